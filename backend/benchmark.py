@@ -0,0 +1,440 @@
+'''
+Load benchmark of the Trivia API.
+
+Seeds a synthetic question bank of each requested size into a local database, drives every route of create_app
+through the Flask test client and/or a multi-threaded HTTP server, and reports throughput, p50/p95/p99 latency and
+SQL queries per request. Results are saved as JSON and can be compared with an earlier run.
+
+    python benchmark.py --sizes 1000,100000 --requests 200 --output results.json
+    python benchmark.py --sizes 1000 --mode http --threads 8 --compare results.json
+'''
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event, func, insert, select
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from flaskr import create_app
+from flaskr.serialization import OrjsonProvider, orjson
+from models import Question, Category, db, question_columns, rebuild_question_counts
+
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports']
+WORDS = ['planet', 'river', 'painter', 'empire', 'movie', 'team', 'atom', 'castle', 'novel', 'island', 'king',
+         'ocean', 'engine', 'opera', 'desert', 'battle', 'galaxy', 'poem', 'mountain', 'olympic']
+SEED_BATCH_SIZE = 10000
+DEFAULT_DATABASE = 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'trivia_benchmark_{size}.db')
+
+
+def synthetic_question(number: int, rng: random.Random) -> dict:
+    words = rng.sample(WORDS, 4)
+    return {
+        'question': f'Question {number}: which {words[0]} is linked to the {words[1]} and the {words[2]}?',
+        'answer': f'The {words[3]} {number}',
+        'category': rng.randint(1, len(CATEGORIES)),
+        'difficulty': rng.randint(1, 5)
+    }
+
+
+def seed_database(app, size: int, rng: random.Random):
+    '''
+    Fills the database with size synthetic questions unless it already holds exactly that many.
+    '''
+    with app.app_context():
+        db.create_all()
+        if db.session.execute(select(func.count(Question.id))).scalar() == size \
+                and db.session.execute(select(func.count(Category.id))).scalar() == len(CATEGORIES):
+            return
+        db.session.execute(Question.__table__.delete())
+        db.session.execute(Category.__table__.delete())
+        db.session.execute(insert(Category), [{'id': index, 'type': name} for index, name in enumerate(CATEGORIES, 1)])
+        for start in range(0, size, SEED_BATCH_SIZE):
+            batch = [synthetic_question(number, rng) for number in range(start, min(start + SEED_BATCH_SIZE, size))]
+            db.session.execute(insert(Question), batch)
+        rebuild_question_counts(db.session.connection())
+        db.session.commit()
+
+
+class Scenarios:
+    '''
+    Builds the requests sent to each endpoint. Each scenario returns (method, url, body, content type).
+    '''
+
+    def __init__(self, app, rng: random.Random):
+        self.rng = rng
+        self.created_ids = []
+        self.quiz_sessions = []
+        self.lock = threading.Lock()
+        with app.app_context():
+            self.max_id = db.session.execute(select(func.max(Question.id))).scalar() or 1
+            self.total = db.session.execute(select(func.count(Question.id))).scalar()
+        self.pages = max(self.total // 10, 1)
+
+    def page(self):
+        return self.rng.randint(1, self.pages)
+
+    def question_id(self):
+        return self.rng.randint(1, self.max_id)
+
+    def category(self):
+        return self.rng.randint(1, len(CATEGORIES))
+
+    def post_question(self):
+        body = json.dumps(synthetic_question(self.rng.randint(0, 10 ** 9), self.rng))
+        return 'POST', '/questions', body, 'application/json'
+
+    def delete_question(self):
+        with self.lock:
+            question_id = self.created_ids.pop() if len(self.created_ids) > 0 else self.max_id + 1
+        return 'DELETE', f'/questions/{question_id}', None, None
+
+    def delete_questions(self):
+        with self.lock:
+            question_ids = [self.created_ids.pop() for _ in range(min(10, len(self.created_ids)))]
+        return 'DELETE', '/questions', json.dumps({'ids': question_ids + [self.max_id + 1]}), 'application/json'
+
+    def import_questions(self):
+        lines = [json.dumps(synthetic_question(self.rng.randint(0, 10 ** 9), self.rng)) for _ in range(10)]
+        return 'POST', '/questions/import', '\n'.join(lines), 'application/x-ndjson'
+
+    def quiz(self):
+        previous_questions = ','.join(str(self.question_id()) for _ in range(self.rng.randint(0, 10)))
+        return 'GET', f'/quizzes?category={self.category()}&previous_questions={previous_questions}', None, None
+
+    def quiz_session(self):
+        with self.lock:
+            token = self.rng.choice(self.quiz_sessions) if len(self.quiz_sessions) > 0 else 'unknown'
+        return 'GET', f'/quizzes/sessions/{token}/next', None, None
+
+    def end_quiz_session(self):
+        with self.lock:
+            token = self.quiz_sessions.pop() if len(self.quiz_sessions) > 0 else 'unknown'
+        return 'DELETE', f'/quizzes/sessions/{token}', None, None
+
+    def build(self) -> dict:
+        '''
+        Returns the scenarios by name, keyed so that every endpoint of the app has at least one scenario.
+        '''
+        return {
+            'get_categories': (lambda: ('GET', '/categories', None, None)),
+            'get_category_stats': (lambda: ('GET', '/categories/stats', None, None)),
+            'get_cache_stats': (lambda: ('GET', '/cache/stats', None, None)),
+            'get_metrics': (lambda: ('GET', '/metrics', None, None)),
+            'get_slow_queries': (lambda: ('GET', '/metrics/slow-queries', None, None)),
+            'get_admission_stats': (lambda: ('GET', '/metrics/admission', None, None)),
+            'get_questions_no_page_specified': (lambda: ('GET', f'/questions?page={self.page()}', None, None)),
+            'get_questions_keyset': (lambda: ('GET', f'/questions?after={self.question_id()}', None, None)),
+            'get_questions_search': (lambda: ('GET', f'/questions?q={self.rng.choice(WORDS)}', None, None)),
+            'get_questions_by_ids': (
+                lambda: ('GET', '/questions?ids=' + ','.join(str(self.question_id()) for _ in range(100)), None, None)),
+            'get_question_by_id': (lambda: ('GET', f'/questions/{self.question_id()}', None, None)),
+            'suggest_questions': (
+                lambda: ('GET', f'/questions/suggest?prefix={self.rng.choice(WORDS)[:3]}', None, None)),
+            'get_question_by_category': (
+                lambda: ('GET', f'/categories/{self.category()}/questions?page={self.rng.randint(1, 5)}', None, None)),
+            'export_all_questions': (
+                lambda: ('GET', f'/questions/export?category={self.category()}&difficulty=1', None, None)),
+            'get_quiz_question': self.quiz,
+            'get_quiz_round': (
+                lambda: ('GET', f'/quizzes?category={self.category()}&count=5&difficulty_mix=1:2,3:2', None, None)),
+            'get_quiz_weighted': (
+                lambda: ('GET', f'/quizzes?category={self.category()}&difficulty_weights=1:1,2:2,3:4,4:2,5:1'
+                                '&rarity=true', None, None)),
+            'start_quiz_session': (
+                lambda: ('POST', '/quizzes/sessions', json.dumps({'category': self.category()}), 'application/json')),
+            'get_next_quiz_session_question': self.quiz_session,
+            'end_quiz_session': self.end_quiz_session,
+            'post_question': self.post_question,
+            'delete_question': self.delete_question,
+            'delete_questions_in_batch': self.delete_questions,
+            'import_questions_in_bulk': self.import_questions
+        }
+
+    def record_response(self, scenario, status, body):
+        if scenario == 'post_question' and status == 200:
+            with self.lock:
+                self.created_ids.append(json.loads(body)['question']['id'])
+        elif scenario == 'start_quiz_session' and status == 200:
+            with self.lock:
+                self.quiz_sessions.append(json.loads(body)['session'])
+
+
+class QueryCounter:
+    '''
+    Counts the SQL statements executed by an engine.
+    '''
+
+    def __init__(self, engine):
+        self.count = 0
+        self.lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        with self.lock:
+            self.count += 1
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if len(sorted_values) == 0:
+        return 0.0
+    index = min(int(round(fraction * len(sorted_values) + 0.5)) - 1, len(sorted_values) - 1)
+    return sorted_values[max(index, 0)]
+
+
+def summarize(scenario, latencies, errors, elapsed, queries, requests) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'scenario': scenario,
+        'requests': requests,
+        'errors': errors,
+        'throughput_rps': round(requests / elapsed, 2) if elapsed > 0 else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'queries_per_request': round(queries / requests, 2) if requests > 0 else 0.0
+    }
+
+
+def decoded_body(data: bytes, content_encoding) -> bytes:
+    '''
+    Returns the body of a response sent with the given Content-Encoding, decompressed.
+    '''
+    if content_encoding == 'gzip':
+        return gzip.decompress(data)
+    if content_encoding == 'br':
+        import brotli
+        return brotli.decompress(data)
+    return data
+
+
+def run_client(app, scenarios, counter, requests: int, accept_encoding=None) -> list:
+    '''
+    Sends the requests of each scenario one after another through the Flask test client.
+    '''
+    headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+    client = app.test_client()
+    results = []
+    for name, build_request in scenarios.build().items():
+        latencies = []
+        errors = 0
+        queries_before = counter.count
+        started = time.perf_counter()
+        for _ in range(requests):
+            method, url, body, content_type = build_request()
+            request_started = time.perf_counter()
+            response = client.open(url, method=method, data=body, content_type=content_type, headers=headers)
+            latencies.append(time.perf_counter() - request_started)
+            if response.status_code >= 500:
+                errors += 1
+            scenarios.record_response(name, response.status_code,
+                                      decoded_body(response.data, response.headers.get('Content-Encoding')))
+        elapsed = time.perf_counter() - started
+        results.append(summarize(name, latencies, errors, elapsed, counter.count - queries_before, requests))
+    return results
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def run_http(app, scenarios, counter, requests: int, threads: int, accept_encoding=None) -> list:
+    '''
+    Serves the app on a local threaded HTTP server and sends the requests of each scenario from a pool of threads.
+    '''
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    def send(name, build_request):
+        method, url, body, content_type = build_request()
+        http_request = urllib.request.Request(base_url + url, method=method,
+                                              data=body.encode() if body is not None else None)
+        if content_type is not None:
+            http_request.add_header('Content-Type', content_type)
+        if accept_encoding:
+            http_request.add_header('Accept-Encoding', accept_encoding)
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(http_request) as response:
+                status, data = response.status, decoded_body(response.read(), response.headers.get('Content-Encoding'))
+        except urllib.error.HTTPError as error:
+            status, data = error.code, decoded_body(error.read(), error.headers.get('Content-Encoding'))
+        except urllib.error.URLError:
+            status, data = 599, b''
+        latency = time.perf_counter() - started
+        scenarios.record_response(name, status, data)
+        return latency, status
+
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for name, build_request in scenarios.build().items():
+                queries_before = counter.count
+                started = time.perf_counter()
+                outcomes = list(pool.map(lambda _: send(name, build_request), range(requests)))
+                elapsed = time.perf_counter() - started
+                latencies = [latency for latency, status in outcomes]
+                errors = len([status for latency, status in outcomes if status >= 500])
+                results.append(summarize(name, latencies, errors, elapsed, counter.count - queries_before, requests))
+    finally:
+        server.shutdown()
+    return results
+
+
+def run_serialization(app, rows: int, repeat: int = 5) -> list:
+    '''
+    Compares the cost of building and serializing a list response of rows questions: ORM objects with
+    Question.format() and the default JSON provider, against question_columns rows with Question.format_row() and
+    the fast JSON provider when it is installed.
+    '''
+    def orm_default():
+        questions = [question.format() for question in
+                     db.session.execute(select(Question).order_by(Question.id).limit(rows)).scalars()]
+        return DefaultJSONProvider(app).dumps({'questions': questions}, separators=(',', ':'))
+
+    def columns_fast():
+        questions = [Question.format_row(row) for row in
+                     db.session.execute(select(*question_columns).order_by(Question.id).limit(rows))]
+        provider = OrjsonProvider(app) if orjson is not None else DefaultJSONProvider(app)
+        return provider.dumps({'questions': questions}, separators=(',', ':'))
+
+    results = []
+    with app.app_context():
+        for name, build in (('serialize_orm_default_json', orm_default), ('serialize_columns_fast_json', columns_fast)):
+            latencies = []
+            for _ in range(repeat):
+                db.session.expunge_all()
+                started = time.perf_counter()
+                build()
+                latencies.append(time.perf_counter() - started)
+            results.append(summarize(name, latencies, 0, sum(latencies), 0, repeat))
+    return results
+
+
+def check_coverage(app, scenarios) -> list:
+    '''
+    Returns the endpoints of the app that have no scenario.
+    '''
+    names = scenarios.build().keys()
+    return sorted(rule.endpoint for rule in app.url_map.iter_rules()
+                  if rule.endpoint != 'static' and rule.endpoint not in names)
+
+
+def compare(results: list, previous: dict):
+    previous_results = {(result['size'], result['mode'], result['scenario']): result
+                        for result in previous.get('results', [])}
+    print('\nChange against the previous run (p95 latency, throughput):')
+    for result in results:
+        before = previous_results.get((result['size'], result['mode'], result['scenario']))
+        if before is None or before['p95_ms'] == 0 or before['throughput_rps'] == 0:
+            continue
+        p95_change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+        throughput_change = (result['throughput_rps'] - before['throughput_rps']) / before['throughput_rps'] * 100
+        print(f"{result['size']:>9} {result['mode']:<6} {result['scenario']:<34} "
+              f"p95 {p95_change:+7.1f}%  rps {throughput_change:+7.1f}%")
+
+
+def print_results(results: list):
+    print(f"{'size':>9} {'mode':<6} {'scenario':<34} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'q/req':>6} {'errors':>6}")
+    for result in results:
+        print(f"{result['size']:>9} {result['mode']:<6} {result['scenario']:<34} {result['throughput_rps']:>9} "
+              f"{result['p50_ms']:>9} {result['p95_ms']:>9} {result['p99_ms']:>9} "
+              f"{result['queries_per_request']:>6} {result['errors']:>6}")
+
+
+def config_overrides(settings: list) -> dict:
+    '''
+    Parses KEY=VALUE settings, reading each value as JSON when possible (true, 10, ["a"]) and as a string otherwise.
+    '''
+    overrides = {}
+    for setting in settings:
+        key, _, value = setting.partition('=')
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every endpoint of the Trivia API.')
+    parser.add_argument('--sizes', default='1000', help='Comma separated question bank sizes, e.g. 1000,100000,1000000.')
+    parser.add_argument('--database', default=DEFAULT_DATABASE,
+                        help='Database URI, {size} is replaced by the question bank size.')
+    parser.add_argument('--requests', type=int, default=100, help='Requests sent per scenario.')
+    parser.add_argument('--mode', choices=['client', 'http', 'both'], default='client')
+    parser.add_argument('--threads', type=int, default=8, help='Client threads in http mode.')
+    parser.add_argument('--accept-encoding', default=None, metavar='CODINGS',
+                        help='Accept-Encoding header sent with every request, e.g. gzip or "br, gzip".')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the data and the requests.')
+    parser.add_argument('--serialization', type=int, default=0, metavar='ROWS',
+                        help='Also compare ORM and column serialization of a list of ROWS questions.')
+    parser.add_argument('--config', action='append', default=[], metavar='KEY=VALUE',
+                        help='App config override, e.g. FAST_JSON=false. May be repeated.')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file.')
+    parser.add_argument('--compare', default=None, help='Compare with the results in this JSON file.')
+    arguments = parser.parse_args()
+
+    results = []
+    for size in [int(size) for size in arguments.sizes.split(',')]:
+        rng = random.Random(arguments.seed)
+        database_path = arguments.database.format(size=size)
+        app = create_app(test_config={'SQLALCHEMY_DATABASE_URI': database_path, **config_overrides(arguments.config)})
+        seed_database(app, size, rng)
+
+        scenarios = Scenarios(app, rng)
+        uncovered = check_coverage(app, scenarios)
+        if len(uncovered) > 0:
+            print(f"No scenario for: {', '.join(uncovered)}")
+
+        with app.app_context():
+            counter = QueryCounter(db.engine)
+
+        modes = ['client', 'http'] if arguments.mode == 'both' else [arguments.mode]
+        for mode in modes:
+            if mode == 'client':
+                mode_results = run_client(app, scenarios, counter, arguments.requests, arguments.accept_encoding)
+            else:
+                mode_results = run_http(app, scenarios, counter, arguments.requests, arguments.threads,
+                                        arguments.accept_encoding)
+            for result in mode_results:
+                result.update(size=size, mode=mode)
+            results.extend(mode_results)
+
+        if arguments.serialization > 0:
+            serialization_results = run_serialization(app, arguments.serialization)
+            for result in serialization_results:
+                result.update(size=size, mode='serial')
+            results.extend(serialization_results)
+
+    print_results(results)
+
+    if arguments.compare is not None:
+        with open(arguments.compare) as previous_file:
+            compare(results, json.load(previous_file))
+
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as output_file:
+            json.dump({
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'arguments': vars(arguments),
+                'results': results
+            }, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,4 +6,107 @@ dotenv_path = join(dirname(__file__), '.env')
 load_dotenv(dotenv_path)
 
 database_password_local = os.environ.get("DB_PASSWORD_LOCAL")
-database_password_unit_test = os.environ.get("DB_PASSWORD_UNIT_TEST")
\ No newline at end of file
+database_password_unit_test = os.environ.get("DB_PASSWORD_UNIT_TEST")
+
+# Seconds the category map is cached for. 0 disables the cache.
+category_cache_ttl = float(os.environ.get("CATEGORY_CACHE_TTL", 300))
+
+# Match misspelled search terms with pg_trgm word similarity on Postgres.
+search_trigram = os.environ.get("SEARCH_TRIGRAM", "true").lower() in ("1", "true", "yes")
+
+# Cache-Control header of each read endpoint that answers conditional (ETag / Last-Modified) requests.
+cache_control = {
+    "get_categories": os.environ.get("CACHE_CONTROL_CATEGORIES", "public, max-age=60"),
+    "get_category_stats": os.environ.get("CACHE_CONTROL_CATEGORY_STATS", "public, no-cache"),
+    "get_questions_no_page_specified": os.environ.get("CACHE_CONTROL_QUESTIONS", "public, no-cache"),
+    "get_question_by_id": os.environ.get("CACHE_CONTROL_QUESTION", "public, no-cache"),
+    "get_question_by_category": os.environ.get("CACHE_CONTROL_CATEGORY_QUESTIONS", "public, no-cache")
+}
+
+# Number of questions written per transaction by the bulk import, and whether Postgres imports use COPY.
+import_batch_size = int(os.environ.get("IMPORT_BATCH_SIZE", 500))
+import_use_copy = os.environ.get("IMPORT_USE_COPY", "true").lower() in ("1", "true", "yes")
+
+# Add a Server-Timing header to every response.
+server_timing = os.environ.get("SERVER_TIMING", "true").lower() in ("1", "true", "yes")
+
+# Log SQL statements slower than this many milliseconds (0 disables the log), with their query plan if enabled.
+slow_query_ms = float(os.environ.get("SLOW_QUERY_MS", 0))
+slow_query_explain = os.environ.get("SLOW_QUERY_EXPLAIN", "true").lower() in ("1", "true", "yes")
+
+# Database URI, by default the local trivia database.
+database_url = os.environ.get("DATABASE_URL")
+
+# Connection pool and engine settings, see models.engine_options.
+db_pool_size = int(os.environ.get("DB_POOL_SIZE", 5))
+db_max_overflow = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+db_pool_timeout = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+db_pool_recycle = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+db_pool_pre_ping = os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+db_statement_timeout_ms = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+
+# Comma separated read replica URIs used by GET requests, how long a failed replica is skipped, and how long a client
+# keeps reading from the primary after a write.
+db_replica_uris = [uri.strip() for uri in os.environ.get("DB_REPLICA_URIS", "").split(",") if uri.strip()]
+replica_retry_seconds = float(os.environ.get("REPLICA_RETRY_SECONDS", 30))
+replica_sticky_seconds = float(os.environ.get("REPLICA_STICKY_SECONDS", 5))
+
+# Serialize responses with orjson when it is installed.
+fast_json = os.environ.get("FAST_JSON", "true").lower() in ("1", "true", "yes")
+
+# Seconds a quiz session is kept after its last request, and the Redis URL of a store shared by every worker
+# (the sessions are kept in the process when it is not set, at most QUIZ_SESSION_MAX_SESSIONS of them).
+quiz_session_ttl = float(os.environ.get("QUIZ_SESSION_TTL", 3600))
+quiz_session_redis_url = os.environ.get("QUIZ_SESSION_REDIS_URL")
+quiz_session_max_sessions = int(os.environ.get("QUIZ_SESSION_MAX_SESSIONS", 10000))
+
+# Seconds the bodies of question list, search and category pages are cached for (0 disables the cache), and the
+# bounds of the cache.
+result_cache_ttl = float(os.environ.get("RESULT_CACHE_TTL", 60))
+result_cache_max_entries = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", 10000))
+result_cache_max_bytes = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+
+# How the workers tell each other about changes so that their in-process caches stay current: auto (LISTEN/NOTIFY on
+# Postgres, off otherwise), postgres, polling (an events table read every INVALIDATION_POLL_SECONDS) or off.
+invalidation_transport = os.environ.get("INVALIDATION_BUS", "auto").lower()
+invalidation_poll_seconds = float(os.environ.get("INVALIDATION_POLL_SECONDS", 1.0))
+
+# Seconds a worker without the invalidation bus keeps the shared data revision its ETags are built from, so that
+# conditional requests do not read it every time (0 reads it for every request).
+data_revision_ttl = float(os.environ.get("DATA_REVISION_TTL", 1.0))
+
+# Where the question list, category and quiz endpoints read questions from: sql (the database) or memory (a
+# columnar snapshot of the question bank kept in each worker).
+read_engine = os.environ.get("READ_ENGINE", "sql").lower()
+
+# Compress text and JSON responses of at least COMPRESSION_MIN_SIZE bytes with brotli (when installed) or gzip, at
+# these levels, keeping up to COMPRESSION_CACHE_MAX_BYTES of compressed bodies of responses with an ETag (0 disables
+# the cache).
+compression = os.environ.get("COMPRESSION", "true").lower() in ("1", "true", "yes")
+compression_min_size = int(os.environ.get("COMPRESSION_MIN_SIZE", 512))
+compression_level = int(os.environ.get("COMPRESSION_LEVEL", 6))
+compression_brotli_quality = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", 5))
+compression_cache_max_bytes = int(os.environ.get("COMPRESSION_CACHE_MAX_BYTES", 8 * 1024 * 1024))
+
+# Limit the concurrent requests to the expensive endpoints, all the endpoints of a kind sharing its read or write
+# budget. Requests beyond the limit wait in a queue of ADMISSION_QUEUE_SIZE per endpoint for up to
+# ADMISSION_QUEUE_TIMEOUT seconds, and are answered with a 503 and Retry-After: ADMISSION_RETRY_AFTER when the queue
+# is full or the wait times out.
+admission_control = os.environ.get("ADMISSION_CONTROL", "true").lower() in ("1", "true", "yes")
+admission_routes = {
+    "get_questions_no_page_specified": "read",
+    "get_question_by_category": "read",
+    "suggest_questions": "read",
+    "export_all_questions": "read",
+    "get_quiz_question": "read",
+    "get_next_quiz_session_question": "read",
+    "post_question": "write",
+    "delete_question": "write",
+    "delete_questions_in_batch": "write",
+    "import_questions_in_bulk": "write"
+}
+admission_read_limit = int(os.environ.get("ADMISSION_READ_LIMIT", 8))
+admission_write_limit = int(os.environ.get("ADMISSION_WRITE_LIMIT", 4))
+admission_queue_size = int(os.environ.get("ADMISSION_QUEUE_SIZE", 16))
+admission_queue_timeout = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 1.0))
+admission_retry_after = int(os.environ.get("ADMISSION_RETRY_AFTER", 1))
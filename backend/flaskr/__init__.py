@@ -1,45 +1,284 @@
-import os
-from flask import Flask, request, abort, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import values, column, select, Integer
+import click
+from flask import Flask, request, abort, jsonify, current_app, stream_with_context
+from sqlalchemy import select, func, true
 from flask_cors import CORS
-import random
 
-from models import setup_db, Question, Category, db
+from models import setup_db, init_db, create_search_indexes, rebuild_question_counts, Question, QuestionCount, db, \
+    question_columns
+from config import category_cache_ttl, search_trigram, cache_control, import_batch_size, import_use_copy, \
+    server_timing, slow_query_ms, slow_query_explain, db_pool_size, db_max_overflow, db_pool_timeout, db_pool_recycle, \
+    db_pool_pre_ping, db_statement_timeout_ms, db_replica_uris, replica_retry_seconds, replica_sticky_seconds, \
+    fast_json, quiz_session_ttl, quiz_session_redis_url, quiz_session_max_sessions, result_cache_ttl, result_cache_max_entries, \
+    result_cache_max_bytes, invalidation_transport, invalidation_poll_seconds, data_revision_ttl, read_engine, compression, compression_min_size, \
+    compression_level, compression_brotli_quality, compression_cache_max_bytes, admission_control, admission_routes, \
+    admission_read_limit, admission_write_limit, admission_queue_size, admission_queue_timeout, admission_retry_after
+from flaskr.cache import category_cache, result_cache, init_result_cache
+from flaskr.quiz import question_selector, parse_difficulty_mix, MAX_QUIZ_QUESTIONS
+from flaskr.quiz_sessions import QuizSession, create_quiz_session_store, new_session_token
+from flaskr.search import search_backend
+from flaskr.conditional import init_conditional_requests
+from flaskr.bulk import import_questions, export_questions, parse_ids, fetch_questions, delete_questions, READERS, \
+    EXPORT_MIMETYPES
+from flaskr.instrumentation import init_instrumentation, request_metrics, METRICS_CONTENT_TYPE
+from flaskr.replicas import init_read_replicas
+from flaskr.serialization import init_json_provider
+from flaskr.migrations import migrate_question_category
+from flaskr.invalidation import init_invalidation_bus, invalidation_bus
+from flaskr.startup import StartupReport
+from flaskr.snapshot import question_snapshot, init_read_engine
+from flaskr.sampling import weighted_sampler, parse_difficulty_weights
+from flaskr.suggest import suggest_index, MAX_SUGGESTIONS
+from flaskr.compression import init_compression
+from flaskr.admission import init_admission_control
 
 QUESTIONS_PER_PAGE = 10
 
 
-def paginate_questions(request: request, selection: list) -> list:
+def paginate_questions(request: request, selection) -> list:
     '''
-    Returns the questions in selection as a list of formatted objects for the page requested in the paramters.
+    Returns the questions in the selection (a select of question_columns) as a list of formatted objects for the page
+    requested in the paramters.
+
+    Only the requested page is read from the database (LIMIT/OFFSET). When an "after" question id is given the page
+    is read with a keyset (id > after) instead, which stays cheap no matter how deep the page is.
     '''
-    page = request.args.get("page", 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
+    after = request.args.get("after", None, type=int)
+    if after is not None:
+        selection = selection.where(Question.id > after)
+    else:
+        page = request.args.get("page", 1, type=int)
+        if page < 1:
+            return []
+        selection = selection.offset((page - 1) * QUESTIONS_PER_PAGE)
 
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
+    rows = db.session.execute(selection.limit(QUESTIONS_PER_PAGE)).all()
+    current_questions = [Question.format_row(row) for row in rows]
 
     return current_questions
 
+def count_questions(filter_criteria) -> int:
+    '''
+    Returns the number of questions matching the filter criteria using a COUNT in the database.
+    '''
+    return db.session.execute(select(func.count(Question.id)).where(filter_criteria)).scalar()
+
+def counted_questions(category_id=None) -> int:
+    '''
+    Returns the number of questions, in the category when one is given, from the maintained question counts.
+    '''
+    statement = select(func.coalesce(func.sum(QuestionCount.total), 0))
+    if category_id is not None:
+        statement = statement.where(QuestionCount.category == category_id)
+    return db.session.execute(statement).scalar()
+
 def filter_questions(request: request):
     '''
     Returns a column filter based on the search paramter (q) in the request.
     '''
     search_term = request.args.get("q", '', type=str)
-    return Question.question.like(f'%{search_term}%')
+    if len(search_term) == 0:
+        return true()
+    return search_backend(current_app.config["SEARCH_TRIGRAM"]).criteria(search_term)
+
+def order_questions(request: request) -> list:
+    '''
+    Returns the order of the questions for the search parameter (q) in the request: best match first when searching,
+    by id otherwise. Keyset pages (an integer after) are always read in id order.
+    '''
+    search_term = request.args.get("q", '', type=str)
+    if len(search_term) == 0 or request.args.get("after", None, type=int) is not None:
+        return [Question.id]
+    return search_backend(current_app.config["SEARCH_TRIGRAM"]).rank(search_term) + [Question.id]
+
+def reads_from_snapshot(request: request) -> bool:
+    '''
+    Returns whether the request is served by the in-memory snapshot: READ_ENGINE is memory and the request does not
+    search, or searches outside Postgres where the snapshot matches like the portable search backend. Postgres
+    searches use full-text ranking and stay in the database.
+    '''
+    if not question_snapshot.enabled:
+        return False
+    return len(request.args.get("q", '', type=str)) == 0 or db.engine.dialect.name != 'postgresql'
+
+def paginate_snapshot(request: request, category_id=None) -> tuple:
+    '''
+    Returns the page of questions requested in the parameters, read from the snapshot the same way as
+    paginate_questions, and the number of matching questions.
+    '''
+    after = request.args.get("after", None, type=int)
+    page = request.args.get("page", 1, type=int)
+    search_term = request.args.get("q", '', type=str)
+    if len(search_term) > 0:
+        rows, total = question_snapshot.search(search_term, QUESTIONS_PER_PAGE, page, after)
+    else:
+        rows = question_snapshot.page(QUESTIONS_PER_PAGE, page, after, category_id)
+        total = question_snapshot.count(category_id)
+    return [Question.format_row(row) for row in rows], total
+
+def select_quiz_question(category_id=None, excluded=frozenset()):
+    '''
+    Returns a random question row in the category whose id is not in excluded from the read engine.
+    '''
+    if question_snapshot.enabled:
+        question = question_snapshot.select(category_id, excluded)
+    else:
+        question = question_selector.select(category_id, excluded)
+    if question is not None:
+        weighted_sampler.record_served([question[0]])
+    return question
+
+def select_quiz_questions(category_id=None, count=1, difficulty_mix=None, excluded=frozenset(),
+                          difficulty_weights=None, rarity=False) -> list:
+    '''
+    Returns up to count distinct random question rows in the category, with the difficulty mix, from the read engine.
+    With difficulty weights or rarity the questions are drawn by the weighted sampler.
+    '''
+    if difficulty_weights is not None or rarity:
+        question_ids = weighted_sampler.draw_many(category_id, count, difficulty_mix, difficulty_weights, rarity,
+                                                  excluded)
+        if question_snapshot.enabled:
+            questions = question_snapshot.rows(question_ids)
+        else:
+            rows = {row[0]: row for row in
+                    db.session.execute(select(*question_columns).where(Question.id.in_(question_ids)))}
+            questions = [rows[question_id] for question_id in question_ids if question_id in rows]
+    elif question_snapshot.enabled:
+        questions = question_snapshot.select_many(category_id, count, difficulty_mix, excluded)
+    else:
+        questions = question_selector.select_many(category_id, count, difficulty_mix, excluded)
+    weighted_sampler.record_served([question[0] for question in questions])
+    return questions
 
 def create_app(test_config=None):
     # create and configure the app
+    startup = StartupReport()
     app = Flask(__name__)
+    app.config.from_mapping(
+        CATEGORY_CACHE_TTL=category_cache_ttl,
+        SEARCH_TRIGRAM=search_trigram,
+        CACHE_CONTROL=dict(cache_control),
+        IMPORT_BATCH_SIZE=import_batch_size,
+        IMPORT_USE_COPY=import_use_copy,
+        SERVER_TIMING=server_timing,
+        SLOW_QUERY_MS=slow_query_ms,
+        SLOW_QUERY_EXPLAIN=slow_query_explain,
+        DB_POOL_SIZE=db_pool_size,
+        DB_MAX_OVERFLOW=db_max_overflow,
+        DB_POOL_TIMEOUT=db_pool_timeout,
+        DB_POOL_RECYCLE=db_pool_recycle,
+        DB_POOL_PRE_PING=db_pool_pre_ping,
+        DB_STATEMENT_TIMEOUT_MS=db_statement_timeout_ms,
+        DB_REPLICA_URIS=list(db_replica_uris),
+        REPLICA_RETRY_SECONDS=replica_retry_seconds,
+        REPLICA_STICKY_SECONDS=replica_sticky_seconds,
+        FAST_JSON=fast_json,
+        QUIZ_SESSION_TTL=quiz_session_ttl,
+        QUIZ_SESSION_REDIS_URL=quiz_session_redis_url,
+        QUIZ_SESSION_MAX_SESSIONS=quiz_session_max_sessions,
+        RESULT_CACHE_TTL=result_cache_ttl,
+        RESULT_CACHE_MAX_ENTRIES=result_cache_max_entries,
+        RESULT_CACHE_MAX_BYTES=result_cache_max_bytes,
+        INVALIDATION_BUS=invalidation_transport,
+        INVALIDATION_POLL_SECONDS=invalidation_poll_seconds,
+        DATA_REVISION_TTL=data_revision_ttl,
+        READ_ENGINE=read_engine,
+        COMPRESSION=compression,
+        COMPRESSION_MIN_SIZE=compression_min_size,
+        COMPRESSION_LEVEL=compression_level,
+        COMPRESSION_BROTLI_QUALITY=compression_brotli_quality,
+        COMPRESSION_CACHE_MAX_BYTES=compression_cache_max_bytes,
+        ADMISSION_CONTROL=admission_control,
+        ADMISSION_ROUTES=dict(admission_routes),
+        ADMISSION_READ_LIMIT=admission_read_limit,
+        ADMISSION_WRITE_LIMIT=admission_write_limit,
+        ADMISSION_QUEUE_SIZE=admission_queue_size,
+        ADMISSION_QUEUE_TIMEOUT=admission_queue_timeout,
+        ADMISSION_RETRY_AFTER=admission_retry_after
+    )
+    if isinstance(test_config, dict):
+        app.config.from_mapping(test_config)
+        test_config = test_config.get("SQLALCHEMY_DATABASE_URI")
+    startup.mark('config')
+
     with app.app_context():
         if test_config is None:
             setup_db(app)
         else:
             setup_db(app, test_config)
+    startup.mark('database')
+
+    category_cache.ttl = app.config["CATEGORY_CACHE_TTL"]
+    category_cache.invalidate()
+    question_selector.reset()
+    weighted_sampler.reset(forget_served=True)
+    suggest_index.reset()
+    suggest_index.builds = suggest_index.refreshes = 0
+    init_read_engine(app)
+    quiz_sessions = create_quiz_session_store(app.config)
+    startup.mark('caches')
 
     CORS(app)
+    init_instrumentation(app)
+    init_json_provider(app)
+    init_compression(app)
+    init_conditional_requests(app)
+    init_result_cache(app)
+    init_admission_control(app)
+    init_read_replicas(app)
+    init_invalidation_bus(app)
+    startup.mark('extensions')
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        '''
+        Create the tables and indexes that do not exist yet, and recount the questions.
+        '''
+        init_db()
+        click.echo('Initialized the database.')
+
+    @app.cli.command('create-search-indexes')
+    def create_search_indexes_command():
+        '''
+        Add the full-text and trigram search indexes to an existing Postgres database.
+        '''
+        create_search_indexes()
+
+    @app.cli.command('import-questions')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'file_format', type=click.Choice(list(READERS)), default=None,
+                  help='ndjson or csv, by default taken from the file extension.')
+    @click.option('--batch-size', type=int, default=None, help='Questions written per transaction.')
+    def import_questions_command(path, file_format, batch_size):
+        '''
+        Import the questions in an NDJSON or CSV file.
+        '''
+        if file_format is None:
+            file_format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+        with open(path, 'rb') as lines:
+            report = import_questions(lines, file_format, batch_size or app.config["IMPORT_BATCH_SIZE"],
+                                      app.config["IMPORT_USE_COPY"])
+        for batch in report['batches']:
+            for error in batch['errors']:
+                click.echo(f"batch {batch['batch']} line {error['line']}: {error['message']}", err=True)
+        click.echo(f"Imported {report['inserted']} questions, rejected {report['rejected']}.")
+
+    @app.cli.command('rebuild-question-counts')
+    def rebuild_question_counts_command():
+        '''
+        Recount the questions per category and difficulty.
+        '''
+        with db.engine.begin() as connection:
+            rebuild_question_counts(connection)
+        click.echo('Rebuilt the question counts.')
+
+    @app.cli.command('migrate-question-category')
+    @click.option('--batch-size', type=int, default=1000, help='Questions rewritten per transaction.')
+    def migrate_question_category_command(batch_size):
+        '''
+        Convert the question category to an integer foreign key and add the category and difficulty indexes.
+        '''
+        migrate_question_category(batch_size, click.echo)
+        click.echo('The question category migration is complete.')
 
     # CORS Headers
     @app.after_request
@@ -61,49 +300,182 @@ def create_app(test_config=None):
         '''
         Return the list of categories.
         '''
-        categories = Category.query.all()
-        categories_json_formated = {}
-        for category in categories:
-            categories_json_formated[category.id] = category.type
+        categories_json_formated = category_cache.get()
         return jsonify({
-            "categories": categories_json_formated, 
+            "categories": categories_json_formated,
             "success": True
         })
-    
+
+    @app.route('/categories/stats', methods=['GET'])
+    def get_category_stats():
+        '''
+        Return the number of questions per category and per difficulty from the maintained question counts.
+        '''
+        categories = {category_id: {'type': category_type, 'total_questions': 0, 'difficulties': {}}
+                      for category_id, category_type in category_cache.get().items()}
+        difficulties = {}
+
+        for category_id, difficulty, total in db.session.execute(
+                select(QuestionCount.category, QuestionCount.difficulty, QuestionCount.total)):
+            if total == 0:
+                continue
+            category = categories.setdefault(category_id, {'type': None, 'total_questions': 0, 'difficulties': {}})
+            category['total_questions'] += total
+            category['difficulties'][difficulty] = total
+            difficulties[difficulty] = difficulties.get(difficulty, 0) + total
+
+        return jsonify({
+            "categories": categories,
+            "difficulties": difficulties,
+            "total_questions": sum(difficulties.values()),
+            "success": True
+        })
+
+
+    @app.route('/cache/stats', methods=['GET'])
+    def get_cache_stats():
+        '''
+        Return the hit and miss counters of the process level caches.
+        '''
+        return jsonify({
+            "categories": category_cache.stats(),
+            "results": result_cache.stats(),
+            "invalidation": invalidation_bus.stats(),
+            "snapshot": question_snapshot.stats(),
+            "sampling": weighted_sampler.stats(),
+            "suggest": suggest_index.stats(),
+            "compression": app.extensions['compressor'].stats(),
+            "success": True
+        })
+
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        '''
+        Return the per-route request metrics in the Prometheus text format.
+        '''
+        return current_app.response_class(request_metrics.render(), mimetype=None, content_type=METRICS_CONTENT_TYPE)
+
+
+    @app.route('/metrics/admission', methods=['GET'])
+    def get_admission_stats():
+        '''
+        Return the concurrency, queue depth, wait time and shed counts of each limited endpoint.
+        '''
+        return jsonify({
+            "routes": current_app.extensions['admission'].stats(),
+            "success": True
+        })
+
+
+    @app.route('/metrics/slow-queries', methods=['GET'])
+    def get_slow_queries():
+        '''
+        Return the most recent SQL statements slower than SLOW_QUERY_MS with their query plans.
+        '''
+        return jsonify({
+            "slow_queries": list(request_metrics.slow_queries),
+            "success": True
+        })
+
 
     @app.route('/questions', methods=['GET'])
     def get_questions_no_page_specified():
         '''
-        Return a paginated list of questions optionally filtered by a search parameter.
+        Return a paginated list of questions optionally filtered by a search parameter, or the questions with
+        the ids in the ids parameter (a comma separated list).
         '''
-        filter_criteria = filter_questions(request)
-        questions = Question.query.filter(filter_criteria).order_by(Question.id).all()
-        current_questions = paginate_questions(request, questions)
-        categories = Category.query.all()
-        categories_json_formated = {}
-        for category in categories:
-            categories_json_formated[category.id] = category.type
+        if "ids" in request.args:
+            try:
+                ids = parse_ids(request.args.get("ids", '', type=str))
+            except ValueError:
+                abort(400)
+            
+            result = fetch_questions(ids)
+            return jsonify({
+                "questions": result['questions'],
+                "found": result['found'],
+                "missing": result['missing'],
+                "success": True
+            })
+        
+        if reads_from_snapshot(request):
+            current_questions, total_questions = paginate_snapshot(request)
+        else:
+            filter_criteria = filter_questions(request)
+            questions = select(*question_columns).where(filter_criteria).order_by(*order_questions(request))
+            current_questions = paginate_questions(request, questions)
+            total_questions = count_questions(filter_criteria) if "q" in request.args else counted_questions()
+        categories_json_formated = category_cache.get()
         
         return jsonify({
             "categories": categories_json_formated,
             "questions": current_questions,
             "current_category": categories_json_formated[1],
-            "total_questions": len(questions),
+            "total_questions": total_questions,
             "success": True
         })
 
+    @app.route('/questions/suggest', methods=['GET'])
+    def suggest_questions():
+        '''
+        Return the words that complete what was typed in a search box and the questions containing them, from an
+        in-memory index.
+        
+        Request Query Parameters
+        ------------------------
+        prefix : the text typed so far. Its last word is completed and the earlier words must all match.
+        limit : the number of words and of questions to return, at most MAX_SUGGESTIONS (10 by default).
+        '''
+        prefix = request.args.get("prefix", '', type=str)
+        limit = request.args.get("limit", 10, type=int)
+        
+        if len(prefix.strip()) == 0 or limit < 1 or limit > MAX_SUGGESTIONS:
+            abort(400)
+        
+        completions, questions = suggest_index.suggest(prefix, limit)
+        return jsonify({
+            'completions': completions,
+            'questions': [Question.format_row(question) for question in questions],
+            'success': True
+        })
+
+    @app.route('/questions/export', methods=['GET'])
+    def export_all_questions():
+        '''
+        Stream every question, optionally filtered, as NDJSON or CSV.
+        
+        Request Query Parameters
+        ------------------------
+        format : ndjson (the default) or csv.
+        category : only export the questions in this category id.
+        difficulty : only export the questions with this difficulty.
+        '''
+        file_format = request.args.get("format", 'ndjson', type=str)
+        category_id = request.args.get("category", None, type=int)
+        difficulty = request.args.get("difficulty", None, type=int)
+        
+        if file_format not in EXPORT_MIMETYPES:
+            abort(400)
+        
+        return current_app.response_class(
+            stream_with_context(export_questions(file_format, category_id, difficulty)),
+            mimetype=EXPORT_MIMETYPES[file_format],
+            headers={'Content-Disposition': f'attachment; filename=questions.{file_format}'}
+        )
+        
     @app.route('/questions/<int:question_id>', methods=['GET'])
     def get_question_by_id(question_id):
         '''
         Return a specific question.
         '''
-        question = Question.query.filter(Question.id == question_id).one_or_none()
+        question = db.session.execute(select(*question_columns).where(Question.id == question_id)).first()
         
         if question is None:
             abort(404)
         else:
             return jsonify({
-                'question': question.format(),
+                'question': Question.format_row(question),
                 'success': True
             })
         
@@ -112,19 +484,21 @@ def create_app(test_config=None):
         '''
         Return a paginated list of questions for the category.
         '''
-        questions = Question.query.filter(Question.category == str( category_id )).all()
-        current_questions = paginate_questions(request, questions)
-        categories = Category.query.all()
-        categories_json_formated = {}
-        for category in categories:
-            categories_json_formated[category.id] = category.type
+        if question_snapshot.enabled:
+            current_questions, total_questions = paginate_snapshot(request, category_id)
+        else:
+            filter_criteria = Question.category == category_id
+            questions = select(*question_columns).where(filter_criteria).order_by(Question.id)
+            current_questions = paginate_questions(request, questions)
+            total_questions = counted_questions(category_id)
+        categories_json_formated = category_cache.get()
             
         return jsonify({
             'categories': categories_json_formated,
-            'current_category': categories_json_formated[category.id],
+            'current_category': categories_json_formated.get(category_id),
             'questions': current_questions,
             'success': True,
-            'total_questions': len(questions)
+            'total_questions': total_questions
         })
             
             
@@ -146,6 +520,35 @@ def create_app(test_config=None):
         return jsonify({
             'success': True
         })
+
+    @app.route('/questions', methods=['DELETE'])
+    def delete_questions_in_batch():
+        '''
+        Delete the questions with the ids in the request body in a single transaction.
+        
+        Request Body
+        ------------
+        ids : the list of question ids to delete.
+        '''
+        data = request.get_json(silent=True)
+        
+        try:
+            ids = parse_ids(data.get('ids') if isinstance(data, dict) else None)
+        except ValueError:
+            abort(400)
+        
+        report = delete_questions(ids)
+        body = {
+            'deleted': report['deleted'],
+            'missing': report['missing'],
+            'failed': report['failed'],
+            'success': len(report['failed']) == 0
+        }
+        if len(report['failed']) > 0:
+            body.update({'error': 500, 'message': 'The questions could not be deleted.'})
+            return jsonify(body), 500
+        
+        return jsonify(body)
                 
 
     @app.route('/questions', methods=['POST'])
@@ -158,11 +561,20 @@ def create_app(test_config=None):
         if 'question' not in data or 'answer' not in data or 'category' not in data or 'difficulty' not in data:
             abort(400)
         
+        try:
+            category_id = int(data['category'])
+            difficulty = int(data['difficulty'])
+        except (TypeError, ValueError):
+            abort(400)
+        
+        if category_id not in category_cache.get():
+            abort(422)
+        
         question = Question(
             question=data['question'],
             answer=data['answer'],
-            category=data['category'],
-            difficulty=int(data['difficulty'])
+            category=category_id,
+            difficulty=difficulty
         )
         
         try:
@@ -176,49 +588,178 @@ def create_app(test_config=None):
         })
         
 
+    @app.route('/questions/import', methods=['POST'])
+    def import_questions_in_bulk():
+        '''
+        Insert the questions in the request body into the datastore in batches.
+        
+        Request Query Parameters
+        ------------------------
+        format : ndjson (the default) or csv. A text/csv content type also selects csv.
+        batch_size : the number of questions written per transaction.
+        '''
+        default_format = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+        file_format = request.args.get("format", default_format, type=str)
+        batch_size = request.args.get("batch_size", current_app.config["IMPORT_BATCH_SIZE"], type=int)
+        
+        if file_format not in READERS or batch_size < 1:
+            abort(400)
+        
+        report = import_questions(request.stream, file_format, batch_size, current_app.config["IMPORT_USE_COPY"])
+        
+        return jsonify({
+            'inserted': report['inserted'],
+            'rejected': report['rejected'],
+            'batches': report['batches'],
+            'success': True
+        })
+        
+
     @app.route('/quizzes', methods=['GET'])
     def get_quiz_question():
         '''
-        Return a single randomly selected question.
+        Return a single randomly selected question, or a round of count distinct questions.
         
         Request Query Parameters
         ------------------------
         category : the category id for the question.
         previous_questions : a comma separated list of questions to be excluded.
+        count : the number of questions to return, at most MAX_QUIZ_QUESTIONS.
+        difficulty_mix : the number of questions of each difficulty, e.g. 1:2,3:1. count defaults to their sum.
+        difficulty_weights : pick questions with these relative weights per difficulty, e.g. 1:1,2:2,3:4.
+        rarity : pick the questions this worker served less often more often (true or false).
         '''
         category_id = request.args.get("category", None, type=int)
         previous_questions_raw = request.args.get("previous_questions", None, type=str)
+        difficulty_mix_raw = request.args.get("difficulty_mix", None, type=str)
+        difficulty_weights_raw = request.args.get("difficulty_weights", None, type=str)
+        rarity = request.args.get("rarity", 'false', type=str).lower() in ('1', 'true', 'yes')
+        count_raw = request.args.get("count", None, type=str)
  
-        if category_id is not None and category_id != 0 :
-
-            statement_base_question_select = select(Question.id).where(Question.category == category_id)
-            
-        else:
-            statement_base_question_select = select(Question.id)
+        if category_id == 0:
+            category_id = None
+        
+        count = None
+        if count_raw is not None:
+            try:
+                count = int(count_raw)
+            except ValueError:
+                abort(400)
                 
+        previous_questions = set()
         if previous_questions_raw is not None and len(previous_questions_raw) > 0:
-            previous_questions = list(map( lambda item: ( int(item), ''), previous_questions_raw.split(',')))
-            previous_question_values = values(column('id'), column('v'), name='test').data(previous_questions)
-            statement_previous_question_values_select = select(previous_question_values.c.id)
-            statement_question_select_filtered = statement_base_question_select.except_(statement_previous_question_values_select)
-        else:
-            statement_question_select_filtered = statement_base_question_select
+            try:
+                previous_questions = set(map(int, previous_questions_raw.split(',')))
+            except ValueError:
+                abort(400)
         
-        final_select = select(Question).where(Question.id.in_(statement_question_select_filtered))
-        questions = db.session.execute(final_select).scalars().all()           
+        difficulty_weights = None
+        if difficulty_weights_raw is not None:
+            try:
+                difficulty_weights = parse_difficulty_weights(difficulty_weights_raw)
+            except ValueError:
+                abort(400)
         
-        if len(questions) > 0 :
-            selected_question_index = random.randint(0, len(questions)-1)
+        if count is not None or difficulty_mix_raw is not None:
+            difficulty_mix = {}
+            if difficulty_mix_raw is not None:
+                try:
+                    difficulty_mix = parse_difficulty_mix(difficulty_mix_raw)
+                except ValueError:
+                    abort(400)
+            if count is None:
+                count = sum(difficulty_mix.values())
+            if count < 1 or count > MAX_QUIZ_QUESTIONS or sum(difficulty_mix.values()) > count:
+                abort(400)
+            
+            questions = select_quiz_questions(category_id, count, difficulty_mix, previous_questions,
+                                              difficulty_weights, rarity)
+            return jsonify({
+                'success': True,
+                'questions': [Question.format_row(question) for question in questions]
+            })
         
+        if difficulty_weights is not None or rarity:
+            questions = select_quiz_questions(category_id, 1, None, previous_questions, difficulty_weights, rarity)
+            question = questions[0] if len(questions) > 0 else None
+        else:
+            question = select_quiz_question(category_id, previous_questions)
+        
+        if question is not None :
             return jsonify({
                 'success': True,
-                'question': questions[selected_question_index].format()
+                'question': Question.format_row(question)
             })
         else:
             return jsonify({
                 'success': True
             })
+
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def start_quiz_session():
+        '''
+        Start a quiz whose questions already asked are remembered on the server.
         
+        Request Body
+        ------------
+        category : the category id for the questions, 0 or none for every category.
+        '''
+        data = request.get_json(silent=True) or {}
+        
+        try:
+            category_id = int(data.get('category') or 0)
+        except (TypeError, ValueError):
+            abort(400)
+        
+        session = QuizSession(new_session_token(), category_id if category_id > 0 else None)
+        quiz_sessions.put(session)
+        
+        return jsonify({
+            'session': session.token,
+            'expires_in': current_app.config["QUIZ_SESSION_TTL"],
+            'success': True
+        })
+
+    @app.route('/quizzes/sessions/<string:token>/next', methods=['GET'])
+    def get_next_quiz_session_question(token):
+        '''
+        Return a random question of the quiz session that it has not asked yet. Concurrent requests for the same
+        session are served one at a time so that they never ask the same question.
+        '''
+        with quiz_sessions.locked(token):
+            session = quiz_sessions.get(token)
+            if session is None:
+                abort(404)
+            
+            question = select_quiz_question(session.category_id, session.seen)
+            if question is None:
+                return jsonify({
+                    'questions_asked': len(session.seen),
+                    'success': True
+                })
+            
+            session.seen.add(question.id)
+            quiz_sessions.put(session)
+        
+        return jsonify({
+            'question': Question.format_row(question),
+            'questions_asked': len(session.seen),
+            'success': True
+        })
+
+    @app.route('/quizzes/sessions/<string:token>', methods=['DELETE'])
+    def end_quiz_session(token):
+        '''
+        End a quiz session.
+        '''
+        session = quiz_sessions.get(token)
+        if session is None or not quiz_sessions.delete(token):
+            abort(404)
+        
+        return jsonify({
+            'questions_asked': len(session.seen),
+            'success': True
+        })
        
     @app.errorhandler(400)
     def handle_bad_request(error):
@@ -260,6 +801,16 @@ def create_app(test_config=None):
             "error": 500, 
             "message": "Server error."
         }), 500
-        
+
+    @app.errorhandler(503)
+    def handle_service_unavailable(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "Service unavailable, retry later."
+        }), 503, {'Retry-After': str(current_app.config["ADMISSION_RETRY_AFTER"])}
+
+    startup.mark('routes')
+    app.extensions['startup_report'] = startup.finish()
     return app
 
@@ -0,0 +1,164 @@
+import threading
+import time
+
+from flask import request, g, abort, current_app
+
+
+class ConcurrencyBudget:
+    '''
+    The slots shared by the limiters of one kind of endpoint: at most limit of their requests run at a time.
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+
+class ConcurrencyLimiter:
+    '''
+    Admits a request when its budget (its own by default, or one shared with other limiters) has a free slot.
+    Requests beyond the limit wait in a queue of this limiter of at most queue_size for up to queue_timeout seconds,
+    in arrival order across every limiter of the budget; a request that finds the queue full or times out is shed.
+    '''
+
+    def __init__(self, limit, queue_size=16, queue_timeout=1.0, budget=None):
+        self.budget = budget if budget is not None else ConcurrencyBudget(limit)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def acquire(self) -> bool:
+        '''
+        Returns True once the request may run, which must be followed by release(), or False when it is shed.
+        '''
+        budget = self.budget
+        with budget.condition:
+            if budget.active < budget.limit and budget.waiting == 0:
+                budget.active += 1
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.queue_size:
+                self.shed_queue_full += 1
+                return False
+
+            self.waiting += 1
+            budget.waiting += 1
+            self.queued += 1
+            started = time.monotonic()
+            deadline = started + self.queue_timeout
+            try:
+                while budget.active >= budget.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed_timeout += 1
+                        return False
+                    budget.condition.wait(remaining)
+                budget.active += 1
+                self.active += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+                budget.waiting -= 1
+                waited = time.monotonic() - started
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    @property
+    def limit(self) -> int:
+        return self.budget.limit
+
+    def release(self):
+        with self.budget.condition:
+            self.budget.active -= 1
+            self.active -= 1
+            self.budget.condition.notify()
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.limit,
+            'budget_active': self.budget.active,
+            'queue_size': self.queue_size,
+            'queue_timeout': self.queue_timeout,
+            'active': self.active,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'shed': {'queue_full': self.shed_queue_full, 'timeout': self.shed_timeout},
+            'wait_seconds': self.wait_seconds,
+            'max_wait_seconds': self.max_wait_seconds
+        }
+
+
+class AdmissionControl:
+    '''
+    The concurrency limiters of an app, one per limited endpoint with its own queue. The limiters of the read
+    endpoints share the read budget and the ones of the write endpoints the write budget, so that the requests
+    running at once stay within the two budgets together, whichever endpoints they come from.
+    '''
+
+    def __init__(self):
+        self.limiters = {}
+        self.kinds = {}
+        self.budgets = {}
+
+    def configure(self, routes: dict, budgets: dict, queue_size, queue_timeout):
+        '''
+        Creates a limiter for each endpoint of routes ({endpoint: 'read' or 'write'}) sharing the budget of its kind
+        in budgets ({'read': limit, 'write': limit}).
+        '''
+        self.budgets = dict(budgets)
+        shared = {kind: ConcurrencyBudget(limit) for kind, limit in budgets.items()}
+        self.limiters = {endpoint: ConcurrencyLimiter(budgets[kind], queue_size, queue_timeout, shared[kind])
+                         for endpoint, kind in routes.items()}
+        self.kinds = dict(routes)
+
+    def stats(self) -> dict:
+        return {endpoint: dict(limiter.stats(), kind=self.kinds[endpoint])
+                for endpoint, limiter in sorted(self.limiters.items())}
+
+
+def init_admission_control(app):
+    '''
+    Limits the concurrent requests to each endpoint of ADMISSION_ROUTES, answering the requests that cannot be
+    admitted in time with a 503 and a Retry-After header instead of letting them pile up on the connection pool.
+
+    It has to be set up after init_conditional_requests and init_result_cache so that the requests they answer
+    without running the view are never queued or shed. The limiters of the app are kept in
+    app.extensions['admission'], with none when ADMISSION_CONTROL is off.
+    '''
+    admission = app.extensions['admission'] = AdmissionControl()
+    if not app.config["ADMISSION_CONTROL"]:
+        return
+
+    admission.configure(
+        app.config["ADMISSION_ROUTES"],
+        {'read': app.config["ADMISSION_READ_LIMIT"], 'write': app.config["ADMISSION_WRITE_LIMIT"]},
+        app.config["ADMISSION_QUEUE_SIZE"],
+        app.config["ADMISSION_QUEUE_TIMEOUT"])
+
+    @app.before_request
+    def admit_request():
+        limiter = current_app.extensions['admission'].limiters.get(request.endpoint)
+        if limiter is None:
+            return None
+        if not limiter.acquire():
+            abort(503)
+        g.admission_limiter = limiter
+        return None
+
+    @app.teardown_request
+    def release_admission(exception):
+        limiter = g.pop('admission_limiter', None)
+        if limiter is not None:
+            limiter.release()
@@ -0,0 +1,311 @@
+import csv
+import io
+import json
+from collections import Counter
+
+from sqlalchemy import insert, select, delete
+
+from models import Question, db, notify_question_change, adjust_question_counts, bump_data_revision, \
+    question_columns
+from flaskr.cache import category_cache
+from flaskr.invalidation import invalidation_bus
+
+QUESTION_FIELDS = ('question', 'answer', 'category', 'difficulty')
+EXPORT_FIELDS = ('id',) + QUESTION_FIELDS
+MAX_ERRORS_PER_BATCH = 20
+MAX_BATCH_IDS = 1000
+# The range of the INTEGER columns.
+MIN_INTEGER = -2 ** 31
+MAX_INTEGER = 2 ** 31 - 1
+
+
+def read_ndjson(lines):
+    '''
+    Yields (line number, row) for each non blank line of newline delimited JSON.
+    '''
+    for line_number, line in enumerate(lines, start=1):
+        if len(line.strip()) == 0:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield line_number, ValueError(f'invalid JSON: {error}')
+            continue
+        yield line_number, row
+
+
+def read_csv(lines):
+    '''
+    Yields (line number, row) for each record of a CSV file with a header line naming the question fields. A record
+    with a line that is not valid UTF-8, or that is not valid CSV, is yielded as a ValueError instead.
+    '''
+    invalid_lines = set()
+
+    def decode(lines):
+        for line_number, line in enumerate(lines, start=1):
+            try:
+                yield line.decode('utf-8')
+            except UnicodeDecodeError:
+                invalid_lines.add(line_number)
+                yield line.decode('utf-8', errors='replace')
+
+    reader = csv.DictReader(decode(lines))
+    first_line = 1
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as error:
+            yield reader.line_num, ValueError(f'invalid CSV: {error}')
+        else:
+            if any(line_number in invalid_lines for line_number in range(first_line, reader.line_num + 1)):
+                yield reader.line_num, ValueError('invalid UTF-8')
+            else:
+                yield reader.line_num, row
+        first_line = reader.line_num + 1
+
+
+READERS = {
+    'ndjson': read_ndjson,
+    'csv': read_csv
+}
+
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def parse_integer(value, field) -> int:
+    '''
+    Returns the integer of an int, of a float with no fractional part or of a string of an integer, raising a
+    ValueError naming field for anything else, booleans included, and for integers out of the range of the column.
+    '''
+    try:
+        if isinstance(value, bool):
+            raise ValueError
+        if isinstance(value, float) and not value.is_integer():
+            raise ValueError
+        if not isinstance(value, (int, float, str)):
+            raise ValueError
+        number = int(value)
+    except (ValueError, OverflowError):
+        raise ValueError(f'{field} must be an integer')
+    if not MIN_INTEGER <= number <= MAX_INTEGER:
+        raise ValueError(f'{field} is out of range')
+    return number
+
+
+def validate_question(row, categories) -> dict:
+    '''
+    Returns the question columns of the row, raising a ValueError describing the first problem found.
+    '''
+    if isinstance(row, Exception):
+        raise row
+    if not isinstance(row, dict):
+        raise ValueError('a question must be an object')
+
+    missing = [field for field in QUESTION_FIELDS if row.get(field) in (None, '')]
+    if len(missing) > 0:
+        raise ValueError(f'missing {", ".join(missing)}')
+
+    category = parse_integer(row['category'], 'category')
+    difficulty = parse_integer(row['difficulty'], 'difficulty')
+    if category not in categories:
+        raise ValueError(f'unknown category {category}')
+
+    return {
+        'question': str(row['question']),
+        'answer': str(row['answer']),
+        'category': category,
+        'difficulty': difficulty
+    }
+
+
+def write_batch(questions, use_copy=False):
+    '''
+    Inserts a batch of validated questions in a single transaction, with COPY on Postgres when use_copy is set and
+    with one executemany otherwise, and adds them to the question counts in the same transaction.
+    '''
+    try:
+        if use_copy and db.engine.dialect.name == 'postgresql':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for question in questions:
+                writer.writerow([question[field] for field in QUESTION_FIELDS])
+            buffer.seek(0)
+            cursor = db.session.connection().connection.cursor()
+            cursor.copy_expert(
+                f'COPY questions ({", ".join(QUESTION_FIELDS)}) FROM STDIN WITH (FORMAT csv)', buffer)
+        else:
+            db.session.execute(insert(Question), questions)
+        adjust_question_counts(Counter((question['category'], question['difficulty']) for question in questions))
+        bump_data_revision()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def import_questions(lines, format='ndjson', batch_size=500, use_copy=False) -> dict:
+    '''
+    Validates and inserts the questions read from lines (an iterable of bytes) in batches of batch_size.
+
+    Rows are read one at a time and at most one batch is held in memory. Invalid rows are skipped and a batch that
+    fails to write is rolled back on its own; both are reported with the batch they belong to.
+    '''
+    categories = category_cache.get()
+    report = {'inserted': 0, 'rejected': 0, 'batches': []}
+    batch = []
+    batch_errors = []
+
+    def flush():
+        result = {'batch': len(report['batches']) + 1, 'inserted': 0, 'errors': batch_errors[:MAX_ERRORS_PER_BATCH]}
+        rejected = len(batch_errors)
+        if len(batch) > 0:
+            try:
+                write_batch(batch, use_copy)
+                result['inserted'] = len(batch)
+            except Exception as error:
+                rejected += len(batch)
+                result['errors'].append({'line': None, 'message': f'batch failed: {error.__class__.__name__}'})
+        report['inserted'] += result['inserted']
+        report['rejected'] += rejected
+        report['batches'].append(result)
+
+    for line_number, row in READERS[format](lines):
+        try:
+            batch.append(validate_question(row, categories))
+        except ValueError as error:
+            batch_errors.append({'line': line_number, 'message': str(error)})
+
+        if len(batch) + len(batch_errors) >= batch_size:
+            flush()
+            batch = []
+            batch_errors = []
+
+    if len(batch) + len(batch_errors) > 0:
+        flush()
+
+    if report['inserted'] > 0:
+        notify_question_change('reload', None)
+
+    return report
+
+
+def export_questions(format='ndjson', category=None, difficulty=None, batch_size=1000):
+    '''
+    Yields the questions, optionally filtered by category and difficulty, as NDJSON or CSV text in id order.
+
+    Rows are read through a server side cursor batch_size at a time and each batch is yielded as one chunk, so memory
+    use does not depend on the number of questions.
+    '''
+    statement = select(*[getattr(Question, field) for field in EXPORT_FIELDS]).order_by(Question.id)
+    if category is not None:
+        statement = statement.where(Question.category == category)
+    if difficulty is not None:
+        statement = statement.where(Question.difficulty == difficulty)
+
+    result = db.session.execute(statement.execution_options(yield_per=batch_size))
+
+    if format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        for partition in result.partitions():
+            writer.writerows(partition)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell() > 0:
+            yield buffer.getvalue()
+    else:
+        for partition in result.partitions():
+            yield ''.join(json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n' for row in partition)
+
+
+def parse_id(value) -> int:
+    '''
+    Returns the question id of an integer, or of a string of digits, raising a ValueError for anything else and for
+    integers out of the range of the id column.
+    '''
+    if isinstance(value, str) and value.strip().isdigit() and value.strip().isascii():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError('ids must be integers')
+    if not MIN_INTEGER <= value <= MAX_INTEGER:
+        raise ValueError('ids must be in the range of the id column')
+    return value
+
+
+def parse_ids(values) -> list:
+    '''
+    Returns the distinct question ids in values (a comma separated string or a list) in their first order, raising a
+    ValueError when one is not an integer (see parse_id) or there are more than MAX_BATCH_IDS.
+    '''
+    if isinstance(values, str):
+        values = [value for value in values.split(',') if len(value.strip()) > 0]
+    if not isinstance(values, list) or len(values) == 0:
+        raise ValueError('ids must be a non empty list')
+    ids = list(dict.fromkeys(parse_id(value) for value in values))
+    if len(ids) > MAX_BATCH_IDS:
+        raise ValueError(f'at most {MAX_BATCH_IDS} ids are allowed')
+    return ids
+
+
+def fetch_questions(ids) -> dict:
+    '''
+    Reads the questions with the given ids in one query. Returns the formatted questions in the order of ids, and the
+    ids that were found and missing.
+    '''
+    rows = db.session.execute(select(*question_columns).where(Question.id.in_(ids))).all()
+    questions = {row[0]: Question.format_row(row) for row in rows}
+    return {
+        'questions': [questions[question_id] for question_id in ids if question_id in questions],
+        'found': [question_id for question_id in ids if question_id in questions],
+        'missing': [question_id for question_id in ids if question_id not in questions]
+    }
+
+
+def delete_questions(ids) -> dict:
+    '''
+    Deletes the questions with the given ids in one statement and one transaction, together with their question
+    counts. Returns the ids that were deleted, missing, or that failed because the transaction was rolled back.
+
+    The local change listeners see each deleted question, while the other workers receive a single reload event.
+    '''
+    statement = delete(Question).where(Question.id.in_(ids)).execution_options(synchronize_session=False)
+    try:
+        if db.engine.dialect.delete_returning:
+            rows = db.session.execute(statement.returning(*question_columns)).all()
+        else:
+            rows = db.session.execute(select(*question_columns).where(Question.id.in_(ids)).with_for_update()).all()
+            db.session.execute(statement)
+        deleted = {row.id for row in rows}
+        changes = Counter()
+        for row in rows:
+            changes[(row.category, row.difficulty)] -= 1
+        adjust_question_counts(changes)
+        bump_data_revision()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        found = set(db.session.execute(select(Question.id).where(Question.id.in_(ids))).scalars())
+        return {
+            'deleted': [],
+            'missing': [question_id for question_id in ids if question_id not in found],
+            'failed': [question_id for question_id in ids if question_id in found]
+        }
+
+    with invalidation_bus.batched():
+        for row in rows:
+            question = Question(row.question, row.answer, row.category, row.difficulty)
+            question.id = row.id
+            notify_question_change('delete', question)
+
+    return {
+        'deleted': [question_id for question_id in ids if question_id in deleted],
+        'missing': [question_id for question_id in ids if question_id not in deleted],
+        'failed': []
+    }
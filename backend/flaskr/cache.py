@@ -0,0 +1,242 @@
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from flask import request, g
+
+from models import Category, on_question_change, on_category_change
+from flaskr.conditional import data_version
+from flaskr.invalidation import invalidation_bus
+
+RESULT_CACHE_ENDPOINTS = ('get_questions_no_page_specified', 'get_question_by_category')
+
+
+class CategoryCache:
+    '''
+    Process level cache of the category map ({id: type}) embedded in the list responses.
+
+    Categories almost never change, so the map is read once and reused until it is older than the ttl (in seconds)
+    or is explicitly invalidated. A ttl of 0 disables caching and a ttl of None keeps the map until invalidated.
+    '''
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._categories = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def _is_fresh(self) -> bool:
+        if self._categories is None:
+            return False
+        return self.ttl is None or time.monotonic() - self._loaded_at < self.ttl
+
+    def get(self) -> dict:
+        '''
+        Returns the category map, reading it from the database only when the cached copy is missing or expired.
+        '''
+        if self._is_fresh():
+            self.hits += 1
+            return self._categories
+
+        with self._lock:
+            if self._is_fresh():
+                self.hits += 1
+                return self._categories
+
+            self.misses += 1
+            categories = {category.id: category.type for category in Category.query.order_by(Category.id).all()}
+            self._categories = categories
+            self._loaded_at = time.monotonic()
+            return categories
+
+    def invalidate(self):
+        '''
+        Drops the cached category map so that the next read goes to the database.
+        '''
+        with self._lock:
+            self._categories = None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'ttl': self.ttl
+        }
+
+
+category_cache = CategoryCache()
+
+
+@on_category_change
+def invalidate_category_cache():
+    category_cache.invalidate()
+
+
+class InMemoryResultStore:
+    '''
+    Process level LRU store of byte strings, bounded by a number of entries and a total size in bytes.
+
+    It has the get / set with a ttl / clear interface of a shared key-value store so that ResultCache can be moved to
+    one later.
+    '''
+
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value: bytes, ttl: float):
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        value, expires_at = self._entries.pop(key)
+        self.bytes -= len(key) + len(value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+
+class ResultCache:
+    '''
+    Process level cache of the bodies of list and search responses, keyed by route, filter and page.
+
+    Keys include the shared data revision the ETag of the response is built from, so an entry computed before a
+    change is never served after it, nor under the ETag of a later revision. Changes also clear the store to free
+    its memory at once. A ttl of 0 disables the cache.
+    '''
+
+    def __init__(self, store=None, ttl=60):
+        self.store = store if store is not None else InMemoryResultStore()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def key(self, path: str, args, revision) -> str:
+        query = urlencode(sorted(args.items(multi=True)))
+        epoch, version, modified_at = revision
+        return f'{epoch}-{version}:{path}?{query}'
+
+    def get(self, key):
+        body = self.store.get(key)
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+
+    def set(self, key, body: bytes):
+        self.store.set(key, body, self.ttl)
+
+    def invalidate(self):
+        self.invalidations += 1
+        self.store.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        stats = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'ttl': self.ttl,
+            'bypassed': self.bypassed,
+            'invalidations': self.invalidations
+        }
+        if isinstance(self.store, InMemoryResultStore):
+            stats.update(entries=len(self.store), bytes=self.store.bytes, max_bytes=self.store.max_bytes,
+                         evictions=self.store.evictions)
+        return stats
+
+
+result_cache = ResultCache()
+
+
+@on_question_change
+def invalidate_result_cache(action, question):
+    result_cache.invalidate()
+
+
+@on_category_change
+def invalidate_result_cache_for_category():
+    result_cache.invalidate()
+
+
+def init_result_cache(app):
+    '''
+    Answers GET requests to the endpoints in RESULT_CACHE_ENDPOINTS from the result cache before the view runs, and
+    stores the bodies of the successful responses that missed.
+
+    The cache is only used with the invalidation bus: without it this worker would not see the changes of the
+    others in time, and would serve their stale pages. It has to be set up after init_conditional_requests, whose
+    revision it is keyed by.
+    '''
+    result_cache.ttl = app.config["RESULT_CACHE_TTL"]
+    result_cache.store = InMemoryResultStore(app.config["RESULT_CACHE_MAX_ENTRIES"], app.config["RESULT_CACHE_MAX_BYTES"])
+    result_cache.hits = result_cache.misses = result_cache.bypassed = result_cache.invalidations = 0
+
+    def is_cacheable():
+        return result_cache.enabled and request.method == 'GET' and request.endpoint in RESULT_CACHE_ENDPOINTS
+
+    @app.before_request
+    def answer_from_result_cache():
+        if not is_cacheable():
+            return None
+        if invalidation_bus.transport is None:
+            result_cache.bypassed += 1
+            return None
+
+        revision = g.data_revision if 'data_revision' in g else data_version.revision()
+        if revision is None:
+            return None
+        key = result_cache.key(request.path, request.args, revision)
+        body = result_cache.get(key)
+        if body is not None:
+            return app.response_class(body, mimetype='application/json')
+        g.result_cache_key = key
+        return None
+
+    @app.after_request
+    def store_in_result_cache(response):
+        key = g.pop('result_cache_key', None)
+        if key is not None and response.status_code == 200 and not response.is_streamed:
+            result_cache.set(key, response.get_data())
+        return response
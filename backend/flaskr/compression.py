@@ -0,0 +1,153 @@
+import gzip
+import weakref
+
+from flask import request
+
+from models import on_question_change, on_category_change
+from flaskr.cache import InMemoryResultStore
+from flaskr.conditional import ENCODING_ETAG_SUFFIXES
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain')
+
+# Compressed bodies are keyed by ETag, which changes with every change to the question bank, so an entry never goes
+# stale and only needs a ttl to free memory.
+COMPRESSED_BODY_TTL = 3600
+
+
+def available_encodings() -> list:
+    '''
+    Returns the content codings the server can produce, best first.
+    '''
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+class Compressor:
+    '''
+    Compresses response bodies with brotli (when it is installed) or gzip, and keeps the compressed bodies of the
+    responses that have an ETag so that a hot response is compressed once rather than on every request.
+    '''
+
+    def __init__(self, enabled=True, level=6, brotli_quality=5, min_size=512, store=None):
+        self.enabled = enabled
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.min_size = min_size
+        self.store = store
+        self.compressed = 0
+        self.cache_hits = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def negotiate(self):
+        '''
+        Returns the content coding used for the current request, the best one its client accepts, or None.
+        '''
+        if not self.enabled:
+            return None
+        return request.accept_encodings.best_match(available_encodings())
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.level, mtime=0)
+
+    def compressed_body(self, body: bytes, encoding: str, etag=None) -> bytes:
+        '''
+        Returns body compressed with encoding, from the store when a response with the same ETag was compressed
+        before.
+        '''
+        key = f'{etag}:{encoding}' if etag is not None and self.store is not None else None
+        if key is not None:
+            compressed = self.store.get(key)
+            if compressed is not None:
+                self.cache_hits += 1
+                return compressed
+
+        compressed = self.compress(body, encoding)
+        self.compressed += 1
+        if key is not None:
+            self.store.set(key, compressed, COMPRESSED_BODY_TTL)
+        return compressed
+
+    def invalidate(self):
+        if self.store is not None:
+            self.store.clear()
+
+    def stats(self) -> dict:
+        stats = {
+            'encodings': available_encodings(),
+            'compressed': self.compressed,
+            'cache_hits': self.cache_hits,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'ratio': self.bytes_out / self.bytes_in if self.bytes_in else 0.0
+        }
+        if self.store is not None:
+            stats.update(entries=len(self.store), bytes=self.store.bytes)
+        return stats
+
+
+# The compressor of each app, whose bodies are dropped by every change.
+compressors = weakref.WeakSet()
+
+
+@on_question_change
+def invalidate_compressed_bodies(action, question):
+    for compressor in list(compressors):
+        compressor.invalidate()
+
+
+@on_category_change
+def invalidate_compressed_bodies_for_category():
+    for compressor in list(compressors):
+        compressor.invalidate()
+
+
+def init_compression(app):
+    '''
+    Compresses the successful text and JSON responses of at least COMPRESSION_MIN_SIZE bytes with the best coding
+    the client accepts. The ETag of a compressed response gets the suffix of its coding, since the bytes differ.
+
+    It has to be set up before init_conditional_requests and init_result_cache: after_request functions run in
+    reverse order, so the response is compressed after its ETag is set and after the result cache stored the
+    uncompressed body. The compressor of the app is kept in app.extensions['compressor'].
+    '''
+    max_bytes = app.config["COMPRESSION_CACHE_MAX_BYTES"]
+    compressor = Compressor(app.config["COMPRESSION"], app.config["COMPRESSION_LEVEL"],
+                            app.config["COMPRESSION_BROTLI_QUALITY"], app.config["COMPRESSION_MIN_SIZE"],
+                            InMemoryResultStore(max_bytes=max_bytes) if max_bytes > 0 else None)
+    app.extensions['compressor'] = compressor
+    compressors.add(compressor)
+
+    if not compressor.enabled:
+        return
+
+    @app.after_request
+    def compress_response(response):
+        if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+                or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+
+        body = response.get_data()
+        if len(body) < compressor.min_size:
+            return response
+        response.vary.add('Accept-Encoding')
+
+        encoding = compressor.negotiate()
+        if encoding is None:
+            return response
+
+        etag, weak = response.get_etag()
+        compressed = compressor.compressed_body(body, encoding, None if etag is None or weak else etag)
+        compressor.bytes_in += len(body)
+        compressor.bytes_out += len(compressed)
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        if etag is not None:
+            response.set_etag(etag + ENCODING_ETAG_SUFFIXES[encoding], weak)
+        return response
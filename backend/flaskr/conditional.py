@@ -0,0 +1,163 @@
+import hashlib
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from flask import request, g
+from sqlalchemy import select
+
+from models import DataRevision, db, on_question_change, on_category_change
+from flaskr.invalidation import invalidation_bus
+
+
+class DataVersion:
+    '''
+    Process level counter of the changes to the question bank seen by this worker, its own and the ones delivered by
+    the invalidation bus, used to key the result cache. The epoch is unique to the process so that a restart never
+    reuses the keys of an earlier run.
+
+    The ETags and Last-Modified dates of the read endpoints, and the keys of the result cache, are built from the
+    data revision shared by every worker instead (see models.DataRevision), so that they agree across workers and
+    restarts.
+    '''
+
+    def __init__(self, ttl=1.0):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.ttl = ttl
+        self._revision = None
+        self._lock = threading.Lock()
+
+    def configure(self, ttl):
+        with self._lock:
+            self.ttl = ttl
+            self._revision = None
+
+    def bump(self):
+        with self._lock:
+            self.version += 1
+            self._revision = None
+
+    def revision(self):
+        '''
+        Returns the (epoch, version, modified_at) of the shared data revision, or None when it has not been created.
+
+        While the invalidation bus is listening the changes of the other workers reach this worker, so the revision
+        is kept until the next change it sees. Otherwise it is kept for ttl seconds, the longest a change made by
+        another worker goes unnoticed (0 reads it for every request).
+        '''
+        cached = self._revision
+        if cached is not None and (invalidation_bus.started or time.monotonic() < cached[1]):
+            return cached[0]
+
+        seen = self.version
+        row = db.session.execute(select(DataRevision.epoch, DataRevision.version, DataRevision.modified_at)
+                                 .where(DataRevision.id == 1)).first()
+        revision = tuple(row) if row is not None else None
+        if revision is not None and (invalidation_bus.started or self.ttl > 0):
+            with self._lock:
+                # A change seen while reading may be newer than the row that was read.
+                if self.version == seen:
+                    self._revision = (revision, time.monotonic() + self.ttl)
+        return revision
+
+    def validators(self, path: str, query_string: bytes, revision=None):
+        '''
+        Returns the strong ETag and the Last-Modified date of the representation at path with query_string for
+        revision (the current one by default), or None when there is no revision yet.
+
+        The date has a one second resolution, so it is left out (None) during the second of the last change: a
+        later change in the same second would not change it.
+        '''
+        if revision is None:
+            revision = self.revision()
+        if revision is None:
+            return None
+        epoch, version, modified_at = revision
+        resource = hashlib.sha1(path.encode() + b'?' + query_string).hexdigest()[:16]
+        last_modified = datetime.fromtimestamp(modified_at, timezone.utc) if modified_at < int(time.time()) else None
+        return f'{epoch}-{version}-{resource}', last_modified
+
+
+data_version = DataVersion()
+
+# Appended to the ETag of a compressed response (see flaskr.compression), whose bytes differ from the uncompressed one.
+ENCODING_ETAG_SUFFIXES = {'br': '-br', 'gzip': '-gzip'}
+
+
+def matching_etag(if_none_match, etag: str, encoding=None):
+    '''
+    Returns the ETag in if_none_match that names etag, or its form compressed with encoding, or None. The forms
+    compressed with other codings are not the representation the client would get now.
+    '''
+    candidates = [etag] if encoding is None else [etag, etag + ENCODING_ETAG_SUFFIXES[encoding]]
+    for candidate in candidates:
+        if if_none_match.contains(candidate):
+            return candidate
+    return None
+
+
+@on_question_change
+def bump_data_version(action, question):
+    data_version.bump()
+
+
+@on_category_change
+def bump_data_version_for_category():
+    data_version.bump()
+
+
+def init_conditional_requests(app):
+    '''
+    Answers conditional GET requests to the endpoints listed in the CACHE_CONTROL config with a 304 before the view
+    runs, and adds ETag, Last-Modified and the endpoint's Cache-Control header to their responses.
+
+    It has to be set up after init_compression, whose compressor negotiates the coding of the ETag to match. The
+    revision the validators are built from is kept in g.data_revision for the result cache.
+    '''
+    compressor = app.extensions.get('compressor')
+    data_version.configure(app.config["DATA_REVISION_TTL"])
+
+    def is_conditional():
+        return request.method in ('GET', 'HEAD') and request.endpoint in app.config["CACHE_CONTROL"]
+
+    def add_validators(response, etag, last_modified):
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        response.headers["Cache-Control"] = app.config["CACHE_CONTROL"][request.endpoint]
+        return response
+
+    @app.before_request
+    def answer_conditional_request():
+        if not is_conditional():
+            return None
+
+        g.data_revision = data_version.revision()
+        validators = data_version.validators(request.path, request.query_string, g.data_revision)
+        if validators is None:
+            return None
+        g.etag, g.last_modified = validators
+
+        matched = g.etag
+        if request.if_none_match:
+            encoding = compressor.negotiate() if compressor is not None else None
+            matched = matching_etag(request.if_none_match, g.etag, encoding)
+            not_modified = matched is not None
+        else:
+            not_modified = request.if_modified_since is not None and g.last_modified is not None \
+                and request.if_modified_since >= g.last_modified
+
+        if not not_modified:
+            return None
+        response = add_validators(app.response_class(status=304), matched, g.last_modified)
+        if compressor is not None and compressor.enabled:
+            response.vary.add('Accept-Encoding')
+        return response
+
+    @app.after_request
+    def add_conditional_headers(response):
+        if response.status_code == 200 and is_conditional() and 'etag' in g:
+            add_validators(response, g.etag, g.last_modified)
+        return response
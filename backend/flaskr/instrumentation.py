@@ -0,0 +1,318 @@
+import bisect
+import logging
+import threading
+import time
+from collections import deque
+
+from flask import g, request, current_app, has_app_context, has_request_context
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import TimedQueuePool, db
+from flaskr.cache import category_cache, result_cache
+from flaskr.replicas import replica_router
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+slow_query_logger = logging.getLogger('flaskr.slow_queries')
+
+
+class Histogram:
+    '''
+    Prometheus style histogram: a count per upper bound plus the count and sum of every observation.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self) -> list:
+        counts = []
+        total = 0
+        for count in self.counts[:-1]:
+            total += count
+            counts.append(total)
+        return counts
+
+
+class RequestMetrics:
+    '''
+    Process level per-route request metrics rendered in the Prometheus text format.
+    '''
+
+    def __init__(self, slow_query_log_size=50):
+        self.durations = {}
+        self.requests = {}
+        self.sql_queries = {}
+        self.sql_seconds = {}
+        self.json_seconds = {}
+        self.slow_queries = deque(maxlen=slow_query_log_size)
+        self.slow_query_count = 0
+        self.pool_wait = Histogram()
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, method, status, duration, queries, sql_time, json_time):
+        route = (endpoint or 'unmatched', method)
+        with self._lock:
+            self.durations.setdefault(route, Histogram()).observe(duration)
+            self.requests[route + (str(status),)] = self.requests.get(route + (str(status),), 0) + 1
+            self.sql_queries[route] = self.sql_queries.get(route, 0) + queries
+            self.sql_seconds[route] = self.sql_seconds.get(route, 0.0) + sql_time
+            self.json_seconds[route] = self.json_seconds.get(route, 0.0) + json_time
+
+    def observe_pool_wait(self, waited: float):
+        with self._lock:
+            self.pool_wait.observe(waited)
+
+    def record_slow_query(self, entry: dict):
+        with self._lock:
+            self.slow_queries.append(entry)
+            self.slow_query_count += 1
+
+    def render(self) -> str:
+        lines = []
+
+        def labels(route, **extra):
+            pairs = [('endpoint', route[0]), ('method', route[1])] + list(extra.items())
+            return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+        with self._lock:
+            lines.append('# HELP trivia_request_duration_seconds Time spent handling a request.')
+            lines.append('# TYPE trivia_request_duration_seconds histogram')
+            for route, histogram in sorted(self.durations.items()):
+                for bound, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                    lines.append(f'trivia_request_duration_seconds_bucket{labels(route, le=bound)} {count}')
+                lines.append(f'trivia_request_duration_seconds_bucket{labels(route, le="+Inf")} {histogram.count}')
+                lines.append(f'trivia_request_duration_seconds_sum{labels(route)} {histogram.sum}')
+                lines.append(f'trivia_request_duration_seconds_count{labels(route)} {histogram.count}')
+
+            lines.append('# HELP trivia_requests_total Requests handled by route and status code.')
+            lines.append('# TYPE trivia_requests_total counter')
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'trivia_requests_total{labels((endpoint, method), status=status)} {count}')
+
+            for name, description, values in (
+                    ('trivia_request_sql_queries_total', 'SQL statements executed.', self.sql_queries),
+                    ('trivia_request_sql_seconds_total', 'Time spent executing SQL statements.', self.sql_seconds),
+                    ('trivia_request_json_seconds_total', 'Time spent serializing JSON.', self.json_seconds)):
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} counter')
+                for route, value in sorted(values.items()):
+                    lines.append(f'{name}{labels(route)} {value}')
+
+            lines.append('# HELP trivia_slow_queries_total SQL statements slower than SLOW_QUERY_MS.')
+            lines.append('# TYPE trivia_slow_queries_total counter')
+            lines.append(f'trivia_slow_queries_total {self.slow_query_count}')
+
+            lines.append('# HELP trivia_db_pool_checkout_wait_seconds Time spent waiting for a pooled connection.')
+            lines.append('# TYPE trivia_db_pool_checkout_wait_seconds histogram')
+            for bound, count in zip(self.pool_wait.buckets, self.pool_wait.cumulative_counts()):
+                lines.append(f'trivia_db_pool_checkout_wait_seconds_bucket{{le="{bound}"}} {count}')
+            lines.append(f'trivia_db_pool_checkout_wait_seconds_bucket{{le="+Inf"}} {self.pool_wait.count}')
+            lines.append(f'trivia_db_pool_checkout_wait_seconds_sum {self.pool_wait.sum}')
+            lines.append(f'trivia_db_pool_checkout_wait_seconds_count {self.pool_wait.count}')
+
+        if has_app_context() and isinstance(db.engine.pool, TimedQueuePool):
+            pool = db.engine.pool
+            for name, description, value in (
+                    ('trivia_db_pool_size', 'Configured number of pooled connections.', pool.size()),
+                    ('trivia_db_pool_checked_out', 'Connections currently checked out.', pool.checkedout()),
+                    ('trivia_db_pool_overflow', 'Connections open beyond the pool size.', max(pool.overflow(), 0))):
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} gauge')
+                lines.append(f'{name} {value}')
+
+        if has_app_context() and 'startup_report' in current_app.extensions:
+            startup = current_app.extensions['startup_report']
+            lines.append('# HELP trivia_startup_seconds Time spent creating the app, by phase.')
+            lines.append('# TYPE trivia_startup_seconds gauge')
+            for phase, duration_ms in startup['phases'].items():
+                lines.append(f'trivia_startup_seconds{{phase="{phase}"}} {duration_ms / 1000}')
+            lines.append('# HELP trivia_startup_database_statements SQL statements executed while creating the app.')
+            lines.append('# TYPE trivia_startup_database_statements gauge')
+            lines.append(f'trivia_startup_database_statements {startup["database_statements"]}')
+
+        stats = category_cache.stats()
+        lines.append('# HELP trivia_category_cache_lookups_total Category map lookups by result.')
+        lines.append('# TYPE trivia_category_cache_lookups_total counter')
+        lines.append(f'trivia_category_cache_lookups_total{{result="hit"}} {stats["hits"]}')
+        lines.append(f'trivia_category_cache_lookups_total{{result="miss"}} {stats["misses"]}')
+
+        stats = result_cache.stats()
+        lines.append('# HELP trivia_result_cache_lookups_total List and search response cache lookups by result.')
+        lines.append('# TYPE trivia_result_cache_lookups_total counter')
+        lines.append(f'trivia_result_cache_lookups_total{{result="hit"}} {stats["hits"]}')
+        lines.append(f'trivia_result_cache_lookups_total{{result="miss"}} {stats["misses"]}')
+        lines.append(f'trivia_result_cache_lookups_total{{result="bypassed"}} {stats["bypassed"]}')
+        if 'bytes' in stats:
+            lines.append('# HELP trivia_result_cache_bytes Size of the cached list and search responses.')
+            lines.append('# TYPE trivia_result_cache_bytes gauge')
+            lines.append(f'trivia_result_cache_bytes {stats["bytes"]}')
+            lines.append('# HELP trivia_result_cache_evictions_total Cached responses evicted to stay within bounds.')
+            lines.append('# TYPE trivia_result_cache_evictions_total counter')
+            lines.append(f'trivia_result_cache_evictions_total {stats["evictions"]}')
+
+        replicas = replica_router.stats()
+        if len(replicas['replicas']) > 0:
+            lines.append('# HELP trivia_replica_reads_total GET requests read from each replica or the primary.')
+            lines.append('# TYPE trivia_replica_reads_total counter')
+            for index, replica in enumerate(replicas['replicas']):
+                lines.append(f'trivia_replica_reads_total{{replica="{index}"}} {replica["reads"]}')
+            lines.append(f'trivia_replica_reads_total{{replica="primary"}} {replicas["primary_reads"]}')
+            lines.append('# HELP trivia_replica_healthy Whether each replica is currently used.')
+            lines.append('# TYPE trivia_replica_healthy gauge')
+            for index, replica in enumerate(replicas['replicas']):
+                lines.append(f'trivia_replica_healthy{{replica="{index}"}} {int(replica["healthy"])}')
+            lines.append('# HELP trivia_replica_failovers_total Replica connections that failed.')
+            lines.append('# TYPE trivia_replica_failovers_total counter')
+            lines.append(f'trivia_replica_failovers_total {replicas["failovers"]}')
+
+        admission = current_app.extensions['admission'].stats() \
+            if has_app_context() and 'admission' in current_app.extensions else {}
+        if len(admission) > 0:
+            for name, description, key in (
+                    ('trivia_admission_in_flight', 'Requests running under the concurrency limit.', 'active'),
+                    ('trivia_admission_queue_depth', 'Requests waiting for a slot.', 'waiting')):
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} gauge')
+                for endpoint, stats in admission.items():
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {stats[key]}')
+            lines.append('# HELP trivia_admission_wait_seconds Time queued requests spent waiting for a slot.')
+            lines.append('# TYPE trivia_admission_wait_seconds summary')
+            for endpoint, stats in admission.items():
+                lines.append(f'trivia_admission_wait_seconds_sum{{endpoint="{endpoint}"}} {stats["wait_seconds"]}')
+                lines.append(f'trivia_admission_wait_seconds_count{{endpoint="{endpoint}"}} {stats["queued"]}')
+            lines.append('# HELP trivia_admission_shed_total Requests answered with a 503, by reason.')
+            lines.append('# TYPE trivia_admission_shed_total counter')
+            for endpoint, stats in admission.items():
+                for reason, count in stats['shed'].items():
+                    lines.append(f'trivia_admission_shed_total{{endpoint="{endpoint}",reason="{reason}"}} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+
+
+def record_pool_wait(waited: float):
+    request_metrics.observe_pool_wait(waited)
+    if has_request_context() and 'pool_wait' in g:
+        g.pool_wait += waited
+
+
+TimedQueuePool.wait_observers.append(record_pool_wait)
+
+
+def record_json_time(seconds: float):
+    if has_request_context() and 'json_time' in g:
+        g.json_time += seconds
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    '''
+    JSON provider that adds the time spent serializing to the request's timings.
+    '''
+
+    def dumps(self, obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            record_json_time(time.perf_counter() - started)
+
+
+def explain(connection, cursor, statement, parameters) -> str:
+    '''
+    Returns the query plan of a statement, read on a separate cursor so that it is not itself instrumented.
+    '''
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.dialect.name == 'sqlite' else 'EXPLAIN '
+    explain_cursor = connection.connection.cursor()
+    try:
+        explain_cursor.execute(prefix + statement, parameters)
+        return '\n'.join(str(row[-1]) for row in explain_cursor.fetchall())
+    finally:
+        explain_cursor.close()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(connection, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - connection.info['query_started'].pop()
+
+    if has_request_context() and 'sql_count' in g:
+        g.sql_count += 1
+        g.sql_time += elapsed
+
+    if not has_app_context():
+        return
+    threshold = current_app.config.get("SLOW_QUERY_MS")
+    if not threshold or elapsed * 1000 < threshold:
+        return
+
+    entry = {
+        'statement': statement,
+        'duration_ms': round(elapsed * 1000, 3),
+        'endpoint': request.endpoint if has_request_context() else None,
+        'plan': None
+    }
+    if current_app.config.get("SLOW_QUERY_EXPLAIN") and not executemany \
+            and statement.lstrip().upper().startswith('SELECT'):
+        try:
+            entry['plan'] = explain(connection, cursor, statement, parameters)
+        except Exception as error:
+            entry['plan'] = f'EXPLAIN failed: {error}'
+    request_metrics.record_slow_query(entry)
+    slow_query_logger.warning('Slow query (%.1f ms) in %s: %s\n%s', entry['duration_ms'], entry['endpoint'],
+                              statement, entry['plan'] or '')
+
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_timer(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+
+def init_instrumentation(app):
+    '''
+    Times every request, its SQL statements and its JSON serialization, adds a Server-Timing header and records the
+    per-route metrics served by /metrics.
+    '''
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        g.sql_count = 0
+        g.sql_time = 0.0
+        g.json_time = 0.0
+        g.pool_wait = 0.0
+
+    @app.after_request
+    def record_request_timings(response):
+        if 'request_started' not in g:
+            return response
+        duration = time.perf_counter() - g.request_started
+        request_metrics.observe(request.endpoint, request.method, response.status_code, duration,
+                                g.sql_count, g.sql_time, g.json_time)
+        if app.config["SERVER_TIMING"]:
+            response.headers.add('Server-Timing', ', '.join([
+                f'pool;dur={g.pool_wait * 1000:.2f}',
+                f'db;dur={g.sql_time * 1000:.2f};desc="{g.sql_count} queries"',
+                f'json;dur={g.json_time * 1000:.2f}',
+                f'app;dur={duration * 1000:.2f}'
+            ]))
+        return response
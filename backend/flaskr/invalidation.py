@@ -0,0 +1,274 @@
+import json
+import logging
+import select as selectors
+import threading
+import time
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+
+from sqlalchemy import select, insert, delete, func
+
+from models import InvalidationEvent, db, on_question_change, on_category_change, question_change_listeners, \
+    category_change_listeners
+
+CHANNEL = 'trivia_invalidation'
+EVENT_RETENTION_SECONDS = 600
+
+invalidation_logger = logging.getLogger('flaskr.invalidation')
+
+"""
+QuestionChange
+    the question of a change published by another worker, with the attributes read by the question change listeners
+"""
+QuestionChange = namedtuple('QuestionChange', ['id', 'category', 'difficulty'])
+
+
+class PostgresNotifyTransport:
+    '''
+    Sends events with NOTIFY and receives them on a dedicated connection that LISTENs on the channel.
+    '''
+
+    name = 'postgres'
+
+    def __init__(self, engine, channel=CHANNEL):
+        self.engine = engine
+        self.channel = channel
+
+    def publish(self, origin, payload: str):
+        with self.engine.begin() as connection:
+            connection.execute(select(func.pg_notify(self.channel, payload)))
+
+    def listen(self, receive, resync, stopped):
+        while not stopped.is_set():
+            connection = None
+            try:
+                connection = self.engine.raw_connection()
+                connection.detach()
+                driver_connection = connection.driver_connection
+                driver_connection.autocommit = True
+                driver_connection.cursor().execute(f'LISTEN {self.channel}')
+                # Events sent while there was no listener are lost, so start from a clean state.
+                resync()
+                while not stopped.is_set():
+                    if selectors.select([driver_connection], [], [], 1.0) == ([], [], []):
+                        continue
+                    driver_connection.poll()
+                    while driver_connection.notifies:
+                        receive(driver_connection.notifies.pop(0).payload)
+            except Exception:
+                invalidation_logger.exception('Invalidation listener failed, reconnecting')
+                stopped.wait(1.0)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+
+class PollingTransport:
+    '''
+    Sends events by writing them to the invalidation_events table and receives them by reading the rows with a
+    higher id every interval seconds. Works with any database, SQLite included.
+    '''
+
+    name = 'polling'
+
+    def __init__(self, engine, interval=1.0):
+        self.engine = engine
+        self.interval = interval
+
+    def publish(self, origin, payload: str):
+        with self.engine.begin() as connection:
+            connection.execute(insert(InvalidationEvent).values(origin=origin, payload=payload,
+                                                                created_at=time.time()))
+
+    def listen(self, receive, resync, stopped):
+        last_id = None
+        next_prune = 0.0
+        while not stopped.is_set():
+            try:
+                with self.engine.begin() as connection:
+                    if last_id is None:
+                        last_id = connection.execute(select(func.coalesce(func.max(InvalidationEvent.id), 0))).scalar()
+                        resync()
+                    rows = connection.execute(select(InvalidationEvent.id, InvalidationEvent.payload)
+                                              .where(InvalidationEvent.id > last_id)
+                                              .order_by(InvalidationEvent.id)).all()
+                    if time.monotonic() >= next_prune:
+                        connection.execute(delete(InvalidationEvent).where(
+                            InvalidationEvent.created_at < time.time() - EVENT_RETENTION_SECONDS))
+                        next_prune = time.monotonic() + EVENT_RETENTION_SECONDS / 10
+                for event_id, payload in rows:
+                    last_id = event_id
+                    receive(payload)
+            except Exception:
+                invalidation_logger.exception('Invalidation polling failed')
+                last_id = None
+            stopped.wait(self.interval)
+
+
+class InvalidationBus:
+    '''
+    Process level bus that keeps the in-process caches of every worker in step.
+
+    Each question or category change committed by this worker is published to the other workers. A background
+    thread receives their changes and runs the local change listeners with them, without publishing them again.
+    Events sent by this worker are recognised by its origin and skipped.
+    '''
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        self.transport = None
+        self.published = 0
+        self.received = 0
+        self.resyncs = 0
+        self.errors = 0
+        self._thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._batch = threading.local()
+
+    def configure(self, transport):
+        '''
+        Replaces the transport, stopping the listener of the previous one. The listener starts with start().
+        '''
+        self.stop()
+        with self._lock:
+            self.transport = transport
+            self.published = self.received = self.resyncs = self.errors = 0
+
+    @property
+    def started(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self.transport is None or self._thread is not None:
+                return
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self.transport.listen, name='invalidation-bus', daemon=True,
+                                            args=(self.receive, self.resync, self._stopped))
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stopped.set()
+        if thread is not None:
+            thread.join(timeout=5)
+
+    @contextmanager
+    def batched(self):
+        '''
+        Publishes the question changes made by this thread within the block as a single reload event, for changes
+        to many questions at once.
+        '''
+        if getattr(self._batch, 'changes', None) is not None:
+            yield
+            return
+        self._batch.changes = 0
+        try:
+            yield
+        finally:
+            changes, self._batch.changes = self._batch.changes, None
+            if changes > 0:
+                self.publish({'kind': 'question', 'action': 'reload'})
+
+    def publish_question(self, event: dict):
+        if getattr(self._batch, 'changes', None) is not None:
+            self._batch.changes += 1
+            return
+        self.publish(event)
+
+    def publish(self, event: dict):
+        if self.transport is None:
+            return
+        try:
+            self.transport.publish(self.origin, json.dumps(dict(event, origin=self.origin)))
+            self.published += 1
+        except Exception:
+            self.errors += 1
+            invalidation_logger.exception('Could not publish %s', event)
+
+    def receive(self, payload: str):
+        event = json.loads(payload)
+        if event.get('origin') == self.origin:
+            return
+        self.received += 1
+        self.apply(event)
+
+    def apply(self, event: dict):
+        '''
+        Runs the local change listeners, except the ones that publish, with a change made by another worker.
+        '''
+        if event['kind'] == 'category':
+            for listener in category_change_listeners:
+                if listener is not publish_category_change:
+                    listener()
+            return
+
+        question = QuestionChange(event['id'], event['category'], event['difficulty']) if 'id' in event else None
+        for listener in question_change_listeners:
+            if listener is not publish_question_change:
+                listener(event['action'], question)
+
+    def resync(self):
+        '''
+        Drops every in-process cache, for when events may have been missed.
+        '''
+        self.resyncs += 1
+        self.apply({'kind': 'question', 'action': 'reload'})
+        self.apply({'kind': 'category'})
+
+    def stats(self) -> dict:
+        return {
+            'transport': self.transport.name if self.transport is not None else None,
+            'listening': self.started and self._thread.is_alive(),
+            'published': self.published,
+            'received': self.received,
+            'resyncs': self.resyncs,
+            'errors': self.errors
+        }
+
+
+invalidation_bus = InvalidationBus()
+
+
+@on_question_change
+def publish_question_change(action, question):
+    event = {'kind': 'question', 'action': action}
+    if question is not None:
+        event.update(id=question.id, category=question.category, difficulty=question.difficulty)
+    invalidation_bus.publish_question(event)
+
+
+@on_category_change
+def publish_category_change():
+    invalidation_bus.publish({'kind': 'category'})
+
+
+def create_transport(config, engine):
+    '''
+    Returns the transport selected by INVALIDATION_BUS: postgres (LISTEN/NOTIFY), polling (the invalidation_events
+    table), off, or auto for postgres on Postgres and off otherwise.
+    '''
+    bus = config["INVALIDATION_BUS"]
+    if bus == 'auto':
+        bus = 'postgres' if engine.dialect.name == 'postgresql' else 'off'
+    if bus == 'postgres':
+        return PostgresNotifyTransport(engine)
+    if bus == 'polling':
+        return PollingTransport(engine, config["INVALIDATION_POLL_SECONDS"])
+    return None
+
+
+def init_invalidation_bus(app):
+    '''
+    Publishes this worker's changes to the other workers and starts listening to theirs with the first request.
+    '''
+    with app.app_context():
+        invalidation_bus.configure(create_transport(app.config, db.engine))
+
+    @app.before_request
+    def start_invalidation_bus():
+        if not invalidation_bus.started:
+            invalidation_bus.start()
@@ -0,0 +1,140 @@
+from sqlalchemy import Integer, MetaData, inspect, select, func, text, insert, cast
+
+from models import Question, Category, db, filter_indexes
+
+CATEGORY_FOREIGN_KEY = 'questions_category_fkey'
+
+
+def category_is_integer(engine) -> bool:
+    columns = {column['name']: column for column in inspect(engine).get_columns('questions')}
+    return isinstance(columns['category']['type'], Integer)
+
+
+def id_ranges(engine, batch_size):
+    '''
+    Yields (start, end) question id ranges of batch_size ids covering every question.
+    '''
+    with engine.connect() as connection:
+        low, high = connection.execute(select(func.min(Question.id), func.max(Question.id))).one()
+    if low is None:
+        return
+    for start in range(low, high + 1, batch_size):
+        yield start, start + batch_size
+
+
+def rewrite_category_postgres(engine, batch_size, echo):
+    '''
+    Converts questions.category to an integer without blocking the table for more than the final swap.
+
+    A new column is filled in batches of batch_size rows, each in its own transaction, while a trigger keeps it in
+    step with the rows written in the meantime. The old column is then dropped and the new one renamed in one short
+    transaction.
+    '''
+    with engine.begin() as connection:
+        connection.exec_driver_sql('ALTER TABLE questions ADD COLUMN IF NOT EXISTS category_new integer')
+        connection.exec_driver_sql(
+            "CREATE OR REPLACE FUNCTION questions_sync_category() RETURNS trigger AS $$ "
+            "BEGIN NEW.category_new := NULLIF(NEW.category, '')::integer; RETURN NEW; END $$ LANGUAGE plpgsql")
+        connection.exec_driver_sql('DROP TRIGGER IF EXISTS questions_sync_category ON questions')
+        connection.exec_driver_sql(
+            'CREATE TRIGGER questions_sync_category BEFORE INSERT OR UPDATE OF category ON questions '
+            'FOR EACH ROW EXECUTE FUNCTION questions_sync_category()')
+
+    backfill = text("UPDATE questions SET category_new = NULLIF(category, '')::integer "
+                    "WHERE id >= :start AND id < :end AND category_new IS NULL AND category IS NOT NULL")
+    for start, end in id_ranges(engine, batch_size):
+        with engine.begin() as connection:
+            updated = connection.execute(backfill, {'start': start, 'end': end}).rowcount
+        echo(f'Rewrote the category of questions {start} to {end - 1} ({updated} rows).')
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql('LOCK TABLE questions IN ACCESS EXCLUSIVE MODE')
+        connection.exec_driver_sql("UPDATE questions SET category_new = NULLIF(category, '')::integer "
+                                   "WHERE category_new IS NULL AND category IS NOT NULL")
+        connection.exec_driver_sql('DROP TRIGGER questions_sync_category ON questions')
+        connection.exec_driver_sql('DROP FUNCTION questions_sync_category()')
+        connection.exec_driver_sql('ALTER TABLE questions DROP COLUMN category')
+        connection.exec_driver_sql('ALTER TABLE questions RENAME COLUMN category_new TO category')
+    echo('Swapped in the integer category column.')
+
+
+def rewrite_category_by_copy(engine, batch_size, echo):
+    '''
+    Converts questions.category to an integer on databases that cannot change a column type (SQLite) by copying the
+    questions, batch_size rows per transaction, into a table built from the model and swapping it in.
+    '''
+    metadata = MetaData()
+    Category.__table__.to_metadata(metadata)
+    migrated = Question.__table__.to_metadata(metadata, name='questions_migrated')
+    for index in list(migrated.indexes):
+        migrated.indexes.discard(index)
+    with engine.begin() as connection:
+        migrated.drop(connection, checkfirst=True)
+        migrated.create(connection)
+
+    columns = [migrated.c[column.name] for column in Question.__table__.columns]
+    source = Question.__table__
+    for start, end in id_ranges(engine, batch_size):
+        rows = select(source.c.id, source.c.question, source.c.answer, cast(source.c.category, Integer),
+                      source.c.difficulty).where(source.c.id >= start, source.c.id < end)
+        with engine.begin() as connection:
+            copied = connection.execute(insert(migrated).from_select(columns, rows)).rowcount
+        echo(f'Copied questions {start} to {end - 1} ({copied} rows).')
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql('DROP TABLE questions')
+        connection.exec_driver_sql('ALTER TABLE questions_migrated RENAME TO questions')
+    echo('Swapped in the migrated questions table.')
+
+
+def add_category_foreign_key(engine, echo):
+    '''
+    Adds the categories foreign key on Postgres without a long lock: it is added NOT VALID and then validated, which
+    lets writes continue while the existing rows are checked.
+    '''
+    if engine.dialect.name != 'postgresql':
+        return
+    if any(key['referred_table'] == 'categories' for key in inspect(engine).get_foreign_keys('questions')):
+        return
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            f'ALTER TABLE questions ADD CONSTRAINT {CATEGORY_FOREIGN_KEY} FOREIGN KEY (category) '
+            'REFERENCES categories(id) ON UPDATE CASCADE ON DELETE SET NULL NOT VALID')
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f'ALTER TABLE questions VALIDATE CONSTRAINT {CATEGORY_FOREIGN_KEY}')
+    echo('Added the category foreign key.')
+
+
+def add_filter_indexes(engine, echo):
+    '''
+    Creates the category and difficulty indexes, CONCURRENTLY on Postgres so that writes are not blocked.
+    '''
+    existing = {index['name'] for index in inspect(engine).get_indexes('questions')}
+    for index in filter_indexes:
+        if index.name in existing:
+            continue
+        if engine.dialect.name == 'postgresql':
+            columns = ', '.join(column.name for column in index.columns)
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                connection.exec_driver_sql(
+                    f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON questions ({columns})')
+        else:
+            with engine.begin() as connection:
+                index.create(connection, checkfirst=True)
+        echo(f'Created the index {index.name}.')
+
+
+def migrate_question_category(batch_size=1000, echo=print):
+    '''
+    Migrates questions.category from a string to an integer foreign key to categories.id with indexes on category
+    and difficulty. Every step is skipped when it is already done, so the migration can be run again after it was
+    interrupted.
+    '''
+    engine = db.engine
+    if not category_is_integer(engine):
+        if engine.dialect.name == 'postgresql':
+            rewrite_category_postgres(engine, batch_size, echo)
+        else:
+            rewrite_category_by_copy(engine, batch_size, echo)
+    add_category_foreign_key(engine, echo)
+    add_filter_indexes(engine, echo)
@@ -0,0 +1,278 @@
+import random
+import threading
+
+from sqlalchemy import select, func
+
+from models import Question, db, on_question_change, question_columns
+
+
+MAX_QUIZ_QUESTIONS = 50
+
+
+def parse_difficulty_mix(value) -> dict:
+    '''
+    Parses a difficulty mix such as "1:2,3:1" (two questions of difficulty 1 and one of difficulty 3) into a
+    {difficulty: number} dict. Raises ValueError when it is malformed.
+    '''
+    mix = {}
+    for part in value.split(','):
+        difficulty, separator, number = part.partition(':')
+        if separator == '' or int(number) < 1 or int(difficulty) in mix:
+            raise ValueError(f'invalid difficulty mix entry {part!r}')
+        mix[int(difficulty)] = int(number)
+    return mix
+
+
+def category_key(category):
+    '''
+    Returns the category of a question as the integer used to key the index.
+    '''
+    try:
+        return int(category)
+    except (TypeError, ValueError):
+        return None
+
+
+def sample_id(ids, excluded, max_attempts=32):
+    '''
+    Returns a random id of ids that is not in excluded, or None when there is none. A few ids are drawn at random
+    before falling back to a scan, so the cost does not depend on the number of ids until most are excluded.
+    '''
+    if not ids:
+        return None
+
+    for attempt in range(max_attempts):
+        try:
+            question_id = random.choice(ids)
+        except IndexError:
+            return None
+        if question_id not in excluded:
+            return question_id
+
+    # Most of the ids have been excluded, pick among what is left.
+    candidates = [question_id for question_id in ids if question_id not in excluded]
+    if len(candidates) == 0:
+        return None
+    return random.choice(candidates)
+
+
+def index_keys(category, difficulty) -> list:
+    '''
+    Returns the keys of the id lists a question belongs to: every question, its category, its difficulty, and its
+    category and difficulty. None stands for any category or any difficulty.
+    '''
+    return list(dict.fromkeys([(None, None), (category, None), (None, difficulty), (category, difficulty)]))
+
+
+def sample_quiz_ids(ids_for, count, difficulty_mix=None, excluded=frozenset(), max_attempts=32) -> list:
+    '''
+    Returns up to count distinct random ids that are not in excluded, in random order. difficulty_mix ({difficulty:
+    number}) asks for that many ids of each difficulty, and the rest of count is drawn from every difficulty.
+    ids_for(difficulty) returns the ids to draw from for a difficulty, or for every difficulty when it is None.
+    '''
+    difficulty_mix = difficulty_mix or {}
+    unavailable = set(excluded)
+    picked = []
+    for difficulty, wanted in list(difficulty_mix.items()) + [(None, count - sum(difficulty_mix.values()))]:
+        ids = ids_for(difficulty)
+        for pick in range(wanted):
+            question_id = sample_id(ids, unavailable, max_attempts)
+            if question_id is None:
+                break
+            unavailable.add(question_id)
+            picked.append(question_id)
+    random.shuffle(picked)
+    return picked
+
+
+class QuestionSelector:
+    '''
+    Picks random quiz questions from an in-memory index of question ids per category, per difficulty and per
+    category and difficulty.
+
+    A pick samples an id that is not excluded and fetches only that row, so the cost of a pick does not depend on
+    the size of the category. Several questions are sampled together and fetched in one query. While the index is
+    cold, a single question is picked in the database with a random offset over a count of the candidates. Changes
+    notified while the index is being built are recorded and applied to it once it is built.
+    '''
+
+    def __init__(self, max_attempts=32):
+        self.max_attempts = max_attempts
+        self._ids = None
+        self._positions = None
+        self._pending = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+
+    @property
+    def is_warm(self) -> bool:
+        return self._ids is not None
+
+    def reset(self):
+        '''
+        Drops the index. It is rebuilt by the next pick.
+        '''
+        with self._lock:
+            self._ids = None
+            self._positions = None
+            self._generation += 1
+            if self._pending is not None:
+                self._pending.clear()
+
+    def warm(self):
+        '''
+        Builds the index from the ids, categories and difficulties of every question unless it is already built.
+        Concurrent calls wait for a single build.
+        '''
+        while not self.is_warm:
+            with self._warm_lock:
+                if not self.is_warm:
+                    self._build()
+
+    def _build(self):
+        with self._lock:
+            # Changes committed before this point are in the rows read below, later ones are recorded and applied
+            # once the index is built.
+            self._pending = []
+            generation = self._generation
+        try:
+            # Read from the primary database so that the index holds the writes already notified.
+            with db.engine.connect() as connection:
+                rows = connection.execute(select(Question.id, Question.category, Question.difficulty)
+                                          .order_by(Question.id)).all()
+            ids = {(None, None): []}
+            positions = {(None, None): {}}
+            for question_id, category, difficulty in rows:
+                for key in index_keys(category_key(category), difficulty):
+                    ids.setdefault(key, [])
+                    positions.setdefault(key, {})
+                    positions[key][question_id] = len(ids[key])
+                    ids[key].append(question_id)
+            with self._lock:
+                # A reset while the questions were read leaves the index to be built again.
+                if generation != self._generation:
+                    return
+                self._ids = ids
+                self._positions = positions
+                for change in self._pending:
+                    if len(change) == 3:
+                        self._add(*change)
+                    else:
+                        self._remove(*change)
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def add(self, question_id, category, difficulty=None):
+        with self._lock:
+            if self._ids is None:
+                if self._pending is not None:
+                    self._pending.append((question_id, category, difficulty))
+                return
+            self._add(question_id, category, difficulty)
+
+    def remove(self, question_id):
+        with self._lock:
+            if self._ids is None:
+                if self._pending is not None:
+                    self._pending.append((question_id,))
+                return
+            self._remove(question_id)
+
+    def _add(self, question_id, category, difficulty):
+        for key in index_keys(category_key(category), difficulty):
+            positions = self._positions.setdefault(key, {})
+            if question_id in positions:
+                continue
+            ids = self._ids.setdefault(key, [])
+            positions[question_id] = len(ids)
+            ids.append(question_id)
+
+    def _remove(self, question_id):
+        for key, positions in self._positions.items():
+            index = positions.pop(question_id, None)
+            if index is None:
+                continue
+            ids = self._ids[key]
+            last_id = ids.pop()
+            if last_id != question_id:
+                ids[index] = last_id
+                positions[last_id] = index
+
+    def select(self, category_id=None, excluded=frozenset()):
+        '''
+        Returns a random question row (see question_columns) in the category (any category when category_id is None)
+        whose id is not in excluded, or None when there is no such question.
+        '''
+        if not self.is_warm:
+            question = self._select_from_database(category_id, excluded)
+            self.warm()
+            return question
+
+        while True:
+            question_id = self._sample(category_id, excluded)
+            if question_id is None:
+                return None
+            question = db.session.execute(select(*question_columns).where(Question.id == question_id)).first()
+            if question is not None:
+                return question
+            # The question was deleted by another process, forget it and pick again.
+            self.remove(question_id)
+
+    def select_many(self, category_id=None, count=1, difficulty_mix=None, excluded=frozenset()) -> list:
+        '''
+        Returns up to count distinct random question rows in the category whose ids are not in excluded, with the
+        number of questions of each difficulty in difficulty_mix (see sample_quiz_ids). The rows are read with one
+        query.
+        '''
+        if not self.is_warm:
+            self.warm()
+
+        while True:
+            question_ids = sample_quiz_ids(lambda difficulty: self._ids.get((category_id, difficulty)), count,
+                                           difficulty_mix, excluded, self.max_attempts)
+            if len(question_ids) == 0:
+                return []
+            rows = {row[0]: row for row in
+                    db.session.execute(select(*question_columns).where(Question.id.in_(question_ids)))}
+            if len(rows) == len(question_ids):
+                return [rows[question_id] for question_id in question_ids]
+            # Some questions were deleted by another process, forget them and pick again.
+            for question_id in question_ids:
+                if question_id not in rows:
+                    self.remove(question_id)
+
+    def _sample(self, category_id, excluded):
+        return sample_id(self._ids.get((category_id, None)), excluded, self.max_attempts)
+
+    def _select_from_database(self, category_id, excluded):
+        criteria = []
+        if category_id is not None:
+            criteria.append(Question.category == category_id)
+        if len(excluded) > 0:
+            criteria.append(Question.id.not_in(list(excluded)))
+
+        candidate_count = db.session.execute(select(func.count(Question.id)).where(*criteria)).scalar()
+        if candidate_count == 0:
+            return None
+
+        statement = select(*question_columns).where(*criteria).order_by(Question.id) \
+            .offset(random.randrange(candidate_count)).limit(1)
+        return db.session.execute(statement).first()
+
+
+question_selector = QuestionSelector()
+
+
+@on_question_change
+def update_question_selector(action, question):
+    if action == 'insert':
+        question_selector.add(question.id, question.category, question.difficulty)
+    elif action == 'update':
+        question_selector.remove(question.id)
+        question_selector.add(question.id, question.category, question.difficulty)
+    elif action == 'delete':
+        question_selector.remove(question.id)
+    else:
+        question_selector.reset()
@@ -0,0 +1,205 @@
+import bisect
+import secrets
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+SPARSE = 0
+BITMAP = 1
+
+# Seconds a Redis session lock is held at most, and waited for at most.
+LOCK_TIMEOUT = 5
+
+
+class SeenQuestions:
+    '''
+    Compact set of question ids already served in a quiz session.
+
+    Ids are kept in a sorted array while there are few of them and in a bitmap once that is smaller, so membership
+    costs at most O(log n) and the memory used never exceeds one bit per question id.
+    '''
+
+    def __init__(self):
+        self._ids = array('I')
+        self._bitmap = None
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, question_id) -> bool:
+        if question_id < 0:
+            return False
+        if self._bitmap is not None:
+            byte = question_id >> 3
+            return byte < len(self._bitmap) and bool(self._bitmap[byte] & (1 << (question_id & 7)))
+        index = bisect.bisect_left(self._ids, question_id)
+        return index < len(self._ids) and self._ids[index] == question_id
+
+    def __iter__(self):
+        if self._bitmap is None:
+            return iter(self._ids)
+        return (byte * 8 + bit for byte, value in enumerate(self._bitmap) if value
+                for bit in range(8) if value & (1 << bit))
+
+    def add(self, question_id):
+        if question_id in self:
+            return
+        self._count += 1
+        if self._bitmap is not None:
+            self._set_bit(question_id)
+            return
+        bisect.insort(self._ids, question_id)
+        if len(self._ids) * self._ids.itemsize > (self._ids[-1] >> 3) + 1:
+            self._to_bitmap()
+
+    def _set_bit(self, question_id):
+        byte = question_id >> 3
+        if byte >= len(self._bitmap):
+            self._bitmap.extend(bytes(byte + 1 - len(self._bitmap)))
+        self._bitmap[byte] |= 1 << (question_id & 7)
+
+    def _to_bitmap(self):
+        self._bitmap = bytearray((self._ids[-1] >> 3) + 1)
+        for question_id in self._ids:
+            self._set_bit(question_id)
+        self._ids = array('I')
+
+    def to_bytes(self) -> bytes:
+        if self._bitmap is not None:
+            return bytes([BITMAP]) + struct.pack('<I', self._count) + bytes(self._bitmap)
+        return bytes([SPARSE]) + self._ids.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        seen = cls()
+        if data[0] == BITMAP:
+            seen._count = struct.unpack('<I', data[1:5])[0]
+            seen._bitmap = bytearray(data[5:])
+        else:
+            seen._ids.frombytes(data[1:])
+            seen._count = len(seen._ids)
+        return seen
+
+
+class QuizSession:
+    '''
+    A quiz in progress: its category (None for every category) and the questions it has served.
+    '''
+
+    def __init__(self, token, category_id=None, seen=None):
+        self.token = token
+        self.category_id = category_id
+        self.seen = seen if seen is not None else SeenQuestions()
+
+    def to_bytes(self) -> bytes:
+        return struct.pack('<i', self.category_id if self.category_id is not None else -1) + self.seen.to_bytes()
+
+    @classmethod
+    def from_bytes(cls, token, data: bytes):
+        category_id = struct.unpack('<i', data[:4])[0]
+        return cls(token, None if category_id < 0 else category_id, SeenQuestions.from_bytes(data[4:]))
+
+
+class InMemoryQuizSessionStore:
+    '''
+    Process level quiz session store. Sessions expire ttl seconds after they were last used, and the least recently
+    used sessions are evicted once there are more than max_sessions.
+
+    Sessions are kept in the order of their last use, which is also the order in which they expire, so expired
+    sessions are dropped from the front as they are met.
+    '''
+
+    def __init__(self, ttl=3600, max_sessions=10000, lock_stripes=64):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.evictions = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._token_locks = [threading.Lock() for stripe in range(lock_stripes)]
+
+    def _drop_expired(self, now):
+        while len(self._sessions) > 0:
+            token, (session, expires_at) = next(iter(self._sessions.items()))
+            if expires_at > now:
+                return
+            del self._sessions[token]
+
+    def locked(self, token):
+        '''
+        Returns a lock that serializes the requests that read and update the session of token.
+        '''
+        return self._token_locks[hash(token) % len(self._token_locks)]
+
+    def get(self, token):
+        now = time.monotonic()
+        with self._lock:
+            self._drop_expired(now)
+            entry = self._sessions.get(token)
+            if entry is None:
+                return None
+            return entry[0]
+
+    def put(self, session):
+        now = time.monotonic()
+        with self._lock:
+            self._drop_expired(now)
+            self._sessions[session.token] = (session, now + self.ttl)
+            self._sessions.move_to_end(session.token)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, token) -> bool:
+        with self._lock:
+            return self._sessions.pop(token, None) is not None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class RedisQuizSessionStore:
+    '''
+    Quiz session store shared by every worker, for any client with the redis-py get/set/delete interface.
+    Sessions are stored in their compact binary form and expire through the Redis key TTL.
+    '''
+
+    def __init__(self, client, ttl=3600, prefix='trivia:quiz:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, token):
+        data = self.client.get(self.prefix + token)
+        if data is None:
+            return None
+        return QuizSession.from_bytes(token, data)
+
+    def put(self, session):
+        self.client.set(self.prefix + session.token, session.to_bytes(), ex=int(self.ttl))
+
+    def delete(self, token) -> bool:
+        return bool(self.client.delete(self.prefix + token))
+
+    def locked(self, token):
+        '''
+        Returns a Redis lock that serializes the requests of every worker that read and update the session of token.
+        '''
+        return self.client.lock(self.prefix + token + ':lock', timeout=LOCK_TIMEOUT, blocking_timeout=LOCK_TIMEOUT)
+
+
+def new_session_token() -> str:
+    return secrets.token_urlsafe(16)
+
+
+def create_quiz_session_store(config):
+    '''
+    Returns the store for QUIZ_SESSION_REDIS_URL when it is set (this needs the redis package), the in-memory store
+    of at most QUIZ_SESSION_MAX_SESSIONS sessions otherwise.
+    '''
+    if config["QUIZ_SESSION_REDIS_URL"]:
+        import redis
+        return RedisQuizSessionStore(redis.Redis.from_url(config["QUIZ_SESSION_REDIS_URL"]), config["QUIZ_SESSION_TTL"])
+    return InMemoryQuizSessionStore(config["QUIZ_SESSION_TTL"], config["QUIZ_SESSION_MAX_SESSIONS"])
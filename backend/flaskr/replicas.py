@@ -0,0 +1,147 @@
+import itertools
+import threading
+import time
+
+from flask import g, request, has_request_context
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import RoutingSession, db, engine_options
+
+STICKY_COOKIE = 'trivia_primary_until'
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+class ReplicaRouter:
+    '''
+    Process level router that sends the reads of GET requests to read replicas.
+
+    Replicas are tried in round-robin order. A replica that fails to connect, or whose connection is lost, is skipped
+    for retry_seconds and the request moves on to the next one, or to the primary when none is left. After a write a
+    client reads from the primary for sticky_seconds so that it sees its own change.
+    '''
+
+    def __init__(self):
+        self.engines = []
+        self.retry_seconds = 30
+        self.sticky_seconds = 5
+        self.reads = []
+        self.primary_reads = 0
+        self.failovers = 0
+        self._unhealthy_until = []
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def configure(self, uris, config, retry_seconds=30, sticky_seconds=5):
+        '''
+        Replaces the replica engines with engines for uris, built with the same options as the primary.
+        '''
+        self.dispose()
+        engines = [create_engine(uri, **engine_options(uri, config)) for uri in uris]
+        for index, engine in enumerate(engines):
+            event.listen(engine, 'handle_error', self._error_handler(index))
+        with self._lock:
+            self.engines = engines
+            self.reads = [0] * len(engines)
+            self.primary_reads = 0
+            self.failovers = 0
+            self._unhealthy_until = [0.0] * len(engines)
+            self.retry_seconds = retry_seconds
+            self.sticky_seconds = sticky_seconds
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = []
+
+    def _error_handler(self, index):
+        def mark_unhealthy_on_disconnect(exception_context):
+            if exception_context.is_disconnect:
+                self.mark_unhealthy(index)
+        return mark_unhealthy_on_disconnect
+
+    def mark_unhealthy(self, index):
+        with self._lock:
+            self._unhealthy_until[index] = time.monotonic() + self.retry_seconds
+
+    def is_healthy(self, index) -> bool:
+        return time.monotonic() >= self._unhealthy_until[index]
+
+    def connect(self):
+        '''
+        Returns (index, connection) for the next healthy replica that accepts a connection, or None.
+        '''
+        count = len(self.engines)
+        start = next(self._next) % count
+        for index in [(start + offset) % count for offset in range(count)]:
+            if not self.is_healthy(index):
+                continue
+            try:
+                return index, self.engines[index].connect()
+            except SQLAlchemyError:
+                self.mark_unhealthy(index)
+                with self._lock:
+                    self.failovers += 1
+        return None
+
+    def record_read(self, index):
+        with self._lock:
+            if index is None:
+                self.primary_reads += 1
+            else:
+                self.reads[index] += 1
+
+    def read_connection(self):
+        '''
+        Returns the replica connection of the current GET request, or None to use the primary.
+
+        The replica is chosen by the first read of the request, so that requests answered without a query (metrics,
+        cached responses, in-memory indexes) never check out a replica connection.
+        '''
+        if not has_request_context() or len(self.engines) == 0 or request.method not in ('GET', 'HEAD'):
+            return None
+        if 'replica_chosen' not in g:
+            g.replica_chosen = True
+            primary_until = request.cookies.get(STICKY_COOKIE, 0, type=float)
+            chosen = self.connect() if primary_until < time.time() else None
+            if chosen is None:
+                self.record_read(None)
+            else:
+                self.record_read(chosen[0])
+                g.replica_connection = chosen[1]
+        return g.get('replica_connection')
+
+    def stats(self) -> dict:
+        return {
+            'replicas': [{'reads': reads, 'healthy': self.is_healthy(index)} for index, reads in enumerate(self.reads)],
+            'primary_reads': self.primary_reads,
+            'failovers': self.failovers
+        }
+
+
+replica_router = ReplicaRouter()
+RoutingSession.router = replica_router
+
+
+def init_read_replicas(app):
+    '''
+    Routes the reads of GET requests to the replicas in DB_REPLICA_URIS and keeps writes, and the reads that follow
+    them from the same client, on the primary.
+    '''
+    replica_router.configure(app.config["DB_REPLICA_URIS"], app.config,
+                             app.config["REPLICA_RETRY_SECONDS"], app.config["REPLICA_STICKY_SECONDS"])
+
+    @app.after_request
+    def stick_to_primary_after_write(response):
+        if len(replica_router.engines) > 0 and request.method in WRITE_METHODS and response.status_code < 400 \
+                and replica_router.sticky_seconds > 0:
+            response.set_cookie(STICKY_COOKIE, str(time.time() + replica_router.sticky_seconds),
+                                max_age=int(replica_router.sticky_seconds), httponly=True, samesite='Lax')
+        return response
+
+    @app.teardown_request
+    def release_read_replica(exception):
+        connection = g.pop('replica_connection', None)
+        if connection is not None:
+            db.session.close()
+            connection.close()
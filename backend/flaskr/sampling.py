@@ -0,0 +1,345 @@
+import math
+import random
+import threading
+
+from sqlalchemy import select
+
+from models import Question, db, on_question_change
+from flaskr.quiz import category_key
+
+MAX_CACHED_TABLES = 256
+
+
+def parse_difficulty_weights(value) -> dict:
+    '''
+    Parses difficulty weights such as "1:1,3:2.5" into a {difficulty: weight} dict. Difficulties that are not listed
+    are never picked. Raises ValueError when the weights are malformed or all zero.
+    '''
+    weights = {}
+    for part in value.split(','):
+        difficulty, separator, weight = part.partition(':')
+        if separator == '' or not math.isfinite(float(weight)) or float(weight) < 0 or int(difficulty) in weights:
+            raise ValueError(f'invalid difficulty weight {part!r}')
+        weights[int(difficulty)] = float(weight)
+    if sum(weights.values()) <= 0:
+        raise ValueError('at least one difficulty weight must be positive')
+    return weights
+
+
+def rarity_bucket(served: int) -> int:
+    '''
+    Returns the bucket k of a question served served times, whose rarity weight 1 / (1 + served) is in
+    (2 ** -(k + 1), 2 ** -k].
+    '''
+    return (served + 1).bit_length() - 1
+
+
+class AliasTable:
+    '''
+    Vose's alias table over a list of weights: built in O(n), then each draw returns index i with probability
+    weights[i] / sum(weights) in O(1).
+    '''
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = float(sum(weights))
+        if count == 0 or total <= 0:
+            raise ValueError('an alias table needs a positive total weight')
+        self.probability = [1.0] * count
+        self.alias = list(range(count))
+
+        scaled = [weight * count / total for weight in weights]
+        small = [index for index, weight in enumerate(scaled) if weight < 1.0]
+        large = [index for index, weight in enumerate(scaled) if weight >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1.0
+            (small if scaled[more] < 1.0 else large).append(more)
+        # What is left is 1 up to rounding errors.
+
+    def __len__(self) -> int:
+        return len(self.probability)
+
+    def draw(self) -> int:
+        index = random.randrange(len(self.probability))
+        return index if random.random() < self.probability[index] else self.alias[index]
+
+
+class IdGroup:
+    '''
+    The ids of the questions of one category, difficulty and rarity bucket, with O(1) add, remove and random pick.
+    '''
+
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, question_id):
+        if question_id not in self.positions:
+            self.positions[question_id] = len(self.ids)
+            self.ids.append(question_id)
+
+    def remove(self, question_id):
+        index = self.positions.pop(question_id)
+        last_id = self.ids.pop()
+        if last_id != question_id:
+            self.ids[index] = last_id
+            self.positions[last_id] = index
+
+
+class WeightedSampler:
+    '''
+    Picks random quiz questions weighted by difficulty (a {difficulty: weight} curve given with each request), by
+    rarity (1 / (1 + the number of times this worker served the question)), or both.
+
+    The questions of each category are grouped by difficulty and rarity bucket. A draw picks a group with an alias
+    table over the groups, weighted by the group size times the largest weight in the group, then a random question
+    of the group, which is kept with probability its weight over that largest weight (at least 1/2). Draws are O(1)
+    whatever the size of the category. Alias tables are cached per category and weighting; adding, deleting or
+    serving a question moves it between groups in O(1) and only rebuilds the tables of its categories, whose size is
+    the number of groups rather than of questions. Changes notified while the groups are being built are recorded
+    and applied to them once they are built.
+    '''
+
+    def __init__(self, max_attempts=32):
+        self.max_attempts = max_attempts
+        self.tables_built = 0
+        self.table_hits = 0
+        self._groups = None
+        self._entries = {}
+        self._served = {}
+        self._versions = {}
+        self._tables = {}
+        self._pending = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+
+    @property
+    def is_warm(self) -> bool:
+        return self._groups is not None
+
+    def reset(self, forget_served=False):
+        '''
+        Drops the groups and tables. They are rebuilt by the next draw. The serve counts are kept unless
+        forget_served is set.
+        '''
+        with self._lock:
+            self._groups = None
+            self._entries = {}
+            self._tables = {}
+            self._generation += 1
+            if self._pending is not None:
+                self._pending.clear()
+            if forget_served:
+                self._served = {}
+                self.tables_built = self.table_hits = 0
+
+    def warm(self):
+        '''
+        Groups the ids of every question by category, difficulty and rarity bucket unless they are already grouped.
+        Concurrent calls wait for a single build.
+        '''
+        while not self.is_warm:
+            with self._warm_lock:
+                if not self.is_warm:
+                    self._build()
+
+    def _build(self):
+        with self._lock:
+            # Changes committed before this point are in the rows read below, later ones are recorded and applied
+            # once the groups are built.
+            self._pending = []
+            generation = self._generation
+        try:
+            # Read from the primary database so that the groups hold the writes already notified.
+            with db.engine.connect() as connection:
+                rows = connection.execute(select(Question.id, Question.category, Question.difficulty)).all()
+            with self._lock:
+                # A reset while the questions were read leaves the groups to be built again.
+                if generation != self._generation:
+                    return
+                self._groups = {}
+                self._entries = {}
+                self._tables = {}
+                for question_id, category, difficulty in rows:
+                    self._add(question_id, category_key(category), difficulty)
+                for change in self._pending:
+                    self._remove(change[0])
+                    if len(change) == 3:
+                        self._add(change[0], category_key(change[1]), change[2])
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def _group_keys(self, question_id):
+        category, difficulty = self._entries[question_id]
+        bucket = rarity_bucket(self._served.get(question_id, 0))
+        return [(key, (difficulty, bucket)) for key in dict.fromkeys((None, category))]
+
+    def _add(self, question_id, category, difficulty):
+        self._entries[question_id] = (category, difficulty)
+        for key, group in self._group_keys(question_id):
+            self._groups.setdefault(key, {}).setdefault(group, IdGroup()).add(question_id)
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+    def _remove(self, question_id):
+        if question_id not in self._entries:
+            return
+        for key, group in self._group_keys(question_id):
+            groups = self._groups[key]
+            groups[group].remove(question_id)
+            if len(groups[group]) == 0:
+                del groups[group]
+            self._versions[key] = self._versions.get(key, 0) + 1
+        del self._entries[question_id]
+
+    def add(self, question_id, category, difficulty):
+        with self._lock:
+            if self._groups is None:
+                if self._pending is not None:
+                    self._pending.append((question_id, category, difficulty))
+                return
+            self._remove(question_id)
+            self._add(question_id, category_key(category), difficulty)
+
+    def remove(self, question_id):
+        with self._lock:
+            if self._groups is None:
+                self._served.pop(question_id, None)
+                if self._pending is not None:
+                    self._pending.append((question_id,))
+                return
+            self._remove(question_id)
+            self._served.pop(question_id, None)
+
+    def record_served(self, question_ids):
+        '''
+        Counts a serve of each question, moving it to the next rarity bucket when its weight halves.
+        '''
+        with self._lock:
+            for question_id in question_ids:
+                served = self._served.get(question_id, 0)
+                entry = self._entries.get(question_id) if self._groups is not None else None
+                moves = entry is not None and rarity_bucket(served) != rarity_bucket(served + 1)
+                if moves:
+                    self._remove(question_id)
+                self._served[question_id] = served + 1
+                if moves:
+                    self._add(question_id, *entry)
+
+    def _table(self, category_id, difficulty_weights, rarity):
+        '''
+        Returns the groups of the category with a positive weight and the alias table over them, from the cache
+        while the category has not changed.
+        '''
+        weights_key = tuple(sorted(difficulty_weights.items())) if difficulty_weights is not None else None
+        cache_key = (category_id, weights_key, rarity)
+        version = self._versions.get(category_id, 0)
+        cached = self._tables.get(cache_key)
+        if cached is not None and cached[0] == version:
+            self.table_hits += 1
+            return cached[1], cached[2]
+
+        groups = []
+        weights = []
+        for (difficulty, bucket), group in self._groups.get(category_id, {}).items():
+            weight = len(group)
+            if difficulty_weights is not None:
+                weight *= difficulty_weights.get(difficulty, 0.0)
+            if rarity:
+                weight *= 2.0 ** -bucket
+            if weight > 0:
+                groups.append(group)
+                weights.append(weight)
+        table = AliasTable(weights) if len(weights) > 0 else None
+
+        if len(self._tables) >= MAX_CACHED_TABLES:
+            self._tables.clear()
+        self._tables[cache_key] = (version, groups, table)
+        self.tables_built += 1
+        return groups, table
+
+    def _weight(self, question_id, difficulty_weights, rarity) -> float:
+        weight = 1.0
+        if difficulty_weights is not None:
+            weight *= difficulty_weights.get(self._entries[question_id][1], 0.0)
+        if rarity:
+            weight /= 1 + self._served.get(question_id, 0)
+        return weight
+
+    def _draw(self, category_id, difficulty_weights, rarity, unavailable):
+        groups, table = self._table(category_id, difficulty_weights, rarity)
+        if table is None:
+            return None
+
+        for attempt in range(self.max_attempts):
+            group = groups[table.draw()]
+            question_id = group.ids[random.randrange(len(group))]
+            if rarity:
+                bucket = rarity_bucket(self._served.get(question_id, 0))
+                if random.random() >= 2.0 ** bucket / (1 + self._served.get(question_id, 0)):
+                    continue
+            if question_id not in unavailable:
+                return question_id
+
+        # Most of the category has been excluded, draw among what is left.
+        candidates = [question_id for group in groups for question_id in group.ids if question_id not in unavailable]
+        weights = [self._weight(question_id, difficulty_weights, rarity) for question_id in candidates]
+        if sum(weights) <= 0:
+            return None
+        return random.choices(candidates, weights)[0]
+
+    def draw_many(self, category_id=None, count=1, difficulty_mix=None, difficulty_weights=None, rarity=False,
+                  excluded=frozenset()) -> list:
+        '''
+        Returns up to count distinct weighted random question ids in the category that are not in excluded, in
+        random order. difficulty_mix ({difficulty: number}) asks for that many questions of each difficulty, weighted
+        by rarity within the difficulty, and the rest of count is drawn with difficulty_weights.
+        '''
+        if not self.is_warm:
+            self.warm()
+
+        difficulty_mix = difficulty_mix or {}
+        unavailable = set(excluded)
+        picked = []
+        with self._lock:
+            strata = [({difficulty: 1.0}, wanted) for difficulty, wanted in difficulty_mix.items()]
+            strata.append((difficulty_weights, count - sum(difficulty_mix.values())))
+            for weights, wanted in strata:
+                for pick in range(wanted):
+                    question_id = self._draw(category_id, weights, rarity, unavailable)
+                    if question_id is None:
+                        break
+                    unavailable.add(question_id)
+                    picked.append(question_id)
+        random.shuffle(picked)
+        return picked
+
+    def stats(self) -> dict:
+        lookups = self.tables_built + self.table_hits
+        return {
+            'warm': self.is_warm,
+            'served_questions': len(self._served),
+            'tables_built': self.tables_built,
+            'table_hits': self.table_hits,
+            'table_hit_rate': self.table_hits / lookups if lookups else 0.0
+        }
+
+
+weighted_sampler = WeightedSampler()
+
+
+@on_question_change
+def update_weighted_sampler(action, question):
+    if action in ('insert', 'update'):
+        weighted_sampler.add(question.id, question.category, question.difficulty)
+    elif action == 'delete':
+        weighted_sampler.remove(question.id)
+    else:
+        weighted_sampler.reset()
@@ -0,0 +1,59 @@
+from sqlalchemy import case, func, or_
+
+from models import Question, db, question_search_document, search_language
+
+
+class PortableSearch:
+    '''
+    Case insensitive substring search on the question and answer text that works on every database.
+
+    Questions that match in the question text rank before those that only match in the answer.
+    '''
+
+    def criteria(self, term):
+        return or_(
+            Question.question.icontains(term, autoescape=True),
+            Question.answer.icontains(term, autoescape=True)
+        )
+
+    def rank(self, term) -> list:
+        return [case((Question.question.icontains(term, autoescape=True), 0), else_=1)]
+
+
+class PostgresSearch(PortableSearch):
+    '''
+    Search backed by the GIN indexes on questions: a full-text match on the question and answer text, an indexed
+    ILIKE through pg_trgm, and optionally a trigram word similarity match for misspelled terms.
+
+    Results are ranked by full-text rank and then by similarity to the question text.
+    '''
+
+    def __init__(self, trigram=True):
+        self.trigram = trigram
+
+    def _query(self, term):
+        return func.plainto_tsquery(search_language, term)
+
+    def criteria(self, term):
+        matches = [
+            question_search_document.op('@@', is_comparison=True)(self._query(term)),
+            super().criteria(term)
+        ]
+        if self.trigram:
+            matches.append(Question.question.op('%>', is_comparison=True)(term))
+        return or_(*matches)
+
+    def rank(self, term) -> list:
+        ranking = [func.ts_rank(question_search_document, self._query(term)).desc()]
+        if self.trigram:
+            ranking.append(func.word_similarity(term, Question.question).desc())
+        return ranking
+
+
+def search_backend(trigram=True):
+    '''
+    Returns the search backend for the database the session is bound to.
+    '''
+    if db.engine.dialect.name == 'postgresql':
+        return PostgresSearch(trigram=trigram)
+    return PortableSearch()
@@ -0,0 +1,107 @@
+import json
+import re
+import time
+
+from flask.json.provider import DefaultJSONProvider
+
+from flaskr.instrumentation import record_json_time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The characters json.dumps(ensure_ascii=True) escapes that orjson writes as they are.
+NON_ASCII = re.compile('[^\x00-\x7e]')
+
+
+def escape_non_ascii(text: str) -> str:
+    '''
+    Writes the non ASCII characters and DEL of JSON text as \\u escapes, with surrogate pairs beyond the BMP, like
+    json.dumps(ensure_ascii=True).
+    '''
+    def escape(match):
+        code = ord(match.group())
+        if code > 0xffff:
+            code -= 0x10000
+            return '\\u{:04x}\\u{:04x}'.format(0xd800 | (code >> 10), 0xdc00 | (code & 0x3ff))
+        return '\\u{:04x}'.format(code)
+    return NON_ASCII.sub(escape, text)
+
+
+def json_key(key) -> str:
+    '''
+    Returns a dict key as json.dumps writes it.
+    '''
+    if isinstance(key, str):
+        return key
+    if isinstance(key, int) and not isinstance(key, bool):
+        return int.__repr__(key)
+    return json.dumps(key)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    '''
+    JSON provider backed by orjson, which serializes the list responses several times faster than the standard
+    library. Responses are the ones of the default provider: keys sorted (integer keys as numbers) and written as
+    strings, non ASCII characters escaped, and indented in debug mode. The one difference is floats below 1e-4 or
+    from 1e16, which orjson writes as 0.000025 or 1e16 where the standard library writes 2.5e-05 or 1e+16.
+    '''
+
+    def _dumps_compact(self, obj) -> bytes:
+        '''
+        Serializes obj with orjson. The containers that hold dicts with non string keys are written piece by piece,
+        since orjson would sort those keys as strings (1, 10, 2) where the standard library sorts them by value.
+        '''
+        try:
+            return orjson.dumps(obj, default=self.default, option=orjson.OPT_SORT_KEYS if self.sort_keys else 0)
+        except TypeError:
+            if isinstance(obj, dict):
+                items = sorted(obj.items()) if self.sort_keys else obj.items()
+                return b'{' + b','.join(orjson.dumps(json_key(key)) + b':' + self._dumps_compact(value)
+                                        for key, value in items) + b'}'
+            if isinstance(obj, (list, tuple)):
+                return b'[' + b','.join(self._dumps_compact(value) for value in obj) + b']'
+            raise
+
+    def _dumps_bytes(self, obj, indent=False) -> bytes:
+        started = time.perf_counter()
+        try:
+            if not indent:
+                data = self._dumps_compact(obj)
+            else:
+                option = orjson.OPT_INDENT_2 | (orjson.OPT_SORT_KEYS if self.sort_keys else 0)
+                try:
+                    data = orjson.dumps(obj, default=self.default, option=option)
+                except TypeError:
+                    # Indented output is only used in debug mode, so the standard library writes non string keys.
+                    return super().dumps(obj, indent=2).encode()
+            if self.ensure_ascii and (not data.isascii() or b'\x7f' in data):
+                data = escape_non_ascii(data.decode()).encode()
+            return data
+        finally:
+            record_json_time(time.perf_counter() - started)
+
+    def dumps(self, obj, **kwargs):
+        '''
+        Serializes with orjson when kwargs ask for the compact or indented layout of the responses, and with the
+        default provider for any other arguments.
+        '''
+        if kwargs == {'separators': (',', ':')}:
+            return self._dumps_bytes(obj).decode()
+        if kwargs == {'indent': 2}:
+            return self._dumps_bytes(obj, indent=True).decode()
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(self._dumps_bytes(obj, indent) + b'\n', mimetype=self.mimetype)
+
+
+def init_json_provider(app):
+    '''
+    Serializes responses with orjson when FAST_JSON is set and orjson is installed.
+    '''
+    if app.config["FAST_JSON"] and orjson is not None:
+        app.json = OrjsonProvider(app)
@@ -0,0 +1,367 @@
+import threading
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple
+
+from sqlalchemy import select
+
+from models import Question, db, on_question_change, question_columns
+from flaskr.quiz import sample_quiz_ids
+
+READ_ENGINES = ('sql', 'memory')
+
+# Stored in the category and difficulty columns for NULL.
+MISSING = -1
+
+"""
+QuestionRow
+    a question read from the snapshot, with the columns of question_columns so that it is formatted by
+    Question.format_row like a database row
+"""
+QuestionRow = namedtuple('QuestionRow', ['id', 'question', 'answer', 'category', 'difficulty'])
+
+
+class StringPool:
+    '''
+    Interned strings referenced by their offset in the pool. Equal strings (a common answer, say) are stored once.
+    The lowercase form used by searches is kept next to each string.
+    '''
+
+    def __init__(self):
+        self.strings = []
+        self.folded = []
+        self._offsets = {}
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+    def add(self, value) -> int:
+        value = value or ''
+        offset = self._offsets.get(value)
+        if offset is None:
+            offset = self._offsets[value] = len(self.strings)
+            self.strings.append(value)
+            self.folded.append(value.lower())
+        return offset
+
+
+class QuestionSnapshot:
+    '''
+    Process level copy of the question bank held in array-backed columns, which serves the question list, category
+    and quiz reads without querying the database.
+
+    Row i of the columns is the question with the i-th smallest id. The text columns hold offsets into a string
+    pool. The ids of each category, each difficulty, and each category and difficulty are kept in their own sorted
+    array, keyed by (category, difficulty) with None for any. The snapshot is loaded by the first read.
+    Changes only mark the ids they touch, which are read again by the next read, so a write costs one primary key
+    query instead of a reload. Changes are marked from the start, loaded or not, so that the ones committed while
+    the questions are being read are applied afterwards.
+    '''
+
+    def __init__(self, max_attempts=32):
+        self.enabled = False
+        self.max_attempts = max_attempts
+        self.loads = 0
+        self.refreshes = 0
+        self._loaded = False
+        self._pending = set()
+        self._generation = 0
+        self._reads = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self._ids = array('I')
+        self._categories = array('i')
+        self._difficulties = array('i')
+        self._questions = array('I')
+        self._answers = array('I')
+        self._index = {}
+        self._pool = StringPool()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._loaded
+
+    def reset(self):
+        '''
+        Drops the snapshot. It is loaded again by the next read.
+        '''
+        with self._lock:
+            self._loaded = False
+            self._generation += 1
+            self._pending.clear()
+            self._clear()
+
+    def mark(self, question_id):
+        '''
+        Reads the question again with the next read.
+        '''
+        with self._lock:
+            self._pending.add(question_id)
+
+    def discard(self, question_id):
+        '''
+        Removes the question now. While questions are being read, which may have been read before it was deleted,
+        it is also read again with the next read.
+        '''
+        with self._lock:
+            self._remove(question_id)
+            if self._reads > 0 or not self._loaded:
+                self._pending.add(question_id)
+            else:
+                self._pending.discard(question_id)
+
+    def ensure_current(self):
+        '''
+        Loads the snapshot if needed and applies the changes marked since the last read. Both read from the primary
+        database so that they see the writes that marked them. Concurrent first reads wait for a single load.
+        '''
+        while not self._loaded:
+            with self._load_lock:
+                if not self._loaded:
+                    self._load()
+        if not self._pending:
+            return
+
+        with self._lock:
+            pending, self._pending = self._pending, set()
+            generation = self._generation
+            self._reads += 1
+        try:
+            with db.engine.connect() as connection:
+                rows = connection.execute(select(*question_columns).where(Question.id.in_(pending))).all()
+            with self._lock:
+                if generation != self._generation:
+                    return
+                for row in rows:
+                    self._put(row)
+                    pending.discard(row[0])
+                for question_id in pending:
+                    self._remove(question_id)
+                self.refreshes += 1
+        finally:
+            with self._lock:
+                self._reads -= 1
+
+    def _load(self):
+        with self._lock:
+            # Changes committed before this point are in the rows read below, later ones are marked again.
+            self._pending.clear()
+            generation = self._generation
+            self._reads += 1
+        try:
+            with db.engine.connect() as connection:
+                rows = connection.execute(select(*question_columns).order_by(Question.id)).all()
+            with self._lock:
+                # A reset while the questions were read leaves the snapshot to be loaded again.
+                if generation != self._generation:
+                    return
+                self._clear()
+                for row in rows:
+                    self._append(row)
+                self._loaded = True
+                self.loads += 1
+        finally:
+            with self._lock:
+                self._reads -= 1
+
+    def _append(self, row):
+        question_id, question, answer, category, difficulty = row
+        category = MISSING if category is None else category
+        difficulty = MISSING if difficulty is None else difficulty
+        self._ids.append(question_id)
+        self._questions.append(self._pool.add(question))
+        self._answers.append(self._pool.add(answer))
+        self._categories.append(category)
+        self._difficulties.append(difficulty)
+        for key in self._keys(category, difficulty):
+            self._index.setdefault(key, array('I')).append(question_id)
+
+    def _put(self, row):
+        question_id = row[0]
+        position = bisect_left(self._ids, question_id)
+        if position == len(self._ids) or self._ids[position] != question_id:
+            if position == len(self._ids):
+                self._append(row)
+                return
+            for column in (self._ids, self._questions, self._answers, self._categories, self._difficulties):
+                column.insert(position, 0)
+            self._ids[position] = question_id
+        else:
+            self._remove_from_index(position)
+
+        category = MISSING if row[3] is None else row[3]
+        difficulty = MISSING if row[4] is None else row[4]
+        self._questions[position] = self._pool.add(row[1])
+        self._answers[position] = self._pool.add(row[2])
+        self._categories[position] = category
+        self._difficulties[position] = difficulty
+        for key in self._keys(category, difficulty):
+            insort(self._index.setdefault(key, array('I')), question_id)
+        self._compact_pool()
+
+    def _remove(self, question_id):
+        position = bisect_left(self._ids, question_id)
+        if position == len(self._ids) or self._ids[position] != question_id:
+            return
+        self._remove_from_index(position)
+        for column in (self._ids, self._questions, self._answers, self._categories, self._difficulties):
+            del column[position]
+
+    @staticmethod
+    def _keys(category, difficulty) -> tuple:
+        return (category, None), (None, difficulty), (category, difficulty)
+
+    def _remove_from_index(self, position):
+        question_id = self._ids[position]
+        for key in self._keys(self._categories[position], self._difficulties[position]):
+            ids = self._index[key]
+            del ids[bisect_left(ids, question_id)]
+            if len(ids) == 0:
+                del self._index[key]
+
+    def _compact_pool(self):
+        # Updates leave the strings they replaced in the pool, rebuild it once they outnumber the live ones.
+        if len(self._pool) <= 2 * (len(self._questions) + len(self._answers)) + 1024:
+            return
+        pool = StringPool()
+        for column in (self._questions, self._answers):
+            for position, offset in enumerate(column):
+                column[position] = pool.add(self._pool.strings[offset])
+        self._pool = pool
+
+    def _row(self, position) -> QuestionRow:
+        category = self._categories[position]
+        difficulty = self._difficulties[position]
+        return QuestionRow(
+            self._ids[position],
+            self._pool.strings[self._questions[position]],
+            self._pool.strings[self._answers[position]],
+            None if category == MISSING else category,
+            None if difficulty == MISSING else difficulty
+        )
+
+    def _position(self, question_id) -> int:
+        return bisect_left(self._ids, question_id)
+
+    def count(self, category_id=None) -> int:
+        self.ensure_current()
+        if category_id is None:
+            return len(self._ids)
+        return len(self._index.get((category_id, None), ()))
+
+    def page(self, per_page, page=1, after=None, category_id=None) -> list:
+        '''
+        Returns the rows of a page of questions in id order, in the category when one is given. The page is read
+        after the id after when one is given, by page number otherwise.
+        '''
+        self.ensure_current()
+        with self._lock:
+            ids = self._ids if category_id is None else self._index.get((category_id, None), array('I'))
+            start = bisect_right(ids, after) if after is not None else (page - 1) * per_page
+            if start < 0:
+                return []
+            page_ids = ids[start:start + per_page]
+            if ids is self._ids:
+                return [self._row(position) for position in range(start, start + len(page_ids))]
+            return [self._row(self._position(question_id)) for question_id in page_ids]
+
+    def search(self, term, per_page, page=1, after=None) -> tuple:
+        '''
+        Returns the rows of a page of the questions whose question or answer text contains term (ignoring case) and
+        the number of matches. Like flaskr.search.PortableSearch, matches in the question text come first, then
+        the ones in the answer, each in id order; pages read after an id are in id order only.
+        '''
+        self.ensure_current()
+        term = term.lower()
+        with self._lock:
+            folded = self._pool.folded
+            in_question = [position for position, offset in enumerate(self._questions) if term in folded[offset]]
+            matched = set(in_question)
+            in_answer = [position for position, offset in enumerate(self._answers)
+                         if position not in matched and term in folded[offset]]
+            total = len(in_question) + len(in_answer)
+
+            if after is not None:
+                positions = sorted(in_question + in_answer)
+                start = bisect_right([self._ids[position] for position in positions], after)
+            else:
+                positions = in_question + in_answer
+                start = (page - 1) * per_page
+            if start < 0:
+                return [], total
+            return [self._row(position) for position in positions[start:start + per_page]], total
+
+    def select(self, category_id=None, excluded=frozenset()):
+        '''
+        Returns a random row in the category (any category when category_id is None) whose id is not in excluded,
+        or None when there is no such question.
+        '''
+        rows = self.select_many(category_id, 1, None, excluded)
+        return rows[0] if len(rows) > 0 else None
+
+    def select_many(self, category_id=None, count=1, difficulty_mix=None, excluded=frozenset()) -> list:
+        '''
+        Returns up to count distinct random rows in the category whose ids are not in excluded, with the number of
+        questions of each difficulty in difficulty_mix (see flaskr.quiz.sample_quiz_ids).
+        '''
+        self.ensure_current()
+        with self._lock:
+            def ids_for(difficulty):
+                if category_id is None and difficulty is None:
+                    return self._ids
+                return self._index.get((category_id, difficulty))
+
+            question_ids = sample_quiz_ids(ids_for, count, difficulty_mix, excluded, self.max_attempts)
+            return [self._row(self._position(question_id)) for question_id in question_ids]
+
+    def rows(self, question_ids) -> list:
+        '''
+        Returns the rows of the questions with the given ids, in that order, leaving out the ids it does not hold.
+        '''
+        self.ensure_current()
+        with self._lock:
+            positions = [self._position(question_id) for question_id in question_ids]
+            return [self._row(position) for question_id, position in zip(question_ids, positions)
+                    if position < len(self._ids) and self._ids[position] == question_id]
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'loaded': self._loaded,
+            'questions': len(self._ids),
+            'categories': sum(1 for category, difficulty in self._index if difficulty is None),
+            'strings': len(self._pool),
+            'loads': self.loads,
+            'refreshes': self.refreshes,
+            'pending': len(self._pending)
+        }
+
+
+question_snapshot = QuestionSnapshot()
+
+
+@on_question_change
+def update_question_snapshot(action, question):
+    if not question_snapshot.enabled:
+        return
+    if action in ('insert', 'update'):
+        question_snapshot.mark(question.id)
+    elif action == 'delete':
+        question_snapshot.discard(question.id)
+    else:
+        question_snapshot.reset()
+
+
+def init_read_engine(app):
+    '''
+    Serves the question list, category and quiz reads from the snapshot when READ_ENGINE is memory, and from the
+    database when it is sql.
+    '''
+    if app.config["READ_ENGINE"] not in READ_ENGINES:
+        raise ValueError(f'READ_ENGINE must be one of {", ".join(READ_ENGINES)}')
+    question_snapshot.enabled = app.config["READ_ENGINE"] == 'memory'
+    question_snapshot.reset()
+    question_snapshot.loads = question_snapshot.refreshes = 0
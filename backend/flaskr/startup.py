@@ -0,0 +1,56 @@
+import logging
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+startup_logger = logging.getLogger('flaskr.startup')
+
+
+class StartupReport:
+    '''
+    Times the phases of create_app and counts the database connections and statements they make, which should be
+    none: the database is first used by the first request.
+    '''
+
+    def __init__(self):
+        self.phases = {}
+        self.connections = 0
+        self.statements = 0
+        self._started = time.perf_counter()
+        self._last_mark = self._started
+        event.listen(Pool, 'connect', self._count_connection)
+        event.listen(Engine, 'before_cursor_execute', self._count_statement)
+
+    def _count_connection(self, dbapi_connection, connection_record):
+        self.connections += 1
+
+    def _count_statement(self, connection, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+
+    def mark(self, phase: str):
+        '''
+        Records the time since the previous mark as the duration of phase.
+        '''
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last_mark
+        self._last_mark = now
+
+    def finish(self) -> dict:
+        event.remove(Pool, 'connect', self._count_connection)
+        event.remove(Engine, 'before_cursor_execute', self._count_statement)
+        report = self.report()
+        startup_logger.info('App created in %.1f ms (%s), %d database connections, %d statements',
+                            report['total_ms'],
+                            ', '.join(f'{phase} {duration:.1f} ms' for phase, duration in report['phases'].items()),
+                            self.connections, self.statements)
+        return report
+
+    def report(self) -> dict:
+        return {
+            'total_ms': round((self._last_mark - self._started) * 1000, 3),
+            'phases': {phase: round(duration * 1000, 3) for phase, duration in self.phases.items()},
+            'database_connections': self.connections,
+            'database_statements': self.statements
+        }
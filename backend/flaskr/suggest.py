@@ -0,0 +1,240 @@
+import re
+import threading
+from array import array
+from bisect import bisect_left, insort
+
+from sqlalchemy import select
+
+from models import Question, db, on_question_change, question_columns
+
+MAX_SUGGESTIONS = 50
+
+# Question ids a suggestion looks at, at most, while it looks for questions containing the earlier words.
+MAX_SCANNED_POSTINGS = 5000
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text) -> list:
+    '''
+    Returns the lowercase words of text.
+    '''
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+class SuggestIndex:
+    '''
+    Process level prefix index over the words of the question and answer text, for autocomplete.
+
+    The distinct words are kept in a sorted list, so the words starting with a prefix are a contiguous run found
+    with a binary search. Each word has two sorted arrays of question ids, one for the question text and one for
+    the answer. The index is built by the first suggestion; changes only mark the ids they touch, which are read
+    again by the next suggestion. Changes are marked from the moment a build starts, so that the ones committed
+    while the questions are being read are applied afterwards.
+    '''
+
+    def __init__(self):
+        self.builds = 0
+        self.refreshes = 0
+        self._built = False
+        self._pending = set()
+        self._generation = 0
+        self._reads = 0
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self._words = []
+        self._postings = {}
+        self._rows = {}
+        self._row_words = {}
+
+    @property
+    def is_built(self) -> bool:
+        return self._built
+
+    def reset(self):
+        '''
+        Drops the index. It is built again by the next suggestion.
+        '''
+        with self._lock:
+            self._built = False
+            self._generation += 1
+            self._pending.clear()
+            self._clear()
+
+    def mark(self, question_id):
+        '''
+        Indexes the question again with the next suggestion. Before the first build there is nothing to update,
+        the build reads every question.
+        '''
+        with self._lock:
+            if self._built or self._reads > 0:
+                self._pending.add(question_id)
+
+    def discard(self, question_id):
+        '''
+        Removes the question now. While questions are being read, which may have been read before it was deleted,
+        it is also read again with the next suggestion.
+        '''
+        with self._lock:
+            self._remove(question_id)
+            if self._reads > 0:
+                self._pending.add(question_id)
+            else:
+                self._pending.discard(question_id)
+
+    def ensure_current(self):
+        '''
+        Builds the index if needed and indexes again the questions marked since the last suggestion, reading them
+        from the primary database. Concurrent first suggestions wait for a single build.
+        '''
+        while not self._built:
+            with self._build_lock:
+                if not self._built:
+                    self._build()
+        if not self._pending:
+            return
+
+        with self._lock:
+            pending, self._pending = self._pending, set()
+            generation = self._generation
+            self._reads += 1
+        try:
+            with db.engine.connect() as connection:
+                rows = connection.execute(select(*question_columns).where(Question.id.in_(pending))).all()
+            with self._lock:
+                if generation != self._generation:
+                    return
+                for question_id in pending:
+                    self._remove(question_id)
+                for row in rows:
+                    self._add(row)
+                self.refreshes += 1
+        finally:
+            with self._lock:
+                self._reads -= 1
+
+    def _build(self):
+        with self._lock:
+            # Changes committed before this point are in the rows read below, later ones are marked again.
+            self._pending.clear()
+            generation = self._generation
+            self._reads += 1
+        try:
+            with db.engine.connect() as connection:
+                rows = connection.execute(select(*question_columns).order_by(Question.id)).all()
+            with self._lock:
+                # A reset while the questions were read leaves the index to be built again.
+                if generation != self._generation:
+                    return
+                self._clear()
+                for row in rows:
+                    self._add(row, sort=False)
+                # Rows come in id order, so only the words need sorting.
+                self._words = sorted(self._postings)
+                self._built = True
+                self.builds += 1
+        finally:
+            with self._lock:
+                self._reads -= 1
+
+    def _add(self, row, sort=True):
+        question_id = row[0]
+        fields = (set(tokenize(row[1])), set(tokenize(row[2])))
+        self._rows[question_id] = tuple(row)
+        self._row_words[question_id] = fields
+        for field, words in enumerate(fields):
+            for word in words:
+                postings = self._postings.get(word)
+                if postings is None:
+                    postings = self._postings[word] = (array('I'), array('I'))
+                    if sort:
+                        insort(self._words, word)
+                if sort:
+                    insort(postings[field], question_id)
+                else:
+                    postings[field].append(question_id)
+
+    def _remove(self, question_id):
+        fields = self._row_words.pop(question_id, None)
+        if fields is None:
+            return
+        del self._rows[question_id]
+        for field, words in enumerate(fields):
+            for word in words:
+                ids = self._postings[word][field]
+                del ids[bisect_left(ids, question_id)]
+                if len(self._postings[word][0]) == 0 and len(self._postings[word][1]) == 0:
+                    del self._postings[word]
+                    del self._words[bisect_left(self._words, word)]
+
+    def _contains_word(self, question_id, word) -> bool:
+        fields = self._row_words[question_id]
+        return word in fields[0] or word in fields[1]
+
+    def suggest(self, prefix, limit=10, max_scanned=MAX_SCANNED_POSTINGS) -> tuple:
+        '''
+        Returns up to limit words starting with the last word of prefix, and up to limit question rows containing
+        such a word and every earlier word of prefix.
+
+        Questions with the last word typed in full come first, then the ones with a longer word, in word order.
+        Within a word, matches in the question text come before matches in the answer only, each in id order.
+        At most max_scanned question ids are looked at, so earlier words that few questions contain may leave
+        fewer than limit questions.
+        '''
+        self.ensure_current()
+        words = tokenize(prefix)
+        if len(words) == 0:
+            return [], []
+        *earlier, last = words
+
+        completions = []
+        question_ids = []
+        seen = set()
+        scanned = 0
+        with self._lock:
+            start = bisect_left(self._words, last)
+            for position in range(start, len(self._words)):
+                word = self._words[position]
+                searching = len(question_ids) < limit and scanned < max_scanned
+                if not word.startswith(last) or (len(completions) >= limit and not searching):
+                    break
+                if len(completions) < limit:
+                    completions.append(word)
+                for ids in self._postings[word]:
+                    for question_id in ids:
+                        if len(question_ids) >= limit or scanned >= max_scanned:
+                            break
+                        scanned += 1
+                        if question_id in seen:
+                            continue
+                        if all(self._contains_word(question_id, earlier_word) for earlier_word in earlier):
+                            seen.add(question_id)
+                            question_ids.append(question_id)
+            rows = [self._rows[question_id] for question_id in question_ids]
+        return completions, rows
+
+    def stats(self) -> dict:
+        return {
+            'built': self._built,
+            'questions': len(self._rows),
+            'words': len(self._words),
+            'builds': self.builds,
+            'refreshes': self.refreshes,
+            'pending': len(self._pending)
+        }
+
+
+suggest_index = SuggestIndex()
+
+
+@on_question_change
+def update_suggest_index(action, question):
+    if action in ('insert', 'update'):
+        suggest_index.mark(question.id)
+    elif action == 'delete':
+        suggest_index.discard(question.id)
+    else:
+        suggest_index.reset()
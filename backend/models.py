@@ -1,24 +1,154 @@
-from config import database_password_local
-from sqlalchemy import Column, String, Integer, create_engine
+from config import database_password_local, database_url, db_pool_size, db_max_overflow, db_pool_timeout, \
+    db_pool_recycle, db_pool_pre_ping, db_statement_timeout_ms
+from sqlalchemy import Column, String, Integer, Float, ForeignKey, Index, DDL, event, func, \
+    literal_column, select, insert, update, delete, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import relationship
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 import json
+import threading
+import time
+import uuid
 
 database_name = 'trivia'
-database_path = "postgresql://{}:{}@{}/{}".format(
+database_path = database_url or "postgresql://{}:{}@{}/{}".format(
     "xtopher", database_password_local, "localhost:5432", database_name)
 
-db = SQLAlchemy()
+"""
+RoutingSession
+    a session that reads through the connection chosen by RoutingSession.router (see flaskr.replicas) when the router
+    returns one for the current request, and through the primary engine otherwise. Flushes always use the primary.
+"""
+class RoutingSession(Session):
+    router = None
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.router is not None and not self._flushing:
+            connection = self.router.read_connection()
+            if connection is not None:
+                return connection
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+"""
+Question change listeners
+    callables listener(action, question) run after a question is committed, where action is one of
+    'insert', 'update' or 'delete'. The action 'reload' (with question None) means that many questions changed at
+    once. They keep the in-process indexes and caches in step with the datastore.
+"""
+question_change_listeners = []
+
+def on_question_change(listener):
+    question_change_listeners.append(listener)
+    return listener
+
+def notify_question_change(action, question):
+    for listener in question_change_listeners:
+        listener(action, question)
+
+"""
+Category change listeners
+    callables listener() run after a transaction that added, updated or deleted categories is committed
+"""
+category_change_listeners = []
+
+def on_category_change(listener):
+    category_change_listeners.append(listener)
+    return listener
+
+def notify_category_change():
+    for listener in category_change_listeners:
+        listener()
+
+"""
+TimedQueuePool
+    a QueuePool that reports how long each checkout waited for a connection to the callables in wait_observers. The
+    time spent opening a new connection is not counted, nor are the retries QueuePool makes within a checkout.
+"""
+class TimedQueuePool(QueuePool):
+    wait_observers = []
+    _checkout = threading.local()
+
+    def _do_get(self):
+        if getattr(self._checkout, 'started', None) is not None:
+            return super()._do_get()
+        self._checkout.started = time.perf_counter()
+        self._checkout.connecting = 0.0
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - self._checkout.started - self._checkout.connecting
+            self._checkout.started = None
+            for observer in self.wait_observers:
+                observer(waited)
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            if getattr(self._checkout, 'started', None) is not None:
+                self._checkout.connecting += time.perf_counter() - started
+
+"""
+engine_options(database_path, config)
+    returns the create_engine options for the database from the DB_* settings in config, falling back to the
+    environment. In-memory SQLite databases keep the default options.
+"""
+def engine_options(database_path, config=None):
+    config = config or {}
+    url = make_url(database_path)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': config.get("DB_POOL_SIZE", db_pool_size),
+        'max_overflow': config.get("DB_MAX_OVERFLOW", db_max_overflow),
+        'pool_timeout': config.get("DB_POOL_TIMEOUT", db_pool_timeout),
+        'pool_recycle': config.get("DB_POOL_RECYCLE", db_pool_recycle),
+        'pool_pre_ping': config.get("DB_POOL_PRE_PING", db_pool_pre_ping)
+    }
+    statement_timeout_ms = config.get("DB_STATEMENT_TIMEOUT_MS", db_statement_timeout_ms)
+    if url.get_backend_name() == 'postgresql' and statement_timeout_ms:
+        options['connect_args'] = {'options': f'-c statement_timeout={int(statement_timeout_ms)}'}
+    return options
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service. Options in SQLALCHEMY_ENGINE_OPTIONS take precedence over
+    the ones built from the DB_* settings. Nothing is sent to the database: the engine connects with the first
+    query, and the tables are created by init_db.
 """
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        **engine_options(database_path, app.config), **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})}
     db.app = app
     db.init_app(app)
+
+"""
+init_db()
+    creates the tables and indexes that do not exist yet (run with flask init-db), then recounts the questions and
+    bumps the data revision since the questions may have been reloaded outside the app
+"""
+def init_db():
     db.create_all()
+    with db.engine.begin() as connection:
+        rebuild_question_counts(connection)
+        bump_data_revision(connection)
+
+search_language = literal_column("'english'::regconfig")
+search_index_names = ('ix_questions_search_document', 'ix_questions_question_trgm', 'ix_questions_answer_trgm')
+filter_index_names = ('ix_questions_category_id', 'ix_questions_difficulty')
+
+def search_document(question, answer):
+    return func.to_tsvector(search_language, func.coalesce(question, '') + ' ' + func.coalesce(answer, ''))
 
 """
 Question
@@ -30,9 +160,22 @@ class Question(db.Model):
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
 
+    category_record = relationship('Category', back_populates='questions')
+
+    __table_args__ = (
+        Index(filter_index_names[0], category, id),
+        Index(filter_index_names[1], difficulty),
+        Index(search_index_names[0], search_document(question, answer),
+              postgresql_using='gin').ddl_if(dialect='postgresql'),
+        Index(search_index_names[1], question, postgresql_using='gin',
+              postgresql_ops={'question': 'gin_trgm_ops'}).ddl_if(dialect='postgresql'),
+        Index(search_index_names[2], answer, postgresql_using='gin',
+              postgresql_ops={'answer': 'gin_trgm_ops'}).ddl_if(dialect='postgresql')
+    )
+
     def __init__(self, question, answer, category, difficulty):
         self.question = question
         self.answer = answer
@@ -41,14 +184,28 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
+        adjust_question_counts({(self.category, self.difficulty): 1})
+        bump_data_revision()
         db.session.commit()
+        notify_question_change('insert', self)
 
     def update(self):
+        attributes = inspect(self).attrs
+        previous = tuple(attributes[name].history.deleted[0] if attributes[name].history.deleted
+                         else getattr(self, name) for name in ('category', 'difficulty'))
+        current = (self.category, self.difficulty)
+        if previous != current:
+            adjust_question_counts({previous: -1, current: 1})
+        bump_data_revision()
         db.session.commit()
+        notify_question_change('update', self)
 
     def delete(self):
         db.session.delete(self)
+        adjust_question_counts({(self.category, self.difficulty): -1})
+        bump_data_revision()
         db.session.commit()
+        notify_question_change('delete', self)
 
     def format(self):
         return {
@@ -59,6 +216,54 @@ class Question(db.Model):
             'difficulty': self.difficulty
             }
 
+    @staticmethod
+    def format_row(row):
+        '''
+        Formats a row selected with question_columns the same way as format(), without building a Question.
+        '''
+        return {
+            'id': row[0],
+            'question': row[1],
+            'answer': row[2],
+            'category': row[3],
+            'difficulty': row[4]
+            }
+
+"""
+question_columns
+    the columns read by the list and quiz endpoints, in the order expected by Question.format_row
+"""
+question_columns = (Question.id, Question.question, Question.answer, Question.category, Question.difficulty)
+
+"""
+Search indexes
+    the full-text (tsvector) and trigram GIN indexes over the question and answer text used by the Postgres search
+    backend are declared in Question.__table_args__ and only created on Postgres.
+"""
+question_search_document = search_document(Question.question, Question.answer)
+search_indexes = [index for index in Question.__table__.indexes if index.name in search_index_names]
+
+"""
+Filter indexes
+    (category, id) serves the category filters and their id order, difficulty the quiz and export filters
+"""
+filter_indexes = [index for index in Question.__table__.indexes if index.name in filter_index_names]
+
+create_trigram_extension = DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql')
+event.listen(Question.__table__, 'before_create', create_trigram_extension)
+
+"""
+create_search_indexes()
+    adds the search indexes to an existing Postgres database
+"""
+def create_search_indexes():
+    if db.engine.dialect.name != 'postgresql':
+        return
+    with db.engine.begin() as connection:
+        connection.execute(DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        for index in search_indexes:
+            index.create(connection, checkfirst=True)
+
 """
 Category
 
@@ -69,6 +274,8 @@ class Category(db.Model):
     id = Column(Integer, primary_key=True)
     type = Column(String)
 
+    questions = relationship('Question', back_populates='category_record', passive_deletes=True)
+
     def __init__(self, type):
         self.type = type
 
@@ -77,3 +284,119 @@ class Category(db.Model):
             'id': self.id,
             'type': self.type
             }
+
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def mark_category_change(mapper, connection, target):
+    inspect(target).session.info['category_changed'] = True
+    bump_data_revision(connection)
+
+@event.listens_for(RoutingSession, 'after_commit')
+def notify_category_change_after_commit(session):
+    if session.info.pop('category_changed', False):
+        notify_category_change()
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_category_change(session):
+    session.info.pop('category_changed', None)
+
+"""
+QuestionCount
+    the number of questions per category and difficulty, kept up to date in the transactions that insert, update
+    and delete questions so that totals are read without scanning the questions. Questions without a category or
+    difficulty are counted under 0.
+"""
+class QuestionCount(db.Model):
+    __tablename__ = 'question_counts'
+
+    category = Column(Integer, primary_key=True, autoincrement=False)
+    difficulty = Column(Integer, primary_key=True, autoincrement=False)
+    total = Column(Integer, nullable=False, default=0)
+
+"""
+adjust_question_counts(changes)
+    adds each delta of changes, a {(category, difficulty): delta} dict, to the counts in the current transaction
+"""
+def adjust_question_counts(changes):
+    dialect = db.engine.dialect.name
+    for (category, difficulty), delta in changes.items():
+        if delta == 0:
+            continue
+        key = {'category': category or 0, 'difficulty': difficulty or 0}
+        if dialect in ('postgresql', 'sqlite'):
+            upsert = (postgresql.insert if dialect == 'postgresql' else sqlite.insert)(QuestionCount)
+            db.session.execute(upsert.values(total=delta, **key).on_conflict_do_update(
+                index_elements=[QuestionCount.category, QuestionCount.difficulty],
+                set_={'total': QuestionCount.total + delta}))
+            continue
+        updated = db.session.execute(update(QuestionCount).filter_by(**key)
+                                     .values(total=QuestionCount.total + delta)).rowcount
+        if updated == 0:
+            db.session.execute(insert(QuestionCount).values(total=delta, **key))
+
+"""
+rebuild_question_counts(connection, categories)
+    recounts the questions of the given categories (0 for the questions without one), or every question by default.
+    On Postgres the counts are locked first so that questions written meanwhile are counted once, either by the
+    rebuild or by their own transaction.
+"""
+def rebuild_question_counts(connection, categories=None):
+    if connection.dialect.name == 'postgresql':
+        connection.exec_driver_sql('LOCK TABLE question_counts IN EXCLUSIVE MODE')
+    category = func.coalesce(Question.category, 0)
+    difficulty = func.coalesce(Question.difficulty, 0)
+    counts = select(category, difficulty, func.count(Question.id)).group_by(category, difficulty)
+    stale = delete(QuestionCount)
+    if categories is not None:
+        counts = counts.where(category.in_(categories))
+        stale = stale.where(QuestionCount.category.in_(categories))
+    connection.execute(stale)
+    connection.execute(insert(QuestionCount).from_select(['category', 'difficulty', 'total'], counts))
+
+@event.listens_for(Category, 'after_delete')
+def recount_questions_of_deleted_category(mapper, connection, target):
+    # The foreign key sets the category of its questions to NULL, which moves them to the counts of category 0.
+    rebuild_question_counts(connection, [target.id, 0])
+
+"""
+InvalidationEvent
+    the changes published by each worker when the polling invalidation bus is used (see flaskr.invalidation). Ids
+    increase with every event so a worker reads the events after the last id it has seen.
+"""
+class InvalidationEvent(db.Model):
+    __tablename__ = 'invalidation_events'
+
+    id = Column(Integer, primary_key=True)
+    origin = Column(String, nullable=False)
+    payload = Column(String, nullable=False)
+    created_at = Column(Float, nullable=False)
+
+"""
+DataRevision
+    a single row (id 1) counting the changes to the questions and categories, bumped in the transactions that make
+    them. Every worker reads the same row, so the ETags and Last-Modified dates built from it (see
+    flaskr.conditional) agree across workers. modified_at is the second of the last bump. epoch is drawn when the
+    row is created, so that a recreated table never reuses the validators of an earlier one.
+"""
+class DataRevision(db.Model):
+    __tablename__ = 'data_revisions'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    epoch = Column(String, nullable=False)
+    version = Column(Integer, nullable=False)
+    modified_at = Column(Integer, nullable=False)
+
+"""
+bump_data_revision(executor)
+    adds one to the data revision in the transaction of executor (a connection, or the current session by default),
+    creating the row when it does not exist yet
+"""
+def bump_data_revision(executor=None):
+    executor = executor if executor is not None else db.session
+    now = int(time.time())
+    updated = executor.execute(update(DataRevision).where(DataRevision.id == 1)
+                               .values(version=DataRevision.version + 1, modified_at=now)
+                               .execution_options(synchronize_session=False)).rowcount
+    if updated == 0:
+        executor.execute(insert(DataRevision).values(id=1, epoch=uuid.uuid4().hex[:8], version=1, modified_at=now))
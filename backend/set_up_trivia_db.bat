@@ -1,2 +1,4 @@
 createdb -U "student" trivia
-psql -U student -d trivia -a -f "C:\xtopher\code\Udacity - Full Stack Web Development\API-Development-project\backend\trivia.psql"
\ No newline at end of file
+psql -U student -d trivia -a -f "C:\xtopher\code\Udacity - Full Stack Web Development\API-Development-project\backend\trivia.psql"
+cd /d "%~dp0"
+flask --app flaskr init-db
\ No newline at end of file
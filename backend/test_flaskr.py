@@ -1,8 +1,27 @@
 from config import database_password_unit_test
 import unittest
 import json
+import gzip
+import time
+import random
+import sqlite3
+import threading
+from collections import Counter
+from sqlalchemy import event, inspect, insert, update, delete, select, func, Integer
 
 from flaskr import create_app
+from flaskr.replicas import replica_router
+from flaskr.quiz_sessions import InMemoryQuizSessionStore, QuizSession, SeenQuestions
+from flaskr.migrations import migrate_question_category
+from flaskr.invalidation import PollingTransport, invalidation_bus
+from flaskr.conditional import DataVersion
+from flaskr.quiz import question_selector
+from flaskr.snapshot import question_snapshot
+from flaskr.suggest import suggest_index
+from flaskr.serialization import OrjsonProvider, orjson
+from flask.json.provider import DefaultJSONProvider
+from flaskr.sampling import AliasTable, weighted_sampler
+from models import Question, Category, notify_question_change, QuestionCount, DataRevision, TimedQueuePool, db, bump_data_revision, init_db
 
 
 
@@ -34,6 +53,12 @@ class TriviaTestCase(unittest.TestCase):
             self.assertEqual( result_data_json['error'], result.status_code, f'HTTP response status code {result.status_code} does not match response message error code {result_data_json["error"]}')
             self.assertIn('message', result_data_json, 'Incorrect response message, missing error message')
         return
+
+    def delete_searched_questions(self, term):
+        '''Helper function to delete the questions an import test created, found by a search term'''
+        questions = json.loads(self.client().get(f'/questions?q={term}').data)['questions']
+        for question in questions:
+            self.client().delete(f'/questions/{question["id"]}')
             
     """
     Categories
@@ -61,6 +86,461 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual( result.status_code, 405 )
         self.check_basic_response_format( result )
         
+    def test_category_map_is_read_once_and_shared_by_the_list_endpoints(self):
+        self.client().get('/categories')
+        stats_before = json.loads( self.client().get('/cache/stats').data )['categories']
+        
+        self.client().get('/categories')
+        self.client().get('/questions')
+        self.client().get('/categories/1/questions')
+        
+        stats_result = self.client().get('/cache/stats')
+        self.check_basic_response_format( stats_result, ['categories'] )
+        stats_after = json.loads( stats_result.data )['categories']
+        self.assertEqual( stats_after['misses'], stats_before['misses'], 'The category map should not be read again while it is cached')
+        self.assertEqual( stats_after['hits'], stats_before['hits'] + 3, 'Each list endpoint should use the cached category map')
+        
+    def test_category_stats_match_the_questions(self):
+        result = self.client().get('/categories/stats')
+        
+        self.check_basic_response_format( result, ['categories', 'difficulties', 'total_questions'] )
+        stats = json.loads( result.data )
+        self.assertEqual( stats['total_questions'], json.loads( self.client().get('/questions').data )['total_questions'] )
+        self.assertEqual( stats['categories']['1']['total_questions'], json.loads( self.client().get('/categories/1/questions').data )['total_questions'] )
+        self.assertEqual( stats['total_questions'], sum(stats['difficulties'].values()) )
+        
+    def test_category_stats_follow_posted_and_deleted_questions(self):
+        stats_before = json.loads( self.client().get('/categories/stats').data )
+        
+        new_question = {'question': 'How many questions are there now?', 'answer': 'One more.', 'category': '5', 'difficulty': '2'}
+        question_id = json.loads( self.client().post('/questions', json=new_question).data )['question']['id']
+        stats_after_post = json.loads( self.client().get('/categories/stats').data )
+        self.assertEqual( stats_after_post['total_questions'], stats_before['total_questions'] + 1 )
+        self.assertEqual( stats_after_post['categories']['5']['total_questions'], stats_before['categories']['5']['total_questions'] + 1 )
+        self.assertEqual( stats_after_post['difficulties']['2'], stats_before['difficulties'].get('2', 0) + 1 )
+        
+        self.client().delete(f'/questions/{question_id}')
+        stats_after_delete = json.loads( self.client().get('/categories/stats').data )
+        self.assertEqual( stats_after_delete['categories'], stats_before['categories'] )
+        
+    def check_question_counts_match_the_questions(self):
+        category = func.coalesce(Question.category, 0)
+        difficulty = func.coalesce(Question.difficulty, 0)
+        questions = db.session.execute(select(category, difficulty, func.count(Question.id)).group_by(category, difficulty)).all()
+        counts = db.session.execute(select(QuestionCount.category, QuestionCount.difficulty, QuestionCount.total)
+                                    .where(QuestionCount.total != 0)).all()
+        self.assertEqual( sorted(map(tuple, counts)), sorted(map(tuple, questions)), 'The question counts should match the questions' )
+
+    def test_init_db_recounts_questions_reloaded_outside_the_app(self):
+        with self.app.app_context():
+            db.session.execute(update(QuestionCount).where(QuestionCount.category == 1).values(total=999))
+            db.session.commit()
+            init_db()
+            self.check_question_counts_match_the_questions()
+
+    def test_deleting_a_category_recounts_its_questions(self):
+        with self.app.app_context():
+            category = Category('Temporary')
+            db.session.add(category)
+            db.session.commit()
+            question = Question('Is this category temporary?', 'Yes', category.id, 1)
+            question.insert()
+            question_id = question.id
+
+            db.session.delete(category)
+            db.session.commit()
+            self.check_question_counts_match_the_questions()
+
+            db.session.get(Question, question_id).delete()
+            self.check_question_counts_match_the_questions()
+
+    def test_repeated_searches_are_answered_from_the_result_cache(self):
+        client = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'INVALIDATION_BUS': 'polling', 'INVALIDATION_POLL_SECONDS': 60}).test_client()
+        # The result cache is used with the invalidation bus, which drops every cache when it starts listening.
+        client.get('/categories')
+        deadline = time.monotonic() + 5
+        while invalidation_bus.stats()['resyncs'] == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        result = client.get('/questions?q=title')
+        stats_before = json.loads( client.get('/cache/stats').data )['results']
+        
+        result_2 = client.get('/questions?q=title')
+        
+        stats_after = json.loads( client.get('/cache/stats').data )['results']
+        invalidation_bus.stop()
+        self.assertEqual( result_2.data, result.data )
+        self.assertEqual( stats_after['hits'], stats_before['hits'] + 1, 'A repeated search should be a result cache hit')
+        self.assertGreater( stats_after['bytes'], 0 )
+        
+    def test_without_the_invalidation_bus_pages_follow_the_changes_of_another_worker(self):
+        app = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'INVALIDATION_BUS': 'off', 'DATA_REVISION_TTL': 0})
+        client = app.test_client()
+        result = client.get('/questions?q=zeppelin')
+        self.assertEqual( json.loads(result.data)['total_questions'], 0 )
+        
+        # Another worker adds a question. This one is not told, since the invalidation bus is off.
+        with app.app_context():
+            with db.engine.begin() as connection:
+                question_id = connection.execute(insert(Question).values(question='Who flew the zeppelin?', answer='Hugo Eckener', category=4, difficulty=3).returning(Question.id)).scalar()
+                bump_data_revision(connection)
+        
+        result_2 = client.get('/questions?q=zeppelin', headers={'If-None-Match': result.headers.get('ETag')})
+        self.assertEqual( result_2.status_code, 200 )
+        self.assertEqual( json.loads(result_2.data)['total_questions'], 1, 'A page should not be served from the cache of a worker that cannot see the changes of the others')
+        stats = json.loads(client.get('/cache/stats').data)['results']
+        self.assertEqual( (stats['hits'], stats['bypassed']), (0, 2), 'Pages should not be cached without the invalidation bus' )
+        with app.app_context():
+            db.session.execute(delete(Question).where(Question.id == question_id))
+            db.session.commit()
+        
+    def test_result_cache_is_invalidated_by_a_new_question(self):
+        total_before = json.loads( self.client().get('/categories/5/questions').data )['total_questions']
+        
+        new_question = {'question': 'Is this page cached?', 'answer': 'Not any more.', 'category': '5', 'difficulty': '1'}
+        self.client().post('/questions', json=new_question)
+        
+        total_after = json.loads( self.client().get('/categories/5/questions').data )['total_questions']
+        self.assertEqual( total_after, total_before + 1, 'A cached category page should not be served after a question is added')
+        
+    def test_changes_made_by_another_worker_invalidate_the_result_cache(self):
+        app = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'INVALIDATION_BUS': 'polling', 'INVALIDATION_POLL_SECONDS': 0.05})
+        client = app.test_client()
+        self.assertEqual( json.loads( client.get('/questions?q=zeppelin').data )['total_questions'], 0 )
+        
+        # Another worker adds a question and publishes the change.
+        with app.app_context():
+            question_id = db.session.execute(insert(Question).values(question='Who flew the zeppelin?', answer='Hugo Eckener', category=4, difficulty=3).returning(Question.id)).scalar()
+            db.session.commit()
+            PollingTransport(db.engine).publish('another-worker', json.dumps({'origin': 'another-worker', 'kind': 'question', 'action': 'insert', 'id': question_id, 'category': 4, 'difficulty': 3}))
+        
+        deadline = time.monotonic() + 5
+        while invalidation_bus.stats()['received'] == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        invalidation_bus.stop()
+        
+        self.assertEqual( json.loads( client.get('/questions?q=zeppelin').data )['total_questions'], 1, 'A change published by another worker should invalidate the cached search')
+        with app.app_context():
+            db.session.execute(delete(Question).where(Question.id == question_id))
+            db.session.commit()
+        
+    def test_deleting_questions_in_batch_publishes_a_single_event(self):
+        published = []
+        
+        class RecordingTransport:
+            name = 'recording'
+            def publish(self, origin, payload):
+                published.append(json.loads(payload))
+            def listen(self, receive, resync, stopped):
+                stopped.wait()
+        
+        new_question = {'question': 'How many events am I worth?', 'answer': 'A share of one.', 'category': '5', 'difficulty': '1'}
+        question_ids = [json.loads(self.client().post('/questions', json=new_question).data)['question']['id'] for _ in range(3)]
+        invalidation_bus.configure(RecordingTransport())
+        try:
+            self.client().delete('/questions', json={'ids': question_ids})
+        finally:
+            invalidation_bus.configure(None)
+        
+        self.assertEqual( [(event['kind'], event['action']) for event in published], [('question', 'reload')], 'A batch delete should publish one reload event' )
+        
+    def test_the_invalidation_bus_defaults_to_auto(self):
+        app = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path})
+        
+        self.assertEqual( app.config['INVALIDATION_BUS'], 'auto' )
+        
+    def test_get_categories_with_a_matching_etag_returns_not_modified(self):
+        result = self.client().get('/categories')
+        etag = result.headers.get('ETag')
+        
+        self.assertIsNotNone( etag, 'GET categories should return an ETag')
+        self.assertIn( 'Cache-Control', result.headers, 'GET categories should return a Cache-Control header')
+        
+        result_2 = self.client().get('/categories', headers={'If-None-Match': etag})
+        
+        self.assertEqual( result_2.status_code, 304, 'GET categories with the current ETag should return 304')
+        self.assertEqual( result_2.headers.get('ETag'), etag )
+        self.assertEqual( len(result_2.data), 0, 'A 304 response should not have a body')
+        
+    def test_validators_change_with_the_changes_of_another_worker(self):
+        app = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'INVALIDATION_BUS': 'off', 'DATA_REVISION_TTL': 0})
+        client = app.test_client()
+        with app.app_context():
+            db.session.execute(update(DataRevision).values(modified_at=int(time.time()) - 10))
+            db.session.commit()
+        result = client.get('/categories')
+        etag = result.headers.get('ETag')
+        last_modified = result.headers.get('Last-Modified')
+        with app.test_request_context('/categories'):
+            self.assertEqual( '"' + DataVersion().validators('/categories', b'')[0] + '"', etag, 'Every worker should build the same ETag')
+        
+        # Another worker changes a question. This one is not told, since the invalidation bus is off.
+        with app.app_context():
+            with db.engine.begin() as connection:
+                bump_data_revision(connection)
+        
+        self.assertEqual( client.get('/categories', headers={'If-None-Match': etag}).status_code, 200, 'The ETag should follow the shared data revision')
+        self.assertIsNotNone( last_modified )
+        self.assertEqual( client.get('/categories', headers={'If-Modified-Since': last_modified}).status_code, 200, 'Last-Modified should follow the shared data revision')
+        
+    def test_responses_are_compressed_for_clients_that_accept_gzip(self):
+        plain = self.client().get('/questions')
+        result = self.client().get('/questions', headers={'Accept-Encoding': 'gzip'})
+        
+        self.assertEqual( result.headers.get('Content-Encoding'), 'gzip', 'A large JSON response should be compressed')
+        self.assertIn( 'Accept-Encoding', result.headers.get('Vary', '') )
+        self.assertEqual( gzip.decompress(result.data), plain.data, 'The compressed body should decompress to the plain one')
+        self.assertEqual( result.headers.get('ETag'), plain.headers.get('ETag').rstrip('"') + '-gzip"', 'A compressed response should have its own ETag')
+        
+        result_2 = self.client().get('/questions', headers={'Accept-Encoding': 'gzip', 'If-None-Match': result.headers.get('ETag')})
+        self.assertEqual( result_2.status_code, 304, 'The ETag of a compressed response should be revalidated')
+        self.assertEqual( result_2.headers.get('ETag'), result.headers.get('ETag') )
+
+    def test_compressed_bodies_are_reused_until_the_questions_change(self):
+        for request_number in range(3):
+            self.client().get('/categories/1/questions', headers={'Accept-Encoding': 'gzip'})
+        stats = json.loads(self.client().get('/cache/stats').data)['compression']
+        self.assertEqual( (stats['compressed'], stats['cache_hits']), (1, 2), 'A hot response should be compressed once')
+        
+        new_question = {'question': 'Is a compressed body kept after a change?', 'answer': 'No', 'category': '5', 'difficulty': '1'}
+        question_id = json.loads(self.client().post('/questions', json=new_question).data)['question']['id']
+        self.client().get('/categories/1/questions', headers={'Accept-Encoding': 'gzip'})
+        self.client().delete(f'/questions/{question_id}')
+        self.assertEqual( json.loads(self.client().get('/cache/stats').data)['compression']['compressed'], 2 )
+
+    def test_small_responses_and_clients_without_gzip_are_not_compressed(self):
+        client = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'COMPRESSION_MIN_SIZE': 10 ** 6}).test_client()
+        default_client = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path}).test_client()
+        self.assertNotIn( 'Content-Encoding', client.get('/questions', headers={'Accept-Encoding': 'gzip'}).headers, 'Responses under the threshold should not be compressed')
+        self.assertEqual( default_client.get('/questions', headers={'Accept-Encoding': 'gzip'}).headers.get('Content-Encoding'), 'gzip', 'The threshold of one app should not apply to another')
+        self.assertNotIn( 'Content-Encoding', default_client.get('/questions', headers={'Accept-Encoding': 'gzip;q=0, identity'}).headers, 'Encodings refused by the client should not be used')
+
+    def test_the_etag_of_a_compressed_response_only_matches_requests_for_the_same_coding(self):
+        etag = self.client().get('/questions', headers={'Accept-Encoding': 'gzip'}).headers.get('ETag')
+        
+        result = self.client().get('/questions', headers={'Accept-Encoding': 'identity', 'If-None-Match': etag})
+        self.assertEqual( result.status_code, 200, 'A client that refuses gzip should not revalidate a gzip ETag')
+        self.assertNotIn( 'Content-Encoding', result.headers )
+        
+        result = self.client().get('/questions', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual( result.status_code, 304 )
+        self.assertIn( 'Accept-Encoding', result.headers.get('Vary', ''), 'A 304 of a compressible endpoint should vary on Accept-Encoding')
+
+    """
+    Metrics
+    """
+    def test_responses_have_a_server_timing_header(self):
+        result = self.client().get('/questions')
+        
+        server_timing = result.headers.get('Server-Timing')
+        self.assertIsNotNone( server_timing, 'Responses should have a Server-Timing header')
+        self.assertIn( 'db;dur=', server_timing )
+        self.assertIn( 'app;dur=', server_timing )
+        
+    def test_metrics_are_returned_in_prometheus_format(self):
+        self.client().get('/categories')
+        
+        result = self.client().get('/metrics')
+        
+        self.assertEqual( result.status_code, 200 )
+        self.assertTrue( result.content_type.startswith('text/plain'), 'Metrics should be returned as text')
+        metrics = result.data.decode()
+        self.assertIn( '# TYPE trivia_request_duration_seconds histogram', metrics )
+        self.assertIn( 'trivia_request_duration_seconds_count{endpoint="get_categories",method="GET"}', metrics )
+        
+    def test_creating_the_app_makes_no_database_round_trips(self):
+        startup_report = self.app.extensions['startup_report']
+        
+        self.assertEqual( startup_report['database_connections'], 0, 'Creating the app should not connect to the database')
+        self.assertEqual( startup_report['database_statements'], 0, 'Creating the app should not run SQL statements')
+        self.assertIn( 'database', startup_report['phases'] )
+        
+    def test_the_app_starts_while_the_database_is_unavailable(self):
+        app = create_app(test_config={'SQLALCHEMY_DATABASE_URI': 'sqlite:////nonexistent/trivia.db'})
+        client = app.test_client()
+        
+        result = client.get('/questions')
+        
+        self.assertEqual( result.status_code, 500, 'Requests should fail, not app creation, when the database is unavailable')
+        self.assertEqual( client.get('/metrics').status_code, 200 )
+        
+    def test_metrics_report_the_connection_pool_wait(self):
+        app = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'DB_POOL_SIZE': 2, 'DB_MAX_OVERFLOW': 1})
+        client = app.test_client()
+        client.get('/questions')
+        
+        metrics = client.get('/metrics').data.decode()
+        
+        self.assertIn( 'trivia_db_pool_checkout_wait_seconds_count', metrics )
+        self.assertIn( 'trivia_db_pool_size 2', metrics, 'The pool should be sized from the DB_POOL_SIZE setting')
+        
+    def test_the_pool_wait_leaves_out_the_time_spent_connecting(self):
+        def slow_connect():
+            time.sleep(0.05)
+            return sqlite3.connect(':memory:')
+        pool = TimedQueuePool(slow_connect, pool_size=1, max_overflow=0)
+        waits = []
+        TimedQueuePool.wait_observers.append(waits.append)
+        try:
+            pool.connect().close()
+        finally:
+            TimedQueuePool.wait_observers.remove(waits.append)
+        
+        self.assertEqual( len(waits), 1 )
+        self.assertLess( waits[0], 0.05, 'Opening a connection is not waiting for one')
+        
+    def test_slow_queries_are_logged_with_their_plan(self):
+        app = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'SLOW_QUERY_MS': 0.000001})
+        client = app.test_client()
+        client.get('/questions')
+        
+        result = client.get('/metrics/slow-queries')
+        
+        self.check_basic_response_format( result, ['slow_queries'] )
+        slow_queries = json.loads( result.data )['slow_queries']
+        self.assertGreater( len(slow_queries), 0, 'Every query should be logged when the threshold is tiny')
+        self.assertIsNotNone( slow_queries[-1]['plan'], 'A slow SELECT should be logged with its query plan')
+        
+    """
+    Admission control
+    """
+    def create_admission_app(self, **config):
+        config = dict({'SQLALCHEMY_DATABASE_URI': self.database_path, 'ADMISSION_READ_LIMIT': 1, 'ADMISSION_QUEUE_SIZE': 0}, **config)
+        app = create_app(test_config=config)
+        return app.test_client(), app.extensions['admission'].limiters['get_question_by_category']
+
+    def test_requests_beyond_the_limit_are_shed_with_a_503(self):
+        client, limiter = self.create_admission_app()
+        limiter.acquire()
+        try:
+            result = client.get('/categories/1/questions')
+        finally:
+            limiter.release()
+        
+        self.assertEqual( result.status_code, 503 )
+        self.check_basic_response_format( result )
+        self.assertEqual( result.headers.get('Retry-After'), '1' )
+        self.assertEqual( limiter.stats()['shed']['queue_full'], 1 )
+        self.assertEqual( client.get('/categories/1/questions').status_code, 200, 'The released slot should admit the next request')
+        
+    def test_queued_requests_are_shed_when_the_wait_times_out(self):
+        client, limiter = self.create_admission_app(ADMISSION_QUEUE_SIZE=1, ADMISSION_QUEUE_TIMEOUT=0.05)
+        limiter.acquire()
+        try:
+            result = client.get('/categories/1/questions')
+        finally:
+            limiter.release()
+        
+        self.assertEqual( result.status_code, 503 )
+        stats = limiter.stats()
+        self.assertEqual( stats['shed']['timeout'], 1 )
+        self.assertGreaterEqual( stats['wait_seconds'], 0.05, 'The time spent in the queue should be recorded')
+        
+    def test_queued_requests_run_when_a_slot_is_released(self):
+        client, limiter = self.create_admission_app(ADMISSION_QUEUE_SIZE=1, ADMISSION_QUEUE_TIMEOUT=5)
+        limiter.acquire()
+        threading.Timer(0.05, limiter.release).start()
+        
+        result = client.get('/categories/1/questions')
+        
+        self.assertEqual( result.status_code, 200 )
+        stats = limiter.stats()
+        self.assertEqual( stats['queued'], 1 )
+        self.assertEqual( stats['active'], 0, 'The slot should be released once the request is answered')
+        
+    def test_admission_metrics_report_the_shed_requests(self):
+        client, limiter = self.create_admission_app()
+        limiter.acquire()
+        try:
+            client.get('/categories/1/questions')
+        finally:
+            limiter.release()
+        
+        result = client.get('/metrics/admission')
+        
+        self.check_basic_response_format( result, ['routes'] )
+        route = json.loads( result.data )['routes']['get_question_by_category']
+        self.assertEqual( route['kind'], 'read' )
+        self.assertEqual( route['limit'], 1 )
+        self.assertEqual( route['shed']['queue_full'], 1 )
+        metrics = client.get('/metrics').data.decode()
+        self.assertIn( 'trivia_admission_shed_total{endpoint="get_question_by_category",reason="queue_full"} 1', metrics )
+        
+    def test_endpoints_of_a_kind_share_its_budget(self):
+        client, limiter = self.create_admission_app()
+        limiters = client.application.extensions['admission'].limiters
+        other_read = limiters['get_questions_no_page_specified']
+        other_read.acquire()
+        try:
+            result = client.get('/categories/1/questions')
+        finally:
+            other_read.release()
+        
+        self.assertEqual( result.status_code, 503, 'A read endpoint should not run beyond the read budget used by another one')
+        self.assertEqual( limiter.stats()['shed']['queue_full'], 1 )
+        self.assertIs( limiters['post_question'].budget, limiters['delete_question'].budget )
+        self.assertIsNot( limiters['post_question'].budget, limiter.budget )
+        
+    def test_admission_control_can_be_turned_off(self):
+        client, limiter = self.create_admission_app()
+        app = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'ADMISSION_CONTROL': False})
+        
+        self.assertEqual( app.extensions['admission'].stats(), {} )
+        self.assertEqual( json.loads( app.test_client().get('/metrics/admission').data )['routes'], {} )
+        self.assertIn( 'get_question_by_category', client.application.extensions['admission'].stats(), 'Turning admission control off in one app should not affect another app' )
+        
+    """
+    Read replicas
+    """
+    def test_get_requests_are_read_from_the_replicas_in_turn(self):
+        app = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'DB_REPLICA_URIS': [self.database_path, self.database_path], 'RESULT_CACHE_TTL': 0})
+        client = app.test_client()
+        
+        for request_number in range(4):
+            result = client.get('/questions')
+            self.assertEqual( result.status_code, 200 )
+        
+        stats = replica_router.stats()
+        self.assertEqual( [replica['reads'] for replica in stats['replicas']], [2, 2], 'GET requests should be shared between the replicas')
+        self.assertEqual( stats['primary_reads'], 0 )
+        
+    def test_requests_without_queries_do_not_check_out_a_replica(self):
+        app = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'DB_REPLICA_URIS': [self.database_path]})
+        client = app.test_client()
+        
+        for path in ('/metrics', '/cache/stats', '/metrics/admission'):
+            self.assertEqual( client.get(path).status_code, 200 )
+        
+        stats = replica_router.stats()
+        self.assertEqual( (stats['replicas'][0]['reads'], stats['primary_reads']), (0, 0), 'A request that reads nothing should not choose a replica')
+        
+    def test_get_requests_fail_over_from_an_unavailable_replica(self):
+        app = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'DB_REPLICA_URIS': ['sqlite:////nonexistent/trivia.db', self.database_path], 'RESULT_CACHE_TTL': 0})
+        client = app.test_client()
+        
+        for request_number in range(3):
+            result = client.get('/categories/1/questions')
+            self.assertEqual( result.status_code, 200, 'An unavailable replica should not fail the request')
+        
+        stats = replica_router.stats()
+        self.assertFalse( stats['replicas'][0]['healthy'], 'A replica that cannot be reached should be marked unhealthy')
+        self.assertEqual( stats['replicas'][1]['reads'], 3 )
+        self.assertEqual( stats['failovers'], 1, 'An unhealthy replica should not be retried right away')
+        
+    def test_get_after_a_write_reads_from_the_primary(self):
+        app = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'DB_REPLICA_URIS': [self.database_path], 'RESULT_CACHE_TTL': 0})
+        client = app.test_client()
+        new_question = {'question': 'Where do reads go right after a write?',
+                        'answer': 'To the primary.',
+                        'category': '5',
+                        'difficulty': '2'}
+        
+        post_result = client.post('/questions', json=new_question)
+        question_id = json.loads(post_result.data)['question']['id']
+        get_result = client.get(f'/questions/{question_id}')
+        
+        self.assertEqual( get_result.status_code, 200, 'A question should be readable right after it was posted')
+        self.assertEqual( replica_router.stats()['primary_reads'], 1, 'A GET right after a write should read from the primary')
+        
     """
     GET Questions
     """
@@ -82,6 +562,29 @@ class TriviaTestCase(unittest.TestCase):
             self.assertDictEqual(question_no_page, question_page_1, 'GET questions without a page query did not return the same set as GET questions with a page query')
             question_index += 1
 
+    def test_fast_json_provider_returns_the_same_response(self):
+        fast_result = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'FAST_JSON': True}).test_client().get('/questions')
+        default_result = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'FAST_JSON': False}).test_client().get('/questions')
+        
+        self.assertEqual( fast_result.status_code, 200 )
+        self.assertEqual( fast_result.mimetype, 'application/json' )
+        self.assertEqual( fast_result.data, default_result.data, 'The fast JSON provider should return exactly the same body as the default one')
+
+    def test_fast_json_provider_sorts_integer_keys_and_escapes_non_ascii_text(self):
+        if orjson is None:
+            self.skipTest('orjson is not installed')
+        payload = {'categories': {category_id: f'Catégorie {category_id}' for category_id in range(1, 13)},
+                   'questions': [{'question': 'Qui a peint « La Joconde » ? 🎨', 'answer': 'Léonard de Vinci', 'id': 1}]}
+        
+        with self.app.app_context():
+            for debug in (False, True):
+                self.app.debug = debug
+                fast = OrjsonProvider(self.app).response(payload).data
+                default = DefaultJSONProvider(self.app).response(payload).data
+                self.assertEqual( fast, default, 'The fast JSON provider should sort integer keys as numbers and escape non ASCII text')
+        self.app.debug = False
+        self.assertEqual( OrjsonProvider(self.app).dumps(payload, ensure_ascii=False), DefaultJSONProvider(self.app).dumps(payload, ensure_ascii=False), 'Other arguments should be honoured')
+        
     def test_get_questions_page_2_returns_a_set_of_questions_after_page_1(self):
         result_2 = self.client().get('/questions?page=2')
         
@@ -108,6 +611,21 @@ class TriviaTestCase(unittest.TestCase):
         
         self.assertEqual(len(get_result_json['questions']), 0, 'Requesting a non-existant page of questions should return an empty page.')
         
+    def test_get_questions_after_a_question_id_returns_the_next_page(self):
+        result_1 = self.client().get('/questions?page=1')
+        data_json_1 = json.loads( result_1.data )
+        id_of_last_question = data_json_1['questions'][-1]['id']
+        
+        result_after = self.client().get(f'/questions?after={id_of_last_question}')
+        
+        self.assertEqual( result_after.status_code, 200 )
+        self.check_basic_response_format( result_after, ['categories', 'questions', 'current_category', 'total_questions'] )
+        
+        data_json_after = json.loads( result_after.data )
+        data_json_2 = json.loads( self.client().get('/questions?page=2').data )
+        self.assertEqual( data_json_after['questions'], data_json_2['questions'], 'GET questions after the last question of page 1 should return the same set as page 2')
+        self.assertEqual( data_json_after['total_questions'], data_json_1['total_questions'], 'Total questions should not depend on the page requested')
+
     def test_get_questions_without_category_sets_current_category_to_a_valid_category(self):
         result = self.client().get('/questions')
         
@@ -151,6 +669,123 @@ class TriviaTestCase(unittest.TestCase):
         
         self.assertGreater(len(get_result_json['questions']), 1, 'Get questions searching for 'in' with page 2 should return more than 1 question')
     
+    def test_search_is_case_insensitive(self):
+        get_result = self.client().get('/questions?q=tim burton')
+        
+        self.assertEqual( get_result.status_code, 200, 'Get questions with a search term returned an error.')
+        self.check_basic_response_format(get_result, ['categories', 'questions', 'current_category', 'total_questions'])
+        
+        get_result_json = json.loads(get_result.data)
+        
+        self.assertEqual(len(get_result_json['questions']), 1, 'Get questions with "tim burton" should return 1 question')
+        self.assertEqual(get_result_json['total_questions'], 1, 'Total questions should count only the questions matching the search')
+
+    def test_search_matches_the_answer_text(self):
+        get_result = self.client().get('/questions?q=Scissorhands')
+        
+        self.assertEqual( get_result.status_code, 200, 'Get questions with a search term returned an error.')
+        get_result_json = json.loads(get_result.data)
+        
+        self.assertEqual(len(get_result_json['questions']), 1, 'Get questions with "Scissorhands" should return the question with that answer')
+        self.assertIn('Tim Burton', get_result_json['questions'][0]['question'])
+    
+    def test_suggest_completes_the_last_word_of_the_prefix(self):
+        get_result = self.client().get('/questions/suggest?prefix=Tim Burt')
+        
+        self.assertEqual(get_result.status_code, 200)
+        self.check_basic_response_format(get_result, ['completions', 'questions'])
+        get_result_json = json.loads(get_result.data)
+        self.assertIn('burton', get_result_json['completions'])
+        self.assertEqual(len(get_result_json['questions']), 1, 'Suggestions for "Tim Burt" should be the Tim Burton question')
+        self.assertIn('Tim Burton', get_result_json['questions'][0]['question'])
+        
+        answer_result_json = json.loads(self.client().get('/questions/suggest?prefix=scissor').data)
+        self.assertEqual(answer_result_json['questions'], get_result_json['questions'], 'Suggestions should match the answer text')
+
+    def test_suggest_follows_posted_and_deleted_questions(self):
+        self.assertEqual(json.loads(self.client().get('/questions/suggest?prefix=zanzib').data)['questions'], [])
+        new_question = {'question': 'Which island gave the Zanzibarian sultanate its name?',
+                        'answer': 'Unguja',
+                        'category': '5',
+                        'difficulty': '2'}
+        
+        question_id = json.loads(self.client().post('/questions', json=new_question).data)['question']['id']
+        get_result_json = json.loads(self.client().get('/questions/suggest?prefix=zanzib').data)
+        self.assertEqual(get_result_json['completions'], ['zanzibarian'])
+        self.assertEqual([question['id'] for question in get_result_json['questions']], [question_id], 'A posted question should be suggested')
+        
+        self.client().delete(f'/questions/{question_id}')
+        get_result_json = json.loads(self.client().get('/questions/suggest?prefix=zanzib').data)
+        self.assertEqual(get_result_json['completions'], [])
+        self.assertEqual(get_result_json['questions'], [], 'A deleted question should not be suggested')
+        self.assertEqual(json.loads(self.client().get('/cache/stats').data)['suggest']['builds'], 1, 'Changes should be applied without rebuilding the index')
+
+    def test_suggest_applies_changes_made_while_the_index_is_built(self):
+        # Another request changes a question while the index reads the questions, possibly too late to be read.
+        def change_during_build(connection, cursor, statement, parameters, context, executemany):
+            if 'ORDER BY' in statement and not suggest_index.is_built:
+                question = Question('Who flew the zeppelin?', 'Hugo Eckener', 4, 3)
+                question.id = 5
+                notify_question_change('update', question)
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', change_during_build)
+        try:
+            self.client().get('/questions/suggest?prefix=scissor')
+        finally:
+            with self.app.app_context():
+                event.remove(db.engine, 'before_cursor_execute', change_during_build)
+        
+        stats = json.loads(self.client().get('/cache/stats').data)['suggest']
+        self.assertEqual((stats['builds'], stats['refreshes']), (1, 1), 'A change made while the index is built should be indexed again afterwards')
+
+    def test_suggest_looks_at_a_bounded_number_of_questions(self):
+        question_ids = []
+        for number in range(12):
+            new_question = {'question': f'Which zeppelinological record is number {number}?',
+                            'answer': 'A long one',
+                            'category': '5',
+                            'difficulty': '2'}
+            question_ids.append(json.loads(self.client().post('/questions', json=new_question).data)['question']['id'])
+        try:
+            with self.app.app_context():
+                completions, rows = suggest_index.suggest('zeppelinolog', limit=10)
+                capped_completions, capped_rows = suggest_index.suggest('zeppelinolog', limit=10, max_scanned=5)
+        finally:
+            for question_id in question_ids:
+                self.client().delete(f'/questions/{question_id}')
+        
+        self.assertEqual(completions, ['zeppelinological'])
+        self.assertEqual([row[0] for row in rows], question_ids[:10])
+        self.assertEqual(capped_completions, completions, 'The scan limit should not change the completions')
+        self.assertEqual([row[0] for row in capped_rows], question_ids[:5], 'A suggestion should stop looking for questions after max_scanned ids')
+
+    def test_suggest_without_a_prefix_or_with_an_invalid_limit_results_in_a_400(self):
+        for query in ('', 'prefix=', 'prefix=tim&limit=0', 'prefix=tim&limit=51'):
+            get_result = self.client().get(f'/questions/suggest?{query}')
+            self.assertEqual(get_result.status_code, 400, f'Suggest with "{query}" should result in a 400')
+
+    def test_export_questions_streams_every_question_as_ndjson(self):
+        total_questions = json.loads(self.client().get('/questions').data)['total_questions']
+        
+        export_result = self.client().get('/questions/export')
+        
+        self.assertEqual(export_result.status_code, 200, 'Exporting questions resulted in an error')
+        self.assertEqual(export_result.mimetype, 'application/x-ndjson')
+        exported_questions = [json.loads(line) for line in export_result.data.decode().splitlines()]
+        self.assertEqual(len(exported_questions), total_questions, 'The export should contain every question')
+        self.assertEqual(set(exported_questions[0].keys()), {'id', 'question', 'answer', 'category', 'difficulty'})
+        
+    def test_export_questions_as_csv_filtered_by_category(self):
+        export_result = self.client().get('/questions/export?format=csv&category=1')
+        
+        self.assertEqual(export_result.status_code, 200, 'Exporting questions resulted in an error')
+        self.assertEqual(export_result.mimetype, 'text/csv')
+        lines = export_result.data.decode().splitlines()
+        self.assertEqual(lines[0], 'id,question,answer,category,difficulty')
+        
+        category_questions = json.loads(self.client().get('/categories/1/questions').data)['total_questions']
+        self.assertEqual(len(lines) - 1, category_questions, 'The export should contain every question in the category')
+    
     def test_get_questions_with_category_gets_only_those_questions(self):
         questions_read = 0
         page = 1
@@ -177,6 +812,81 @@ class TriviaTestCase(unittest.TestCase):
             self.assertDictEqual(question, get_science_questions_json['questions'][i])
             i += 1
 
+    def test_memory_read_engine_returns_the_same_responses_as_sql(self):
+        urls = ['/questions', '/questions?page=2', '/questions?page=0', '/questions?after=5', '/questions?q=in&page=2',
+                '/questions?q=in&after=12', '/questions?q=a&after=none',
+                '/questions?q=Scissorhands', '/categories/1/questions', '/categories/4/questions?page=2', '/categories/999/questions']
+        sql_client = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'RESULT_CACHE_TTL': 0}).test_client()
+        sql_responses = [json.loads(sql_client.get(url).data) for url in urls]
+        
+        memory_client = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'RESULT_CACHE_TTL': 0, 'READ_ENGINE': 'memory'}).test_client()
+        for url, sql_response in zip(urls, sql_responses):
+            if url.startswith('/questions?q=') and self.database_path.startswith('postgresql'):
+                continue
+            self.assertEqual( json.loads(memory_client.get(url).data), sql_response, f'The memory read engine should answer {url} like the database')
+        self.assertEqual( json.loads(memory_client.get('/cache/stats').data)['snapshot']['loads'], 1, 'The snapshot should be loaded once')
+
+    def test_memory_read_engine_follows_posted_and_deleted_questions(self):
+        client = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'RESULT_CACHE_TTL': 0, 'READ_ENGINE': 'memory'}).test_client()
+        total_questions = json.loads(client.get('/categories/5/questions').data)['total_questions']
+        new_question = {'question': 'Which engine reads the questions from memory?',
+                        'answer': 'The snapshot.',
+                        'category': '5',
+                        'difficulty': '1'}
+        
+        question_id = json.loads(client.post('/questions', json=new_question).data)['question']['id']
+        get_result_json = json.loads(client.get(f'/categories/5/questions?after={question_id - 1}').data)
+        self.assertEqual( get_result_json['total_questions'], total_questions + 1 )
+        self.assertEqual( get_result_json['questions'][0]['id'], question_id, 'A posted question should be read from the snapshot')
+        
+        client.delete(f'/questions/{question_id}')
+        get_result_json = json.loads(client.get(f'/categories/5/questions?after={question_id - 1}').data)
+        self.assertEqual( get_result_json['total_questions'], total_questions )
+        self.assertNotIn( question_id, [question['id'] for question in get_result_json['questions']], 'A deleted question should leave the snapshot')
+        
+        stats = json.loads(client.get('/cache/stats').data)['snapshot']
+        self.assertEqual( stats['loads'], 1, 'Changes should be applied without reloading the snapshot')
+        self.assertEqual( stats['refreshes'], 1 )
+
+    def test_memory_read_engine_applies_changes_made_while_it_loads(self):
+        app = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'RESULT_CACHE_TTL': 0, 'READ_ENGINE': 'memory'})
+        client = app.test_client()
+        
+        # Another request changes a question while the snapshot reads the questions, possibly too late to be read.
+        def change_during_load(connection, cursor, statement, parameters, context, executemany):
+            if 'ORDER BY' in statement and not question_snapshot.is_loaded:
+                question = Question('Who flew the zeppelin?', 'Hugo Eckener', 4, 3)
+                question.id = 5
+                notify_question_change('update', question)
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', change_during_load)
+        try:
+            client.get('/questions')
+        finally:
+            with app.app_context():
+                event.remove(db.engine, 'before_cursor_execute', change_during_load)
+        
+        stats = json.loads(client.get('/cache/stats').data)['snapshot']
+        self.assertEqual( (stats['loads'], stats['refreshes']), (1, 1), 'A change made while the snapshot loads should be read again afterwards' )
+        
+    def test_concurrent_first_reads_load_the_memory_read_engine_once(self):
+        client = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'RESULT_CACHE_TTL': 0, 'READ_ENGINE': 'memory'}).test_client()
+        threads = [threading.Thread(target=client.get, args=('/questions',)) for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual( json.loads(client.get('/cache/stats').data)['snapshot']['loads'], 1, 'Concurrent first reads should share one load' )
+        
+    def test_memory_read_engine_picks_quiz_questions_in_the_category(self):
+        client = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'READ_ENGINE': 'memory'}).test_client()
+        category_questions = json.loads(client.get('/categories/4/questions').data)['questions']
+        previous_questions = [question['id'] for question in category_questions[1:]]
+        
+        get_result_json = json.loads(client.get(f'/quizzes?category=4&previous_questions={",".join(map(str, previous_questions))}').data)
+        self.assertEqual( get_result_json['question'], category_questions[0], 'The only question left in the category should be picked')
+
     """
     GET Quizzes
     """        
@@ -216,6 +926,203 @@ class TriviaTestCase(unittest.TestCase):
         self.check_basic_response_format(get_result, ['success'])
         self.assertTrue(get_result_json['success'], 'Get Quizzes with an invalid category should return successfully')
         self.assertNotIn('question', get_result_json, 'Get Quizzes should not return a question key when no question can be found')
+    def test_get_quizzes_never_repeats_a_previous_question(self):
+        previous_questions = []
+        get_result = self.client().get('/quizzes?category=1')
+        get_result_json = json.loads(get_result.data)
+        while 'question' in get_result_json:
+            self.assertNotIn(get_result_json['question']['id'], previous_questions, 'Get Quizzes should not return a question that was already used')
+            self.assertEqual(get_result_json['question']['category'], 1, 'Get Quizzes should return a question in the same category as requested')
+            previous_questions.append(get_result_json['question']['id'])
+            get_result = self.client().get(f'/quizzes?category=1&previous_questions={",".join(map(str, previous_questions))}')
+            get_result_json = json.loads(get_result.data)
+        
+        self.check_basic_response_format(get_result, ['success'])
+        self.assertGreater(len(previous_questions), 1, 'Get Quizzes should return every question in the category once')
+        
+    def test_get_quizzes_with_a_count_returns_distinct_new_questions(self):
+        category_questions = json.loads(self.client().get('/categories/2/questions').data)['questions']
+        previous_questions = [question['id'] for question in category_questions[:-3]]
+        get_result = self.client().get(f'/quizzes?category=2&count=3&previous_questions={",".join(map(str, previous_questions))}')
+        
+        self.assertEqual(get_result.status_code, 200)
+        self.check_basic_response_format(get_result, ['questions'])
+        questions = json.loads(get_result.data)['questions']
+        question_ids = [question['id'] for question in questions]
+        self.assertEqual(len(set(question_ids)), 3, 'Get Quizzes with a count should return that many distinct questions')
+        self.assertFalse(set(question_ids) & set(previous_questions), 'Get Quizzes should not return a question that was already used')
+        self.assertEqual(sorted(question_ids), [question['id'] for question in category_questions[-3:]], 'Get Quizzes should return the questions left in the category')
+
+    def test_get_quizzes_with_a_difficulty_mix_returns_those_difficulties(self):
+        difficulties = sorted(int(difficulty) for difficulty, total in json.loads(self.client().get('/categories/stats').data)['difficulties'].items() if total >= 2)[:2]
+        for read_engine in ('sql', 'memory'):
+            client = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'READ_ENGINE': read_engine}).test_client()
+            get_result = client.get(f'/quizzes?count=5&difficulty_mix={difficulties[0]}:2,{difficulties[1]}:1')
+            
+            questions = json.loads(get_result.data)['questions']
+            self.assertEqual(len(questions), 5, f'Get Quizzes with the {read_engine} engine should fill the count with any difficulty')
+            self.assertEqual(len({question['id'] for question in questions}), 5)
+            self.assertGreaterEqual(sum(question['difficulty'] == difficulties[0] for question in questions), 2)
+            self.assertGreaterEqual(sum(question['difficulty'] == difficulties[1] for question in questions), 1)
+
+    def test_get_quizzes_with_an_invalid_count_or_mix_results_in_a_400(self):
+        for query in ('count=0', 'count=51', 'count=abc', 'count=', 'count=2.5', 'difficulty_mix=1', 'difficulty_mix=1:0', 'count=2&difficulty_mix=1:2,2:1'):
+            get_result = self.client().get(f'/quizzes?{query}')
+            self.assertEqual(get_result.status_code, 400, f'Get Quizzes with {query} should result in a 400')
+
+    def test_question_selector_keeps_a_change_made_while_it_warms_up(self):
+        question = Question('Who flew the zeppelin?', 'Hugo Eckener', 7777, 3)
+        question.id = 5
+        def insert_during_warm_up(conn, cursor, statement, parameters, context, executemany):
+            if 'ORDER BY' in statement and not question_selector.is_warm:
+                notify_question_change('insert', question)
+        question_selector.reset()
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', insert_during_warm_up)
+            try:
+                question_selector.warm()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', insert_during_warm_up)
+
+            picked = question_selector.select(7777)
+        question_selector.reset()
+
+        self.assertIsNotNone(picked, 'A question added while the quiz index warms up should be in the index')
+        self.assertEqual(picked.id, 5)
+
+    def test_weighted_sampler_keeps_a_change_made_while_it_warms_up(self):
+        question = Question('Who flew the zeppelin?', 'Hugo Eckener', 7777, 3)
+        question.id = 5
+        def insert_during_warm_up(conn, cursor, statement, parameters, context, executemany):
+            if 'FROM questions' in statement and not weighted_sampler.is_warm:
+                notify_question_change('insert', question)
+        weighted_sampler.reset()
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', insert_during_warm_up)
+            try:
+                weighted_sampler.warm()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', insert_during_warm_up)
+
+        picked = weighted_sampler.draw_many(7777)
+        weighted_sampler.reset()
+
+        self.assertEqual(picked, [5], 'A question added while the weighted sampler warms up should be grouped')
+
+    def test_alias_table_draws_in_proportion_to_the_weights(self):
+        random.seed(1)
+        table = AliasTable([1, 0, 3, 6])
+        draws = Counter(table.draw() for _ in range(20000))
+        
+        self.assertEqual(draws[1], 0, 'An index with no weight should never be drawn')
+        for index, share in ((0, 0.1), (2, 0.3), (3, 0.6)):
+            self.assertAlmostEqual(draws[index] / 20000, share, delta=0.02)
+
+    def test_get_quizzes_with_difficulty_weights_returns_only_weighted_difficulties(self):
+        for read_engine in ('sql', 'memory'):
+            client = create_app(test_config={'SQLALCHEMY_DATABASE_URI': self.database_path, 'READ_ENGINE': read_engine}).test_client()
+            questions = json.loads(client.get('/quizzes?count=5&difficulty_weights=1:0,4:1').data)['questions']
+            
+            self.assertEqual(len(questions), 5, f'Get Quizzes with difficulty weights and the {read_engine} engine should fill the count')
+            self.assertTrue(all(question['difficulty'] == 4 for question in questions), 'Difficulties with no weight should never be picked')
+
+    def test_get_quizzes_by_rarity_avoids_questions_served_often(self):
+        category_ids = [json.loads(line)['id'] for line in self.client().get('/questions/export?category=2').data.splitlines()]
+        often, rarely = category_ids[:2]
+        previous_questions = ','.join(map(str, category_ids[2:]))
+        weighted_sampler.record_served([often] * 100000)
+        
+        random.seed(0)
+        for draw in range(10):
+            get_result_json = json.loads(self.client().get(f'/quizzes?category=2&rarity=true&previous_questions={previous_questions}').data)
+            self.assertEqual(get_result_json['question']['id'], rarely, 'A question served 100000 times should almost never be picked by rarity')
+
+    def test_get_quizzes_with_invalid_difficulty_weights_results_in_a_400(self):
+        for weights in ('1', '1:-1', '1:0,2:0', '1:nan', 'one:1'):
+            get_result = self.client().get(f'/quizzes?difficulty_weights={weights}')
+            self.assertEqual(get_result.status_code, 400, f'Get Quizzes with difficulty weights {weights} should result in a 400')
+
+    def test_get_quizzes_with_invalid_previous_questions_results_in_a_400(self):
+        get_result = self.client().get('/quizzes?category=1&previous_questions=1,two')
+        
+        self.check_basic_response_format(get_result)
+        self.assertEqual(get_result.status_code, 400, 'Get Quizzes with non numeric previous questions should result in a 400')
+
+    def test_quiz_session_asks_every_question_in_the_category_once(self):
+        start_result = self.client().post('/quizzes/sessions', json={'category': 1})
+        self.check_basic_response_format(start_result, ['session', 'expires_in', 'success'])
+        token = json.loads(start_result.data)['session']
+
+        asked = []
+        next_result = self.client().get(f'/quizzes/sessions/{token}/next')
+        next_json = json.loads(next_result.data)
+        while 'question' in next_json:
+            self.assertNotIn(next_json['question']['id'], asked, 'A quiz session should not ask a question twice')
+            self.assertEqual(next_json['question']['category'], 1, 'A quiz session should ask questions in its category')
+            asked.append(next_json['question']['id'])
+            self.assertEqual(next_json['questions_asked'], len(asked))
+            next_result = self.client().get(f'/quizzes/sessions/{token}/next')
+            next_json = json.loads(next_result.data)
+
+        self.check_basic_response_format(next_result, ['questions_asked', 'success'])
+        self.assertGreater(len(asked), 1, 'A quiz session should ask every question in the category')
+
+        end_result = self.client().delete(f'/quizzes/sessions/{token}')
+        self.check_basic_response_format(end_result, ['questions_asked', 'success'])
+        self.assertEqual(json.loads(end_result.data)['questions_asked'], len(asked))
+
+        next_result = self.client().get(f'/quizzes/sessions/{token}/next')
+        self.assertEqual(next_result.status_code, 404, 'An ended quiz session should result in a 404')
+
+    def test_quiz_session_with_an_unknown_token_results_in_a_404(self):
+        self.assertEqual(self.client().get('/quizzes/sessions/unknown/next').status_code, 404)
+        self.assertEqual(self.client().delete('/quizzes/sessions/unknown').status_code, 404)
+
+    def test_quiz_session_store_evicts_the_least_recently_used_session(self):
+        store = InMemoryQuizSessionStore(ttl=60, max_sessions=2)
+        for token in ('first', 'second', 'first', 'third'):
+            store.put(QuizSession(token, 1, SeenQuestions()))
+
+        self.assertEqual(len(store), 2, 'The store should keep at most max_sessions sessions')
+        self.assertIsNone(store.get('second'), 'The least recently used session should be evicted')
+        self.assertIsNotNone(store.get('first'))
+        self.assertIsNotNone(store.get('third'))
+        self.assertEqual(store.evictions, 1)
+
+    def test_concurrent_quiz_session_requests_never_ask_a_question_twice(self):
+        token = json.loads(self.client().post('/quizzes/sessions', json={'category': 1}).data)['session']
+        asked = []
+
+        def ask():
+            for attempt in range(3):
+                next_json = json.loads(self.client().get(f'/quizzes/sessions/{token}/next').data)
+                if 'question' in next_json:
+                    asked.append(next_json['question']['id'])
+
+        threads = [threading.Thread(target=ask) for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertGreater(len(asked), 1)
+        self.assertEqual(len(asked), len(set(asked)), 'Concurrent requests of a quiz session should not ask a question twice')
+        end_result = self.client().delete(f'/quizzes/sessions/{token}')
+        self.assertEqual(json.loads(end_result.data)['questions_asked'], len(asked))
+
+    def test_quiz_session_seen_questions_survive_serialization(self):
+        seen = SeenQuestions()
+        for question_id in (3, 70, 5, 1000):
+            seen.add(question_id)
+        self.assertEqual(list(QuizSession.from_bytes('token', QuizSession('token', 2, seen).to_bytes()).seen), [3, 5, 70, 1000])
+
+        for question_id in range(0, 1000, 2):
+            seen.add(question_id)
+        restored = SeenQuestions.from_bytes(seen.to_bytes())
+        self.assertEqual(len(restored), 503)
+        self.assertEqual(set(restored), set(range(0, 1000, 2)) | {3, 5, 1000})
+        self.assertNotIn(7, restored)
+
     """
     DELETE Questions
     """
@@ -265,6 +1172,78 @@ class TriviaTestCase(unittest.TestCase):
         get_result_json = json.loads(get_result.data)
         self.assertDictEqual(post_result_json['question'], get_result_json['question'] )
         
+    def test_post_question_changes_the_etag_of_the_questions(self):
+        get_result = self.client().get('/questions')
+        etag = get_result.headers.get('ETag')
+        
+        new_question = {'question': 'What does a strong ETag identify?',
+                        'answer': 'One exact representation of a resource.',
+                        'category': '5',
+                        'difficulty': '3'}
+        self.client().post('/questions', json=new_question)
+        
+        get_result_2 = self.client().get('/questions', headers={'If-None-Match': etag})
+        
+        self.assertEqual( get_result_2.status_code, 200, 'GET questions with an ETag from before a change should return the questions')
+        self.assertNotEqual( get_result_2.headers.get('ETag'), etag, 'Posting a question should change the ETag of the questions')
+        
+    def test_import_questions_inserts_valid_rows_and_reports_invalid_ones(self):
+        lines = [
+            json.dumps({'question': 'Imported question one?', 'answer': 'One', 'category': 5, 'difficulty': 1}),
+            json.dumps({'question': 'Imported question two?', 'answer': 'Two'}),
+            'not json',
+            json.dumps({'question': 'Imported question three?', 'answer': 'Three', 'category': '2', 'difficulty': '3'})
+        ]
+        
+        import_result = self.client().post('/questions/import?batch_size=2', data='\n'.join(lines), content_type='application/x-ndjson')
+        
+        self.assertEqual(import_result.status_code, 200, 'Importing questions resulted in an error')
+        self.check_basic_response_format(import_result, ['inserted', 'rejected', 'batches'])
+        import_result_json = json.loads(import_result.data)
+        self.assertEqual(import_result_json['inserted'], 2)
+        self.assertEqual(import_result_json['rejected'], 2)
+        self.assertEqual(len(import_result_json['batches']), 2, 'Four rows in batches of two should be written in two batches')
+        self.assertEqual([error['line'] for error in import_result_json['batches'][0]['errors']], [2])
+        self.assertEqual([error['line'] for error in import_result_json['batches'][1]['errors']], [3])
+        
+        get_result_json = json.loads(self.client().get('/questions?q=Imported question three').data)
+        self.assertEqual(len(get_result_json['questions']), 1, 'An imported question should be searchable')
+        self.delete_searched_questions('Imported question')
+        
+    def test_import_questions_reads_csv(self):
+        data = 'question,answer,category,difficulty\n"Imported from CSV, with a comma?",Yes,3,2\n'
+        
+        import_result = self.client().post('/questions/import', data=data, content_type='text/csv')
+        
+        self.check_basic_response_format(import_result, ['inserted', 'rejected', 'batches'])
+        self.assertEqual(json.loads(import_result.data)['inserted'], 1)
+        self.delete_searched_questions('Imported from CSV')
+        
+    def test_import_questions_rejects_values_that_are_not_integers(self):
+        lines = [json.dumps({'question': 'Imported odd value?', 'answer': 'No', 'category': 5, 'difficulty': difficulty})
+                 for difficulty in (2.7, True, '2.7', 'two', [2])]
+        lines.append('{"question": "Imported huge value?", "answer": "No", "category": 5, "difficulty": 1e400}')
+        lines.append(json.dumps({'question': 'Imported big value?', 'answer': 'No', 'category': 5, 'difficulty': 2 ** 31}))
+        lines.append(json.dumps({'question': 'Imported float category?', 'answer': 'No', 'category': 5.5, 'difficulty': 1}))
+        
+        import_result = self.client().post('/questions/import', data='\n'.join(lines), content_type='application/x-ndjson')
+        
+        self.assertEqual(import_result.status_code, 200, 'Importing values that are not integers resulted in an error')
+        import_result_json = json.loads(import_result.data)
+        self.assertEqual((import_result_json['inserted'], import_result_json['rejected']), (0, len(lines)), 'Values that are not integers should be rejected')
+        
+    def test_import_questions_reports_csv_lines_that_are_not_utf8(self):
+        data = ('question,answer,category,difficulty\n'.encode() + b'Imported caf\xe9?,Yes,3,2\n'
+                + 'Imported from CSV after a bad line?,Yes,3,2\n'.encode())
+        
+        import_result = self.client().post('/questions/import', data=data, content_type='text/csv')
+        
+        self.assertEqual(import_result.status_code, 200, 'Importing a CSV line that is not UTF-8 resulted in an error')
+        import_result_json = json.loads(import_result.data)
+        self.assertEqual((import_result_json['inserted'], import_result_json['rejected']), (1, 1))
+        self.assertEqual(import_result_json['batches'][0]['errors'], [{'line': 2, 'message': 'invalid UTF-8'}])
+        self.delete_searched_questions('Imported from CSV after a bad line')
+        
     def test_posting_an_incomplete_question_results_in_a_400(self):
         new_question = {'question': 'Why do we write our tests first?',
                         'answer': 'So that we only satify those tests.'}
@@ -274,6 +1253,100 @@ class TriviaTestCase(unittest.TestCase):
         self.check_basic_response_format(post_result)
         self.assertEqual(post_result.status_code, 400, 'Posting an invalid question should result in an error')
         
+    def test_get_questions_by_ids_reports_found_and_missing_ids(self):
+        question_ids = [question['id'] for question in json.loads(self.client().get('/questions').data)['questions'][:3]]
+        
+        get_result = self.client().get(f'/questions?ids={question_ids[2]},999999,{question_ids[0]},{question_ids[2]}')
+        
+        self.check_basic_response_format(get_result, ['questions', 'found', 'missing'])
+        get_result_json = json.loads(get_result.data)
+        self.assertEqual([question['id'] for question in get_result_json['questions']], [question_ids[2], question_ids[0]], 'Questions should be returned once each in the order requested')
+        self.assertEqual(get_result_json['found'], [question_ids[2], question_ids[0]])
+        self.assertEqual(get_result_json['missing'], [999999])
+        
+    def test_get_questions_by_invalid_ids_results_in_a_400(self):
+        for ids in ('1,two', '1,2147483648'):
+            get_result = self.client().get(f'/questions?ids={ids}')
+            
+            self.check_basic_response_format(get_result)
+            self.assertEqual(get_result.status_code, 400, f'Get Questions with the ids {ids} should result in a 400')
+        
+    def test_delete_questions_in_batch_removes_them_in_one_request(self):
+        new_question = {'question': 'Which batch am I in?', 'answer': 'The next one.', 'category': '5', 'difficulty': '1'}
+        question_ids = [json.loads(self.client().post('/questions', json=new_question).data)['question']['id'] for _ in range(3)]
+        stats_before = json.loads(self.client().get('/categories/stats').data)
+        
+        delete_result = self.client().delete('/questions', json={'ids': question_ids + [999999]})
+        
+        self.check_basic_response_format(delete_result, ['deleted', 'missing', 'failed'])
+        delete_result_json = json.loads(delete_result.data)
+        self.assertEqual(delete_result_json['deleted'], question_ids)
+        self.assertEqual(delete_result_json['missing'], [999999])
+        self.assertEqual(delete_result_json['failed'], [])
+        self.assertEqual(json.loads(self.client().get(f'/questions?ids={",".join(map(str, question_ids))}').data)['found'], [])
+        stats_after = json.loads(self.client().get('/categories/stats').data)
+        self.assertEqual(stats_after['categories']['5']['total_questions'], stats_before['categories']['5']['total_questions'] - 3, 'Deleted questions should be removed from the question counts')
+        
+    def test_delete_questions_in_batch_without_ids_results_in_a_400(self):
+        delete_result = self.client().delete('/questions', json={'ids': []})
+        
+        self.check_basic_response_format(delete_result)
+        self.assertEqual(delete_result.status_code, 400)
+        
+    def test_delete_questions_in_batch_with_ids_that_are_not_integers_results_in_a_400(self):
+        new_question = {'question': 'Which id am I?', 'answer': 'A whole one.', 'category': '5', 'difficulty': '1'}
+        question_id = json.loads(self.client().post('/questions', json=new_question).data)['question']['id']
+        
+        for ids in ([question_id + 0.7], [None], [[question_id]], [{}], [True], [f'{question_id}.0'], [2 ** 31], [str(2 ** 31)]):
+            delete_result = self.client().delete('/questions', json={'ids': ids})
+            self.check_basic_response_format(delete_result)
+            self.assertEqual(delete_result.status_code, 400, f'Deleting the ids {ids} should result in a 400')
+        self.assertEqual(json.loads(self.client().get(f'/questions?ids={question_id}').data)['found'], [question_id])
+        
+        self.client().delete(f'/questions/{question_id}')
+        
+    def test_delete_questions_in_batch_that_fails_reports_the_error(self):
+        new_question = {'question': 'Which batch fails?', 'answer': 'This one.', 'category': '5', 'difficulty': '1'}
+        question_id = json.loads(self.client().post('/questions', json=new_question).data)['question']['id']
+        def fail_delete(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('DELETE FROM questions'):
+                raise RuntimeError('the delete failed')
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', fail_delete)
+        try:
+            delete_result = self.client().delete('/questions', json={'ids': [question_id, 999999]})
+        finally:
+            with self.app.app_context():
+                event.remove(db.engine, 'before_cursor_execute', fail_delete)
+        
+        self.assertEqual(delete_result.status_code, 500)
+        self.check_basic_response_format(delete_result, ['deleted', 'missing', 'failed'])
+        delete_result_json = json.loads(delete_result.data)
+        self.assertEqual((delete_result_json['deleted'], delete_result_json['missing'], delete_result_json['failed']), ([], [999999], [question_id]))
+        
+        self.client().delete(f'/questions/{question_id}')
+        
+    def test_posting_a_question_in_an_unknown_category_results_in_a_422(self):
+        new_question = {'question': 'Which category is this in?',
+                        'answer': 'None that exists.',
+                        'category': '999',
+                        'difficulty': '1'}
+        
+        post_result = self.client().post('/questions', json=new_question)
+        
+        self.check_basic_response_format(post_result)
+        self.assertEqual(post_result.status_code, 422, 'Posting a question in an unknown category should result in an error')
+        
+    def test_question_category_migration_is_repeatable(self):
+        with self.app.app_context():
+            migrate_question_category(echo=lambda message: None)
+            
+            inspector = inspect(db.engine)
+            category_column = [column for column in inspector.get_columns('questions') if column['name'] == 'category'][0]
+            self.assertIsInstance(category_column['type'], Integer, 'The question category should be an integer')
+            self.assertTrue({'ix_questions_category_id', 'ix_questions_difficulty'} <= {index['name'] for index in inspector.get_indexes('questions')})
+        
+        self.assertGreater(json.loads(self.client().get('/categories/1/questions').data)['total_questions'], 0)
              
 # Make the tests conveniently executable
 if __name__ == "__main__":